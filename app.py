@@ -1,10 +1,34 @@
-from flask import Flask, send_file, request, render_template, jsonify, redirect
-from datetime import datetime
+from flask import Flask, Response, request, render_template, jsonify, redirect, g
+from datetime import datetime, timedelta
 import psycopg2
 import psycopg2.extras
 import os
+import atexit
+import time
+from functools import partial
 import urllib.parse
 from config import config
+import db_pool
+import ingest
+import spool
+import assets
+import counters  # registra o hook de contadores na ingestão
+import partitions
+import migrations
+import cache
+import pagination
+import export
+import live
+import tokens
+import empresas
+import devices  # registra o hook de estatísticas de dispositivos
+import geo  # registra o hook de estatísticas de provedor e estado
+import geoip
+import dedup
+import rollups  # registra o hook das séries temporais
+import funnel  # registra o hook do funil abertura -> clique
+import useragent
+import opens
 
 app = Flask(__name__)
 app.config.from_object(config)
@@ -13,20 +37,131 @@ app.config.from_object(config)
 DATABASE_CONFIG = config.DATABASE_CONFIG
 
 def get_db_connection():
-    """Cria uma conexão com o banco PostgreSQL"""
+    """Empresta uma conexão do pool PostgreSQL (conn.close() devolve ao pool)"""
     try:
-        conn = psycopg2.connect(
-            host=DATABASE_CONFIG['HOST'],
-            database=DATABASE_CONFIG['NAME'],
-            user=DATABASE_CONFIG['USER'],
-            password=DATABASE_CONFIG['PASSWORD'],
-            port=DATABASE_CONFIG['PORT']
-        )
-        return conn
+        return db_pool.get_pool(config).getconn()
     except psycopg2.Error as e:
         print(f"Erro ao conectar ao PostgreSQL: {e}")
         return None
 
+# Imagens de rastreamento carregadas em memória (inclui pixel.gif / pixel.png)
+image_registry = assets.load_registry(config.TRACKING_IMAGES_DIR, config.TRACKING_IMAGES)
+
+# Faixas de IP de proxies de imagem e buscas automáticas (open_class)
+opens.load_from_config(config)
+
+# Base de IP -> ASN e estado (enriquecimento na ingestão)
+geoip.load_from_config(config)
+
+# Fuso dos buckets de /api/timeseries
+rollups.configure_from_config(config)
+
+# Empresas de boleto (empresas.json), recarregadas quando o arquivo muda
+empresa_registry = empresas.EmpresaRegistry(config.EMPRESAS_FILE, config.EMPRESAS_RELOAD_INTERVAL)
+
+# Codec dos links /t/<token>.png e /b/<token>; None sem segredo configurado
+def create_token_codec(snapshot):
+    if not config.TRACKING_TOKEN_SECRET:
+        return None
+    return tokens.codec_from_config(config, snapshot.token_ids)
+
+token_codec = create_token_codec(empresa_registry.current())
+
+def reload_token_codec(snapshot):
+    global token_codec
+    token_codec = create_token_codec(snapshot)
+
+empresa_registry.on_reload(reload_token_codec)
+
+def create_ingest_sink():
+    """Cria o destino dos eventos: spool em disco (durável), fila em memória
+    ou gravação síncrona (INGEST_MODE = 'sync', para depuração)"""
+    if config.INGEST_MODE == 'sync':
+        return ingest.SyncWriter(get_db_connection)
+    
+    if config.SPOOL_ENABLED:
+        event_spool = spool.Spool(
+            config.SPOOL_DIR,
+            segment_bytes=config.SPOOL_SEGMENT_BYTES,
+            segment_max_age_ms=config.SPOOL_SEGMENT_MAX_AGE_MS,
+            fsync=config.SPOOL_FSYNC,
+            fsync_interval_ms=config.SPOOL_FSYNC_INTERVAL_MS
+        )
+        replayer = spool.SpoolReplayer(
+            event_spool,
+            get_db_connection,
+            interval_ms=config.SPOOL_REPLAY_INTERVAL_MS,
+            retry_interval_ms=config.SPOOL_RETRY_INTERVAL_MS
+        )
+        return spool.SpoolSink(event_spool, replayer)
+    
+    return ingest.WriteBehindBuffer(
+        get_db_connection,
+        batch_size=config.INGEST_BATCH_SIZE,
+        flush_interval_ms=config.INGEST_FLUSH_INTERVAL_MS,
+        max_queue_size=config.INGEST_QUEUE_SIZE,
+        retry_interval_ms=config.INGEST_RETRY_INTERVAL_MS
+    )
+
+ingest_sink = create_ingest_sink()
+
+# atexit executa em ordem inversa: grava os eventos antes de fechar o pool
+atexit.register(db_pool.close_pool)
+atexit.register(ingest_sink.stop, config.INGEST_SHUTDOWN_TIMEOUT)
+
+# Feed ao vivo (SSE): cada lote ingerido é publicado via NOTIFY
+live_hub = live.LiveHub(
+    db_pool.connect_kwargs_from_config(config),
+    config.LIVE_CHANNEL,
+    client_queue_size=config.LIVE_CLIENT_QUEUE_SIZE
+)
+if config.LIVE_ENABLED:
+    ingest.register_batch_hook(live.make_notify_hook(config.LIVE_CHANNEL, config.LIVE_RECENT_EVENTS))
+
+# Cache das consultas de estatísticas (dashboard e /api/stats)
+stats_cache = cache.ResultCache(
+    default_ttl=config.CACHE_DEFAULT_TIMEOUT,
+    stale_ttl=config.CACHE_STALE_TIMEOUT,
+    enabled=config.CACHE_TYPE != 'null'
+)
+
+# Janela de deduplicação das aberturas de imagem (por processo)
+open_window = dedup.DedupWindow(config.OPEN_DEDUP_WINDOW_S, config.OPEN_DEDUP_MAX_KEYS)
+
+# Latência dos endpoints de rastreamento (resposta ao cliente, sem o registro)
+TRACKING_ENDPOINTS = ('serve_image', 'redirect_boleto', 'serve_token_image', 'redirect_boleto_token')
+tracking_latency = {endpoint: ingest.LatencyRecorder() for endpoint in TRACKING_ENDPOINTS}
+
+def deliver_events(events):
+    """Entrega ao sink os eventos capturados numa requisição"""
+    for event in events:
+        if not ingest_sink.enqueue(event):
+            print(f"Falha na ingestão, evento descartado: {event.id_fatura or 'N/A'}")
+
+def capture_event(event):
+    """Captura o evento; no modo assíncrono ele só é entregue após a resposta"""
+    if config.INGEST_MODE == 'sync':
+        deliver_events([event])
+    else:
+        g.setdefault('tracking_events', []).append(event)
+
+@app.before_request
+def start_tracking_timer():
+    if request.endpoint in TRACKING_ENDPOINTS:
+        g.tracking_start = time.perf_counter()
+
+@app.after_request
+def dispatch_tracking_events(response):
+    """Responde primeiro e registra depois: os eventos vão para o sink quando
+    o servidor termina de enviar a resposta (call_on_close)"""
+    start = g.pop('tracking_start', None)
+    if start is not None:
+        tracking_latency[request.endpoint].record(time.perf_counter() - start)
+    events = g.pop('tracking_events', None)
+    if events:
+        response.call_on_close(partial(deliver_events, events))
+    return response
+
 def init_db():
     """Inicializa o banco de dados com as tabelas necessárias"""
     conn = get_db_connection()
@@ -34,140 +169,236 @@ def init_db():
         print("Não foi possível conectar ao banco de dados")
         return
     
-    cursor = conn.cursor()
     try:
-        # Tabela para rastreamento de imagens
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS image_views (
-                id SERIAL PRIMARY KEY,
-                id_fatura VARCHAR(255) NOT NULL,
-                ip_address VARCHAR(45),
-                user_agent TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                referer TEXT
-            )
-        ''')
+        # Esquema versionado: tabelas, contadores e índices (ver migrations.py)
+        migrations.migrate(conn)
+        print("Tabelas image_views e boleto_views criadas/verificadas com sucesso!")
         
-        # Tabela para rastreamento de boletos
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS boleto_views (
-                id SERIAL PRIMARY KEY,
-                empresa VARCHAR(50) NOT NULL,
-                codigo_boleto VARCHAR(255) NOT NULL,
-                id_fatura VARCHAR(255),
-                ip_address VARCHAR(45),
-                user_agent TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                referer TEXT
-            )
-        ''')
+        # Partições futuras e retenção
+        result = partitions.maintain_from_config(conn, config)
+        if result['created'] or result['removed']:
+            print(f"Partições criadas: {result['created']} / removidas: {result['removed']}")
         
-        conn.commit()
-        print("Tabelas image_views e boleto_views criadas/verificadas com sucesso!")
+        # Retenção dos buckets de minuto das séries temporais
+        rollups.prune(conn, config.ROLLUP_MINUTE_RETENTION_DAYS)
     except psycopg2.Error as e:
         print(f"Erro ao criar tabelas: {e}")
     finally:
-        cursor.close()
         conn.close()
 
+# Tamanho das colunas id_fatura / codigo_boleto (VARCHAR(255))
+MAX_IDENTIFIER_LENGTH = 255
+
+def invalid_identifier(name, value):
+    """Mensagem de erro se o identificador não pode ser gravado (longo demais
+    para a coluna ou com byte NUL, que o PostgreSQL recusa); senão None"""
+    if value is None:
+        return None
+    if len(value) > MAX_IDENTIFIER_LENGTH:
+        return f"Parâmetro {name} deve ter no máximo {MAX_IDENTIFIER_LENGTH} caracteres"
+    if '\x00' in value:
+        return f"Parâmetro {name} inválido"
+    return None
+
+def header_text(name):
+    """Cabeçalho da requisição sem bytes NUL (texto livre gravado como está)"""
+    return request.headers.get(name, '').replace('\x00', '')
+
 def log_image_view(id_fatura):
-    """Registra uma visualização da imagem no banco de dados"""
-    conn = get_db_connection()
-    if not conn:
-        print("Não foi possível conectar ao banco para registrar visualização")
-        return
-    
-    cursor = conn.cursor()
-    try:
-        cursor.execute('''
-            INSERT INTO image_views (id_fatura, ip_address, user_agent, referer)
-            VALUES (%s, %s, %s, %s)
-        ''', (
-            id_fatura,
-            request.remote_addr,
-            request.headers.get('User-Agent', ''),
-            request.headers.get('Referer', '')
-        ))
-        
-        conn.commit()
-        print(f"Visualização registrada para fatura: {id_fatura}")
-    except psycopg2.Error as e:
-        print(f"Erro ao registrar visualização: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+    """Registra a visualização da imagem (capturada na requisição)"""
+    user_agent = header_text('User-Agent')
+    # Reabertura dentro da janela: só soma nos contadores, sem nova linha
+    repeated = open_window.seen(dedup.open_key(id_fatura, request.remote_addr, user_agent))
+    event_type = ingest.ImageRepeatEvent if repeated else ingest.ImageViewEvent
+    event = event_type(
+        id_fatura,
+        request.remote_addr,
+        user_agent,
+        header_text('Referer'),
+        datetime.now()
+    )
+    capture_event(event)
 
-@app.route('/')
-def index():
-    """Página principal com estatísticas"""
+def log_boleto_view(empresa, codigo, id_fatura):
+    """Registra o acesso ao boleto (capturado na requisição)"""
+    event = ingest.BoletoViewEvent(
+        empresa,
+        codigo,
+        id_fatura if id_fatura else None,  # id_fatura é opcional
+        request.remote_addr,
+        header_text('User-Agent'),
+        header_text('Referer'),
+        datetime.now()
+    )
+    capture_event(event)
+
+def fetch_totals(cursor, exclude=()):
+    """Retorna (total de visualizações de imagens, total de acessos a boletos,
+    aberturas únicas de imagens, número de faturas vistas)"""
+    cursor.execute('SELECT kind, {}, views - repeat_views, faturas FROM view_totals'
+                   .format(counters.views_column(exclude)))
+    totals = {kind: (views, unique, faturas) for kind, views, unique, faturas in cursor.fetchall()}
+    image_views, unique_image_views, total_faturas = totals.get('image', (0, 0, 0))
+    return image_views, totals.get('boleto', (0, 0, 0))[0], unique_image_views, total_faturas
+
+class DatabaseUnavailable(Exception):
+    """Não foi possível obter uma conexão com o banco"""
+
+def load_dashboard_stats():
+    """Executa as consultas do dashboard e retorna os dados do template"""
     conn = get_db_connection()
     if not conn:
-        return "Erro ao conectar ao banco de dados", 500
+        raise DatabaseUnavailable()
     
     cursor = conn.cursor()
     try:
-        # Estatísticas de imagens
-        cursor.execute('SELECT COUNT(*) FROM image_views')
-        total_image_views = cursor.fetchone()[0]
+        # Lido antes dos contadores: a página em cache recupera a partir dele
+        # (/api/dashboard?since=) o que mudou depois da leitura
+        watermark = counters.current_watermark(cursor)
         
-        # Estatísticas de boletos
-        cursor.execute('SELECT COUNT(*) FROM boleto_views')
-        total_boleto_views = cursor.fetchone()[0]
+        # Totais de imagens e boletos (contadores)
+        total_image_views, total_boleto_views, total_unique_image_views, total_faturas = fetch_totals(cursor)
         
-        # Visualizações de imagens por fatura
+        # Faturas mais vistas (idx_fatura_view_counters_views)
         cursor.execute('''
-            SELECT id_fatura, COUNT(*) as views, 
-                   MIN(timestamp) as first_view, 
-                   MAX(timestamp) as last_view
-            FROM image_views 
-            GROUP BY id_fatura 
+            SELECT id_fatura, views, first_view, last_view
+            FROM fatura_view_counters 
             ORDER BY views DESC
-        ''')
+            LIMIT %s
+        ''', (config.TOP_FATURAS,))
         fatura_stats = cursor.fetchall()
         
-        # Visualizações de imagens recentes
-        cursor.execute('''
-            SELECT id_fatura, ip_address, timestamp, user_agent
-            FROM image_views 
-            ORDER BY timestamp DESC 
-            LIMIT 10
-        ''')
-        recent_image_views = cursor.fetchall()
+        # Limite inferior em timestamp para que só as partições recentes sejam lidas
+        recent_since = datetime.now() - timedelta(days=config.RECENT_VIEWS_WINDOW_DAYS)
+        recent_image_views, recent_boleto_views = fetch_recent_views(cursor, recent_since)
         
         # Visualizações de boletos por empresa
         cursor.execute('''
-            SELECT empresa, COUNT(*) as views, 
-                   MIN(timestamp) as first_view, 
-                   MAX(timestamp) as last_view
-            FROM boleto_views 
-            GROUP BY empresa 
+            SELECT empresa, views, first_view, last_view
+            FROM empresa_boleto_counters 
             ORDER BY views DESC
         ''')
         boleto_empresa_stats = cursor.fetchall()
         
-        # Visualizações de boletos recentes
+        # Dispositivos e clientes na mesma janela, das estatísticas diárias
+        image_devices = devices.load_breakdown(cursor, 'image', date_from=recent_since.date())['totals']
+        boleto_devices = devices.load_breakdown(cursor, 'boleto', date_from=recent_since.date())['totals']
+        
+        # Horários de pico na mesma janela, dos rollups por hora (horário local)
+        peak_to = rollups.now()
+        hours = rollups.load_hour_of_day(cursor, 'opens', peak_to - timedelta(days=config.RECENT_VIEWS_WINDOW_DAYS),
+                                         peak_to)
+        peak_hours = sorted((h for h in hours if h[1]), key=lambda h: (-h[1], h[0]))[:5]
+        
+        return {
+            'total_image_views': total_image_views,
+            'total_unique_image_views': total_unique_image_views,
+            'total_boleto_views': total_boleto_views,
+            'total_faturas': total_faturas,
+            'top_faturas': config.TOP_FATURAS,
+            'fatura_stats': fatura_stats,
+            'recent_image_views': recent_image_views,
+            'boleto_empresa_stats': boleto_empresa_stats,
+            'recent_boleto_views': recent_boleto_views,
+            'device_stats': device_rows(image_devices, boleto_devices, 'device'),
+            'client_stats': device_rows(image_devices, boleto_devices, 'client'),
+            'device_window_days': config.RECENT_VIEWS_WINDOW_DAYS,
+            'peak_hours': peak_hours,
+            'dedup_window_minutes': config.OPEN_DEDUP_WINDOW_S // 60,
+            'cursor': counters.encode_watermark(watermark)
+        }
+    finally:
+        cursor.close()
+        conn.close()
+
+def fetch_recent_views(cursor, recent_since):
+    """Últimas 10 visualizações de imagens e de boletos desde recent_since"""
+    cursor.execute('''
+        SELECT id_fatura, ip_address, timestamp, user_agent
+        FROM image_views 
+        WHERE timestamp >= %s
+        ORDER BY timestamp DESC 
+        LIMIT 10
+    ''', (recent_since,))
+    recent_image_views = cursor.fetchall()
+    
+    cursor.execute('''
+        SELECT empresa, codigo_boleto, id_fatura, ip_address, timestamp
+        FROM boleto_views 
+        WHERE timestamp >= %s
+        ORDER BY timestamp DESC 
+        LIMIT 10
+    ''', (recent_since,))
+    recent_boleto_views = cursor.fetchall()
+    return recent_image_views, recent_boleto_views
+
+def load_dashboard_delta(since):
+    """Estado do dashboard a partir do cursor da página: totais, contadores
+    alterados (valores atuais, não incrementos) e visualizações recentes"""
+    conn = get_db_connection()
+    if not conn:
+        raise DatabaseUnavailable()
+    
+    cursor = conn.cursor()
+    try:
+        watermark = counters.current_watermark(cursor)
+        total_image_views, total_boleto_views, total_unique_image_views, total_faturas = fetch_totals(cursor)
         cursor.execute('''
-            SELECT empresa, codigo_boleto, id_fatura, ip_address, timestamp
-            FROM boleto_views 
-            ORDER BY timestamp DESC 
-            LIMIT 10
-        ''')
-        recent_boleto_views = cursor.fetchall()
+            SELECT id_fatura, views, first_view, last_view
+            FROM fatura_view_counters
+            WHERE changed_txid >= %s
+        ''', (since,))
+        faturas = cursor.fetchall()
+        cursor.execute('''
+            SELECT empresa, views, first_view, last_view
+            FROM empresa_boleto_counters
+            WHERE changed_txid >= %s
+        ''', (since,))
+        empresas = cursor.fetchall()
         
-        return render_template('dashboard.html', 
-                             total_image_views=total_image_views,
-                             total_boleto_views=total_boleto_views,
-                             fatura_stats=fatura_stats,
-                             recent_image_views=recent_image_views,
-                             boleto_empresa_stats=boleto_empresa_stats,
-                             recent_boleto_views=recent_boleto_views)
-    except psycopg2.Error as e:
-        print(f"Erro ao buscar estatísticas: {e}")
-        return "Erro ao buscar dados do banco", 500
+        recent_since = datetime.now() - timedelta(days=config.RECENT_VIEWS_WINDOW_DAYS)
+        recent_image_views, recent_boleto_views = fetch_recent_views(cursor, recent_since)
+        
+        # Mesmo formato das mensagens do feed ao vivo, eventos do mais antigo ao mais novo
+        recent = [{'kind': 'image', 'id_fatura': row[0], 'ip_address': row[1],
+                   'timestamp': row[2].isoformat(), 'user_agent': (row[3] or '')[:200]}
+                  for row in reversed(recent_image_views)]
+        recent += [{'kind': 'boleto', 'empresa': row[0], 'codigo_boleto': row[1][:40], 'id_fatura': row[2],
+                    'ip_address': row[3], 'timestamp': row[4].isoformat()}
+                   for row in reversed(recent_boleto_views)]
+        return {
+            'totals': {'image': total_image_views, 'unique_image': total_unique_image_views,
+                       'boleto': total_boleto_views, 'faturas': total_faturas},
+            'faturas': [[k, n, first.isoformat(), last.isoformat()] for k, n, first, last in faturas],
+            'empresas': [[k, n, first.isoformat(), last.isoformat()] for k, n, first, last in empresas],
+            'recent': recent,
+            'cursor': counters.encode_watermark(watermark)
+        }
     finally:
         cursor.close()
         conn.close()
 
+def device_rows(image_breakdown, boleto_breakdown, field):
+    """Linhas (nome, aberturas, cliques) ordenadas por aberturas"""
+    names = set(image_breakdown[field]) | set(boleto_breakdown[field])
+    rows = [(name, image_breakdown[field].get(name, 0), boleto_breakdown[field].get(name, 0))
+            for name in names]
+    return sorted(rows, key=lambda row: (-row[1], -row[2], row[0]))
+
+@app.route('/')
+def index():
+    """Página principal com estatísticas"""
+    try:
+        stats = stats_cache.get('dashboard', load_dashboard_stats,
+                                ttl=config.CACHE_TTLS.get('dashboard'))
+    except DatabaseUnavailable:
+        return "Erro ao conectar ao banco de dados", 500
+    except psycopg2.Error as e:
+        print(f"Erro ao buscar estatísticas: {e}")
+        return "Erro ao buscar dados do banco", 500
+    
+    return render_template('dashboard.html', **stats)
+
 @app.route('/image/<filename>')
 def serve_image(filename):
     """Serve a imagem com rastreamento de visualizações"""
@@ -175,86 +406,406 @@ def serve_image(filename):
     
     if not id_fatura:
         return "Parâmetro id_fatura é obrigatório", 400
+    error = invalid_identifier('id_fatura', id_fatura)
+    if error:
+        return error, 400
+    
+    # Apenas imagens carregadas na inicialização podem ser servidas
+    asset = image_registry.get(filename)
+    if asset is None:
+        return "Imagem não encontrada", 404
     
     # Registra a visualização
     log_image_view(id_fatura)
     
-    # Caminho para a imagem
-    image_path = os.path.join(os.getcwd(), filename)
+    return asset_response(asset)
+
+@app.route('/t/<token>.<any(png, gif):ext>')
+def serve_token_image(token, ext):
+    """Pixel/imagem de rastreamento identificado por token assinado"""
+    if token_codec is None:
+        return "Imagem não encontrada", 404
+    try:
+        decoded = token_codec.decode(token)
+    except tokens.InvalidToken:
+        return "Imagem não encontrada", 404
+    if not isinstance(decoded, tokens.PixelToken) or invalid_identifier('id_fatura', decoded.id_fatura):
+        return "Imagem não encontrada", 404
     
-    if not os.path.exists(image_path):
+    asset = image_registry.get(decoded.image or 'pixel.' + ext)
+    if asset is None:
         return "Imagem não encontrada", 404
     
-    # Retorna a imagem
-    return send_file(image_path, mimetype='image/png')
+    log_image_view(decoded.id_fatura)
+    
+    return asset_response(asset)
 
-@app.route('/api/stats')
-def api_stats():
-    """API para obter estatísticas em formato JSON"""
+def asset_response(asset):
+    """Resposta com a imagem da memória.
+
+    "no-cache" obriga o cliente a revalidar a cada abertura (registrada pela
+    rota) e a ETag permite responder 304.
+    """
+    response = Response(asset.data, mimetype=asset.mimetype)
+    response.set_etag(asset.etag)
+    response.last_modified = asset.last_modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def load_api_stats(exclude=()):
+    """Executa as consultas de /api/stats e retorna o corpo JSON"""
     conn = get_db_connection()
     if not conn:
-        return jsonify({'error': 'Erro ao conectar ao banco de dados'}), 500
+        raise DatabaseUnavailable()
     
     cursor = conn.cursor()
     try:
-        # Estatísticas de imagens
-        cursor.execute('SELECT COUNT(*) FROM image_views')
-        total_image_views = cursor.fetchone()[0]
+        # Lido antes dos contadores: é o ponto de partida de ?since=
+        watermark = counters.current_watermark(cursor)
+        total_image_views, total_boleto_views, total_unique_image_views, total_faturas = \
+            fetch_totals(cursor, exclude)
+        views = counters.views_column(exclude)
         
+        # Faturas mais vistas (views inclui as reaberturas; unique_views não)
         cursor.execute('''
-            SELECT id_fatura, COUNT(*) as views
-            FROM image_views 
-            GROUP BY id_fatura 
+            SELECT id_fatura, {0} AS views, views - repeat_views
+            FROM fatura_view_counters 
             ORDER BY views DESC
-        ''')
+            LIMIT %s
+        '''.format(views), (config.TOP_FATURAS,))
         fatura_stats = cursor.fetchall()
         
         # Estatísticas de boletos
-        cursor.execute('SELECT COUNT(*) FROM boleto_views')
-        total_boleto_views = cursor.fetchone()[0]
-        
         cursor.execute('''
-            SELECT empresa, COUNT(*) as views
-            FROM boleto_views 
-            GROUP BY empresa 
+            SELECT empresa, {0} AS views
+            FROM empresa_boleto_counters 
             ORDER BY views DESC
-        ''')
+        '''.format(views))
         boleto_stats = cursor.fetchall()
         
-        return jsonify({
+        return {
             'imagens': {
                 'total_views': total_image_views,
-                'fatura_stats': [{'id_fatura': row[0], 'views': row[1]} for row in fatura_stats]
+                'unique_views': total_unique_image_views,
+                'total_faturas': total_faturas,
+                'fatura_stats': [{'id_fatura': row[0], 'views': row[1], 'unique_views': row[2]}
+                                 for row in fatura_stats]
             },
             'boletos': {
                 'total_views': total_boleto_views,
                 'empresa_stats': [{'empresa': row[0], 'views': row[1]} for row in boleto_stats]
-            }
-        })
+            },
+            'cursor': counters.encode_watermark(watermark),
+            'exclude': list(exclude)
+        }
+    finally:
+        cursor.close()
+        conn.close()
+
+def load_stats_delta(since, exclude=()):
+    """Contadores alterados desde o cursor, em formato compacto"""
+    conn = get_db_connection()
+    if not conn:
+        raise DatabaseUnavailable()
+    
+    cursor = conn.cursor()
+    try:
+        watermark = counters.current_watermark(cursor)
+        total_image_views, total_boleto_views, total_unique_image_views, total_faturas = \
+            fetch_totals(cursor, exclude)
+        faturas, empresas = counters.changed_since(cursor, since, exclude)
+        return {
+            'totals': {'image': total_image_views, 'unique_image': total_unique_image_views,
+                       'boleto': total_boleto_views, 'faturas': total_faturas},
+            'faturas': [list(row) for row in faturas],
+            'empresas': [list(row) for row in empresas],
+            'cursor': counters.encode_watermark(watermark)
+        }
+    finally:
+        cursor.close()
+        conn.close()
+
+@app.route('/api/stats')
+def api_stats():
+    """API para obter estatísticas em formato JSON"""
+    since = request.args.get('since')
+    try:
+        # ?exclude=proxy,prefetch (ou machine) desconta as aberturas de máquina
+        exclude = opens.parse_exclude(request.args.get('exclude'))
+        if since is not None:
+            # Só os contadores alterados; específico de cada cliente, sem cache
+            stats = load_stats_delta(counters.decode_watermark(since), exclude)
+        else:
+            stats = stats_cache.get('api_stats:' + ','.join(exclude), partial(load_api_stats, exclude),
+                                    ttl=config.CACHE_TTLS.get('api_stats'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except DatabaseUnavailable:
+        return jsonify({'error': 'Erro ao conectar ao banco de dados'}), 500
     except psycopg2.Error as e:
         print(f"Erro ao buscar estatísticas da API: {e}")
         return jsonify({'error': 'Erro ao buscar dados do banco'}), 500
+    
+    return jsonify(stats)
+
+@app.route('/api/dashboard')
+def api_dashboard():
+    """Recuperação do dashboard ao vivo: o que mudou desde ?since=<cursor>"""
+    try:
+        # Específico de cada página, sem cache
+        stats = load_dashboard_delta(counters.decode_watermark(request.args.get('since')))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except DatabaseUnavailable:
+        return jsonify({'error': 'Erro ao conectar ao banco de dados'}), 500
+    except psycopg2.Error as e:
+        print(f"Erro ao buscar estado do dashboard: {e}")
+        return jsonify({'error': 'Erro ao buscar dados do banco'}), 500
+    
+    return jsonify(stats)
+
+@app.route('/api/stream')
+def api_stream():
+    """Feed ao vivo (Server-Sent Events) com novos eventos e deltas dos contadores"""
+    if not config.LIVE_ENABLED:
+        return jsonify({'error': 'Feed ao vivo desativado'}), 404
+    
+    subscription = live_hub.subscribe()
+    response = Response(live.sse_stream(live_hub, subscription, config.LIVE_HEARTBEAT_S),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # desativa o buffer do nginx
+    response.call_on_close(partial(live_hub.unsubscribe, subscription))
+    return response
+
+@app.route('/api/live')
+def api_live():
+    """API com as métricas do feed ao vivo"""
+    return jsonify(live_hub.stats())
+
+@app.route('/api/cache')
+def api_cache():
+    """API com as métricas do cache de estatísticas"""
+    return jsonify(stats_cache.stats())
+
+@app.route('/api/pool')
+def api_pool():
+    """API com as métricas do pool de conexões do processo"""
+    return jsonify(db_pool.get_pool(config).stats())
+
+@app.route('/api/ingest')
+def api_ingest():
+    """API com os contadores da ingestão e a latência dos endpoints de rastreamento"""
+    latency = {}
+    for endpoint, recorder in tracking_latency.items():
+        latency[endpoint] = recorder.percentiles()
+        p99 = latency[endpoint]['p99_ms']
+        latency[endpoint]['p99_target_ms'] = config.TRACKING_P99_TARGET_MS
+        latency[endpoint]['p99_ok'] = p99 is None or p99 <= config.TRACKING_P99_TARGET_MS
+    return jsonify({
+        'mode': config.INGEST_MODE,
+        'sink': ingest_sink.stats(),
+        'latency': latency,
+        'user_agent_cache': useragent.cache_stats(),
+        'open_dedup': open_window.stats()
+    })
+
+@app.route('/api/devices')
+def api_devices():
+    """Aberturas e cliques por dispositivo, cliente e sistema (pré-agregados por dia)"""
+    kind = request.args.get('kind')
+    bucket = request.args.get('by', 'day')
+    if kind is not None and kind not in devices.KINDS:
+        return jsonify({'error': 'Parâmetro kind deve ser image ou boleto'}), 400
+    if bucket not in devices.BUCKETS:
+        return jsonify({'error': 'Parâmetro by deve ser day, week ou month'}), 400
+    try:
+        date_from = request.args.get('from')
+        date_to = request.args.get('to')
+        date_from = pagination.parse_datetime(date_from, 'from').date() if date_from else None
+        date_to = pagination.parse_datetime(date_to, 'to').date() if date_to else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'error': 'Erro ao conectar ao banco de dados'}), 500
+    
+    cursor = conn.cursor()
+    try:
+        return jsonify(devices.load_breakdown(cursor, kind, request.args.get('empresa'),
+                                              date_from, date_to, bucket))
+    except psycopg2.Error as e:
+        print(f"Erro ao buscar estatísticas de dispositivos: {e}")
+        return jsonify({'error': 'Erro ao buscar dados do banco'}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+@app.route('/api/geo')
+def api_geo():
+    """Aberturas e cliques por estado e por provedor (ASN), pré-agregados por dia"""
+    kind = request.args.get('kind')
+    if kind is not None and kind not in geo.KINDS:
+        return jsonify({'error': 'Parâmetro kind deve ser image ou boleto'}), 400
+    try:
+        # limit = quantos provedores listar
+        page = pagination.parse_page_args(request.args, config.GEO_API_ASN_LIMIT,
+                                          config.GEO_API_MAX_ASN_LIMIT)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    date_from = page['from'].date() if page['from'] else None
+    date_to = page['to'].date() if page['to'] else None
+    
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'error': 'Erro ao conectar ao banco de dados'}), 500
+    
+    cursor = conn.cursor()
+    try:
+        return jsonify(geo.load_breakdown(cursor, kind, request.args.get('empresa'),
+                                          date_from, date_to, page['limit']))
+    except psycopg2.Error as e:
+        print(f"Erro ao buscar estatísticas de provedor e estado: {e}")
+        return jsonify({'error': 'Erro ao buscar dados do banco'}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+@app.route('/api/timeseries')
+def api_timeseries():
+    """Série temporal de aberturas ou cliques, lida só dos rollups (horário local)"""
+    metric = request.args.get('metric', 'opens')
+    bucket = request.args.get('bucket', 'hour')
+    empresa = request.args.get('empresa')
+    id_fatura = request.args.get('id_fatura')
+    if metric not in rollups.METRICS:
+        return jsonify({'error': 'Parâmetro metric deve ser opens, unique_opens ou clicks'}), 400
+    if bucket not in rollups.BUCKETS and bucket != rollups.HOUR_OF_DAY:
+        return jsonify({'error': 'Parâmetro bucket deve ser minute, hour, day ou hour_of_day'}), 400
+    if bucket == 'minute' and id_fatura:
+        return jsonify({'error': 'Buckets de minuto não têm quebra por fatura; use hour ou day'}), 400
+    try:
+        date_from = request.args.get('from')
+        date_to = request.args.get('to')
+        date_from = pagination.parse_datetime(date_from, 'from') if date_from else None
+        date_to = pagination.parse_datetime(date_to, 'to') if date_to else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    span = timedelta(hours=config.ROLLUP_DEFAULT_SPAN_HOURS[bucket])
+    date_from, date_to = rollups.default_range(bucket, span, date_from, date_to)
+    if date_to <= date_from:
+        return jsonify({'error': 'Parâmetro to deve ser posterior a from'}), 400
+    if bucket in rollups.BUCKETS and (date_to - date_from) / rollups.BUCKETS[bucket][1] > config.ROLLUP_MAX_POINTS:
+        return jsonify({'error': f'Período longo demais para bucket {bucket} '
+                                 f'(máximo de {config.ROLLUP_MAX_POINTS} pontos)'}), 400
+    
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'error': 'Erro ao conectar ao banco de dados'}), 500
+    
+    cursor = conn.cursor()
+    try:
+        if bucket == rollups.HOUR_OF_DAY:
+            points = rollups.load_hour_of_day(cursor, metric, date_from, date_to, empresa, id_fatura)
+        else:
+            points = [(ts.isoformat(), views) for ts, views in
+                      rollups.load_series(cursor, metric, bucket, date_from, date_to, empresa, id_fatura)]
+        return jsonify({
+            'metric': metric,
+            'bucket': bucket,
+            'timezone': config.ROLLUP_TIMEZONE,
+            'from': date_from.isoformat(),
+            'to': date_to.isoformat(),
+            'total': sum(views for _, views in points),
+            'points': [list(point) for point in points],
+            # Linhas anteriores aos rollups ainda não agregadas (python rollups.py backfill)
+            'backfill_pending': rollups.backfill_pending(cursor)
+        })
+    except psycopg2.Error as e:
+        print(f"Erro ao buscar série temporal: {e}")
+        return jsonify({'error': 'Erro ao buscar dados do banco'}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+@app.route('/api/funnel')
+def api_funnel():
+    """Taxas de abertura e clique e tempos até abertura e clique, por empresa ou campanha"""
+    by = request.args.get('by', 'empresa')
+    if by not in funnel.GROUP_BY:
+        return jsonify({'error': 'Parâmetro by deve ser empresa, campaign ou total'}), 400
+    
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'error': 'Erro ao conectar ao banco de dados'}), 500
+    
+    cursor = conn.cursor()
+    try:
+        return jsonify({
+            'by': by,
+            'groups': funnel.load_funnel(cursor, by, request.args.get('empresa'),
+                                         request.args.get('campaign'))
+        })
+    except psycopg2.Error as e:
+        print(f"Erro ao buscar funil: {e}")
+        return jsonify({'error': 'Erro ao buscar dados do banco'}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+@app.route('/api/funnel/<id_fatura>')
+def api_funnel_fatura(id_fatura):
+    """Estado do funil de uma fatura"""
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'error': 'Erro ao conectar ao banco de dados'}), 500
+    
+    cursor = conn.cursor()
+    try:
+        state = funnel.load_fatura(cursor, id_fatura)
+        if state is None:
+            return jsonify({'error': 'Fatura sem eventos nem envio registrado'}), 404
+        result = {'id_fatura': id_fatura}
+        for field, value in state._asdict().items():
+            result[field] = value.isoformat() if isinstance(value, datetime) else value
+        if state.sent_at and state.first_open and state.first_open >= state.sent_at:
+            result['time_to_open_s'] = (state.first_open - state.sent_at).total_seconds()
+        if state.first_open and state.first_click and state.first_click >= state.first_open:
+            result['time_to_click_s'] = (state.first_click - state.first_open).total_seconds()
+        return jsonify(result)
+    except psycopg2.Error as e:
+        print(f"Erro ao buscar funil da fatura: {e}")
+        return jsonify({'error': 'Erro ao buscar dados do banco'}), 500
     finally:
         cursor.close()
         conn.close()
 
 @app.route('/api/views/<id_fatura>')
 def api_fatura_views(id_fatura):
-    """API para obter visualizações de uma fatura específica"""
+    """API para obter visualizações de uma fatura específica (paginada)"""
+    try:
+        page = pagination.parse_page_args(request.args, config.API_PAGE_SIZE, config.API_MAX_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     conn = get_db_connection()
     if not conn:
         return jsonify({'error': 'Erro ao conectar ao banco de dados'}), 500
     
     cursor = conn.cursor()
     try:
+        conditions, params = pagination.keyset_filters(page)
         cursor.execute('''
-            SELECT timestamp, ip_address, user_agent, referer
+            SELECT timestamp, ip_address, user_agent, referer, id
             FROM image_views 
-            WHERE id_fatura = %s
-            ORDER BY timestamp DESC
-        ''', (id_fatura,))
+            WHERE id_fatura = %s {}
+            ORDER BY timestamp DESC, id DESC
+            LIMIT %s
+        '''.format(''.join(' AND ' + c for c in conditions)),
+            [id_fatura] + params + [page['limit'] + 1])
         
-        views = cursor.fetchall()
+        views, cursor_next = pagination.next_cursor(cursor.fetchall(), page['limit'], 0, 4)
         
         return jsonify({
             'id_fatura': id_fatura,
@@ -263,7 +814,8 @@ def api_fatura_views(id_fatura):
                 'ip_address': view[1],
                 'user_agent': view[2],
                 'referer': view[3]
-            } for view in views]
+            } for view in views],
+            'next_cursor': cursor_next
         })
     except psycopg2.Error as e:
         print(f"Erro ao buscar visualizações da fatura {id_fatura}: {e}")
@@ -272,6 +824,72 @@ def api_fatura_views(id_fatura):
         cursor.close()
         conn.close()
 
+def parse_batch_ids(payload, field='ids'):
+    """Lista de ids (sem repetição) do corpo JSON; levanta ValueError"""
+    ids = payload.get(field) if isinstance(payload, dict) else None
+    if not isinstance(ids, list) or not ids:
+        raise ValueError(f'Envie um JSON com a lista "{field}"')
+    if len(ids) > config.BATCH_LOOKUP_MAX_IDS:
+        raise ValueError(f'No máximo {config.BATCH_LOOKUP_MAX_IDS} ids por requisição')
+    if not all(isinstance(i, str) and i for i in ids):
+        raise ValueError(f'"{field}" deve conter apenas strings não vazias')
+    return list(dict.fromkeys(ids))
+
+def _iso(value):
+    return value.isoformat() if value else None
+
+@app.route('/api/views/batch', methods=['POST'])
+def api_views_batch():
+    """Aberturas e cliques de várias faturas em uma única chamada"""
+    try:
+        ids = parse_batch_ids(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'error': 'Erro ao conectar ao banco de dados'}), 500
+    
+    cursor = conn.cursor()
+    try:
+        # Aberturas vêm dos contadores; uma consulta para todos os ids
+        cursor.execute('''
+            SELECT id_fatura, views, first_view, last_view
+            FROM fatura_view_counters
+            WHERE id_fatura = ANY(%s)
+        ''', (ids,))
+        open_counts = {row[0]: row[1:] for row in cursor.fetchall()}
+        
+        cursor.execute('''
+            SELECT id_fatura, COUNT(*), MIN(timestamp), MAX(timestamp)
+            FROM boleto_views
+            WHERE id_fatura = ANY(%s)
+            GROUP BY id_fatura
+        ''', (ids,))
+        clicks = {row[0]: row[1:] for row in cursor.fetchall()}
+        
+        results = {}
+        for id_fatura in ids:
+            views, first_view, last_view = open_counts.get(id_fatura, (0, None, None))
+            n_clicks, first_click, last_click = clicks.get(id_fatura, (0, None, None))
+            results[id_fatura] = {
+                'opened': views > 0,
+                'opens': views,
+                'first_open': _iso(first_view),
+                'last_open': _iso(last_view),
+                'clicked': n_clicks > 0,
+                'clicks': n_clicks,
+                'first_click': _iso(first_click),
+                'last_click': _iso(last_click)
+            }
+        return jsonify({'results': results})
+    except psycopg2.Error as e:
+        print(f"Erro na consulta em lote de faturas: {e}")
+        return jsonify({'error': 'Erro ao buscar dados do banco'}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
 @app.route('/boleto')
 def redirect_boleto():
     """Redireciona para o boleto baseado na empresa e código"""
@@ -286,104 +904,91 @@ def redirect_boleto():
             'parametros_opcionais': ['id_fatura'],
             'exemplo': '/boleto?empresa=megalink&codigo=c42f66f6bc19678efa2a983f93170cb31ed23d0c6e1cefe03f72fe62cf5ea9b21f71e4e61850ef5c&id_fatura=FAT001'
         }), 400
+    error = invalid_identifier('codigo', codigo) or invalid_identifier('id_fatura', id_fatura)
+    if error:
+        return jsonify({'error': error}), 400
     
-    # Mapeamento das empresas para suas URLs base
-    empresas_urls = {
-        'megalink': 'https://api.megalinktelecom.hubsoft.com.br/pdf/fatura/',
-        'bjfibra': 'https://api.bjfibra.hubsoft.com.br/pdf/fatura/'
-    }
-    
-    # Verifica se a empresa é válida
-    if empresa not in empresas_urls:
+    # Verifica se a empresa é válida e constrói a URL completa do boleto
+    registry = empresa_registry.current()
+    url_boleto = registry.url(empresa, codigo)
+    if url_boleto is None:
         return jsonify({
             'error': 'Empresa inválida',
-            'empresas_validas': list(empresas_urls.keys())
+            'empresas_validas': list(registry.empresas)
         }), 400
     
-    # Constrói a URL completa do boleto
-    url_boleto = empresas_urls[empresa] + codigo
-    
     # Registra o acesso ao boleto na tabela específica
-    try:
-        conn = get_db_connection()
-        if conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO boleto_views (empresa, codigo_boleto, id_fatura, ip_address, user_agent, referer)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            ''', (
-                empresa,
-                codigo,
-                id_fatura if id_fatura else None,  # id_fatura é opcional
-                request.remote_addr,
-                request.headers.get('User-Agent', ''),
-                request.headers.get('Referer', '')
-            ))
-            conn.commit()
-            cursor.close()
-            conn.close()
-            print(f"Acesso ao boleto registrado: {empresa} - {codigo[:8]} - Fatura: {id_fatura or 'N/A'}")
-    except Exception as e:
-        print(f"Erro ao registrar acesso ao boleto: {e}")
+    log_boleto_view(empresa, codigo, id_fatura)
     
     # Redireciona para o boleto
     return redirect(url_boleto, code=302)
 
+@app.route('/b/<token>')
+def redirect_boleto_token(token):
+    """Redireciona para o boleto identificado por token assinado"""
+    if token_codec is None:
+        return jsonify({'error': 'Links com token desativados'}), 404
+    registry = empresa_registry.current()
+    try:
+        decoded = token_codec.decode(token)
+    except tokens.InvalidToken as e:
+        return jsonify({'error': str(e)}), 404
+    url_boleto = registry.url(decoded.empresa, decoded.codigo) if isinstance(decoded, tokens.BoletoToken) else None
+    if url_boleto is None or invalid_identifier('codigo', decoded.codigo) \
+            or invalid_identifier('id_fatura', decoded.id_fatura):
+        return jsonify({'error': 'Token inválido'}), 404
+    
+    log_boleto_view(decoded.empresa, decoded.codigo, decoded.id_fatura)
+    
+    return redirect(url_boleto, code=302)
+
 @app.route('/api/empresas')
 def api_empresas():
     """API para listar empresas disponíveis e suas URLs base"""
-    empresas_info = {
-        'megalink': {
-            'nome': 'Megalink Telecom',
-            'url_base': 'https://api.megalinktelecom.hubsoft.com.br/pdf/fatura/',
-            'exemplo': '/boleto?empresa=megalink&codigo=c42f66f6bc19678efa2a983f93170cb31ed23d0c6e1cefe03f72fe62cf5ea9b21f71e4e61850ef5c'
-        },
-        'bjfibra': {
-            'nome': 'BJ Fibra',
-            'url_base': 'https://api.bjfibra.hubsoft.com.br/pdf/fatura/',
-            'exemplo': '/boleto?empresa=bjfibra&codigo=c42f66f6bc19678efa2a983f93170cb31ed23d0c6e1cefe03f72fe62cf5ea9b21f71e4e61850ef5c'
-        }
-    }
-    
-    return jsonify({
-        'empresas': empresas_info,
-        'instrucoes': {
-            'rota': '/boleto',
-            'parametros_obrigatorios': ['empresa', 'codigo'],
-            'parametros_opcionais': ['id_fatura'],
-            'formato_url': '/boleto?empresa={empresa}&codigo={codigo_boleto}&id_fatura={id_fatura}',
-            'exemplo_uso': 'https://seudominio.com/boleto?empresa=megalink&codigo=c42f66f6bc19678efa2a983f93170cb31ed23d0c6e1cefe03f72fe62cf5ea9b21f71e4e61850ef5c&id_fatura=FAT001'
-        }
-    })
+    # Corpo serializado uma vez por versão do cadastro
+    return Response(empresa_registry.current().api_body, mimetype='application/json')
 
 @app.route('/api/boletos/<empresa>')
 def api_empresa_boletos(empresa):
-    """API para obter visualizações de boletos de uma empresa específica"""
+    """API para obter visualizações de boletos de uma empresa específica (paginada)"""
+    try:
+        page = pagination.parse_page_args(request.args, config.API_PAGE_SIZE, config.API_MAX_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     conn = get_db_connection()
     if not conn:
         return jsonify({'error': 'Erro ao conectar ao banco de dados'}), 500
     
     cursor = conn.cursor()
     try:
+        conditions, params = pagination.keyset_filters(page)
         cursor.execute('''
-            SELECT codigo_boleto, id_fatura, ip_address, timestamp, user_agent
+            SELECT codigo_boleto, id_fatura, ip_address, timestamp, user_agent, id
             FROM boleto_views 
-            WHERE empresa = %s
-            ORDER BY timestamp DESC
-        ''', (empresa,))
+            WHERE empresa = %s {}
+            ORDER BY timestamp DESC, id DESC
+            LIMIT %s
+        '''.format(''.join(' AND ' + c for c in conditions)),
+            [empresa] + params + [page['limit'] + 1])
         
-        boletos = cursor.fetchall()
+        boletos, cursor_next = pagination.next_cursor(cursor.fetchall(), page['limit'], 3, 5)
+        
+        # Total histórico da empresa, lido do contador
+        cursor.execute('SELECT views FROM empresa_boleto_counters WHERE empresa = %s', (empresa,))
+        row = cursor.fetchone()
         
         return jsonify({
             'empresa': empresa,
-            'total_boletos': len(boletos),
+            'total_boletos': row[0] if row else 0,
             'boletos': [{
                 'codigo_boleto': boleto[0],
                 'id_fatura': boleto[1],
                 'ip_address': boleto[2],
                 'timestamp': boleto[3].isoformat() if boleto[3] else None,
                 'user_agent': boleto[4]
-            } for boleto in boletos]
+            } for boleto in boletos],
+            'next_cursor': cursor_next
         })
     except psycopg2.Error as e:
         print(f"Erro ao buscar boletos da empresa {empresa}: {e}")
@@ -392,6 +997,92 @@ def api_empresa_boletos(empresa):
         cursor.close()
         conn.close()
 
+BATCH_BOLETO_KEYS = ('id_fatura', 'codigo_boleto')
+
+@app.route('/api/boletos/batch', methods=['POST'])
+def api_boletos_batch():
+    """Cliques em boletos de vários ids de fatura ou códigos em uma única chamada"""
+    payload = request.get_json(silent=True)
+    key = payload.get('by', 'id_fatura') if isinstance(payload, dict) else 'id_fatura'
+    if key not in BATCH_BOLETO_KEYS:
+        return jsonify({'error': 'Parâmetro by deve ser id_fatura ou codigo_boleto'}), 400
+    try:
+        ids = parse_batch_ids(payload)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'error': 'Erro ao conectar ao banco de dados'}), 500
+    
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            SELECT {key}, COUNT(*), MIN(timestamp), MAX(timestamp)
+            FROM boleto_views
+            WHERE {key} = ANY(%s)
+            GROUP BY {key}
+        '''.format(key=key), (ids,))
+        clicks = {row[0]: row[1:] for row in cursor.fetchall()}
+        
+        results = {}
+        for value in ids:
+            n_clicks, first_click, last_click = clicks.get(value, (0, None, None))
+            results[value] = {
+                'clicked': n_clicks > 0,
+                'clicks': n_clicks,
+                'first_click': _iso(first_click),
+                'last_click': _iso(last_click)
+            }
+        return jsonify({'by': key, 'results': results})
+    except psycopg2.Error as e:
+        print(f"Erro na consulta em lote de boletos: {e}")
+        return jsonify({'error': 'Erro ao buscar dados do banco'}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+@app.route('/api/export/<table>')
+def api_export(table):
+    """Exporta visualizações brutas em CSV ou NDJSON, em streaming"""
+    if table not in export.EXPORTS:
+        return jsonify({
+            'error': 'Exportação inválida',
+            'exportacoes_validas': sorted(export.EXPORTS)
+        }), 404
+    
+    fmt = request.args.get('format', 'csv').lower()
+    if fmt not in export.FORMATS:
+        return jsonify({'error': 'Parâmetro format deve ser csv ou ndjson'}), 400
+    
+    try:
+        date_from = request.args.get('from')
+        date_to = request.args.get('to')
+        date_from = pagination.parse_datetime(date_from, 'from') if date_from else None
+        date_to = pagination.parse_datetime(date_to, 'to') if date_to else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    use_gzip = request.args.get('gzip', '').lower() in ('1', 'true', 'sim')
+    filters = {column: request.args.get(column) for column in export.EXPORTS[table]['filters']}
+    
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'error': 'Erro ao conectar ao banco de dados'}), 500
+    
+    body = export.stream_export(conn, table, fmt, filters, date_from, date_to,
+                                itersize=config.EXPORT_ITERSIZE, gzip=use_gzip)
+    
+    filename = '%s_%s.%s%s' % (table, datetime.now().strftime('%Y%m%d%H%M%S'), fmt,
+                               '.gz' if use_gzip else '')
+    response = Response(body, mimetype=export.FORMATS[fmt])
+    response.headers['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    if use_gzip:
+        response.mimetype = 'application/gzip'
+    # Garante a devolução da conexão mesmo se o cliente desistir antes do início
+    response.call_on_close(conn.close)
+    return response
+
 if __name__ == "__main__":
     init_db()
     app.run(host=config.HOST, port=config.PORT, debug=config.DEBUG)
\ No newline at end of file
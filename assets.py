@@ -0,0 +1,84 @@
+# Registro em memória das imagens servidas pela rota de rastreamento
+
+import hashlib
+import mimetypes
+import os
+import struct
+import zlib
+from collections import namedtuple
+from datetime import datetime, timezone
+
+Asset = namedtuple('Asset', ['name', 'data', 'mimetype', 'etag', 'last_modified'])
+
+# GIF 1x1 transparente (43 bytes)
+PIXEL_GIF = (
+    b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff'
+    b'!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;'
+)
+
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def _transparent_png():
+    """PNG 1x1 RGBA totalmente transparente"""
+    header = struct.pack('>IIBBBBB', 1, 1, 8, 6, 0, 0, 0)
+    pixels = zlib.compress(b'\x00\x00\x00\x00\x00', 9)
+    return (b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', header)
+            + _png_chunk(b'IDAT', pixels) + _png_chunk(b'IEND', b''))
+
+
+PIXEL_PNG = _transparent_png()
+
+
+def make_asset(name, data, mimetype=None, last_modified=None):
+    """Monta um Asset com ETag forte (hash do conteúdo)"""
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if last_modified is None:
+        last_modified = datetime.now(timezone.utc)
+    etag = hashlib.sha256(data).hexdigest()[:32]
+    return Asset(name, data, mimetype, etag, last_modified.replace(microsecond=0))
+
+
+class AssetRegistry:
+    """Imagens permitidas, carregadas uma vez na inicialização.
+
+    Nenhuma requisição toca o sistema de arquivos: nomes fora do registro
+    simplesmente não existem.
+    """
+
+    def __init__(self):
+        self._assets = {}
+
+    def add(self, asset):
+        self._assets[asset.name] = asset
+
+    def load_file(self, path, name=None):
+        """Carrega um arquivo do disco para a memória"""
+        with open(path, 'rb') as f:
+            data = f.read()
+        mtime = datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)
+        self.add(make_asset(name or os.path.basename(path), data, last_modified=mtime))
+
+    def get(self, name):
+        return self._assets.get(name)
+
+    def names(self):
+        return sorted(self._assets)
+
+
+def load_registry(directory, filenames, pixel_names=('pixel.gif', 'pixel.png')):
+    """Cria o registro com as imagens configuradas e os pixels 1x1"""
+    registry = AssetRegistry()
+    for filename in filenames:
+        path = os.path.join(directory, filename)
+        try:
+            registry.load_file(path, filename)
+        except OSError as e:
+            print(f"Erro ao carregar imagem de rastreamento {filename}: {e}")
+    for name in pixel_names:
+        data = PIXEL_GIF if name.endswith('.gif') else PIXEL_PNG
+        registry.add(make_asset(name, data))
+    return registry
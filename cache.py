@@ -0,0 +1,137 @@
+# Cache de resultados com TTL, stale-while-revalidate e single-flight
+#
+# Usado pelas consultas de estatísticas (dashboard e /api/stats): enquanto o
+# valor está fresco ele é servido direto; depois de expirar, e até o fim da
+# janela "stale", o valor antigo é servido e recalculado em segundo plano.
+# Em qualquer momento, no máximo um recálculo por chave está em andamento.
+
+import threading
+import time
+
+
+class _Entry:
+    __slots__ = ('value', 'fresh_until', 'stale_until')
+
+    def __init__(self, value, fresh_until, stale_until):
+        self.value = value
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+
+
+class _Flight:
+    """Cálculo em andamento de uma chave; os demais chamadores aguardam"""
+
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResultCache:
+    """Cache em memória do processo, por chave, com TTL próprio por chave"""
+
+    def __init__(self, default_ttl=300, stale_ttl=0, enabled=True):
+        self.default_ttl = default_ttl
+        self.stale_ttl = stale_ttl
+        self.enabled = enabled
+        self._entries = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'stale_hits': 0,
+            'misses': 0,
+            'waits': 0,
+            'refreshes': 0,
+            'refresh_errors': 0,
+        }
+
+    def get(self, key, compute, ttl=None, stale_ttl=None):
+        """Retorna o valor da chave, calculando com ``compute()`` se preciso"""
+        if not self.enabled:
+            return compute()
+        ttl = self.default_ttl if ttl is None else ttl
+        stale_ttl = self.stale_ttl if stale_ttl is None else stale_ttl
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now < entry.fresh_until:
+                self._stats['hits'] += 1
+                return entry.value
+            if entry is not None and now < entry.stale_until:
+                self._stats['stale_hits'] += 1
+                if key not in self._inflight:
+                    flight = self._inflight[key] = _Flight()
+                    threading.Thread(target=self._refresh, args=(key, compute, ttl, stale_ttl, flight),
+                                     name='cache-refresh', daemon=True).start()
+                return entry.value
+
+            flight = self._inflight.get(key)
+            if flight is None:
+                self._stats['misses'] += 1
+                flight = self._inflight[key] = _Flight()
+                leader = True
+            else:
+                self._stats['waits'] += 1
+                leader = False
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            value = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            flight.value = value
+            self._store(key, value, ttl, stale_ttl)
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    def _store(self, key, value, ttl, stale_ttl):
+        now = time.monotonic()
+        with self._lock:
+            self._entries[key] = _Entry(value, now + ttl, now + ttl + stale_ttl)
+
+    def _refresh(self, key, compute, ttl, stale_ttl, flight):
+        try:
+            flight.value = compute()
+            self._store(key, flight.value, ttl, stale_ttl)
+            with self._lock:
+                self._stats['refreshes'] += 1
+        except Exception as e:
+            # Mantém o valor antigo até o fim da janela stale
+            print(f"Erro ao atualizar cache '{key}': {e}")
+            flight.error = e
+            with self._lock:
+                self._stats['refresh_errors'] += 1
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    def invalidate(self, key=None):
+        """Remove uma chave (ou todas)"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['keys'] = len(self._entries)
+        lookups = stats['hits'] + stats['stale_hits'] + stats['misses'] + stats['waits']
+        stats['hit_ratio'] = (stats['hits'] + stats['stale_hits']) / lookups if lookups else 0.0
+        return stats
@@ -23,15 +23,139 @@ class Config:
     # String de conexão PostgreSQL
     DATABASE_URL = f"postgresql://{DATABASE_CONFIG['USER']}:{DATABASE_CONFIG['PASSWORD']}@{DATABASE_CONFIG['HOST']}:{DATABASE_CONFIG['PORT']}/{DATABASE_CONFIG['NAME']}"
     
+    # Configurações do pool de conexões (ver db_pool.py)
+    DB_CONNECT_TIMEOUT = 5      # segundos para abrir uma conexão nova
+    DB_POOL_MIN_SIZE = 1        # conexões abertas na criação do pool
+    DB_POOL_MAX_SIZE = 10       # limite de conexões simultâneas por processo
+    DB_POOL_TIMEOUT = 5.0       # segundos aguardando uma conexão livre
+    DB_POOL_MAX_USES = 1000     # recicla a conexão após N empréstimos (0 = sem limite)
+    DB_POOL_MAX_AGE = 1800      # recicla a conexão após N segundos de vida (0 = sem limite)
+    DB_POOL_MAX_IDLE = 300      # fecha conexões ociosas há mais de N segundos (0 = sem limite)
+    DB_POOL_HEALTH_CHECK = True # executa SELECT 1 antes de emprestar a conexão
+    
+    # Modo de ingestão dos eventos de /image e /boleto:
+    # 'async' responde primeiro e entrega o evento ao spool/fila depois;
+    # 'sync' grava no banco antes de responder (apenas para depuração)
+    INGEST_MODE = 'async'
+    TRACKING_P99_TARGET_MS = 20       # meta de p99 dos endpoints de rastreamento
+    
+    # Configurações da ingestão write-behind (ver ingest.py)
+    INGEST_BATCH_SIZE = 500           # eventos por INSERT multi-linha
+    INGEST_FLUSH_INTERVAL_MS = 200    # intervalo máximo entre gravações
+    INGEST_QUEUE_SIZE = 50000         # eventos em memória antes de descartar
+    INGEST_RETRY_INTERVAL_MS = 1000   # espera após falha ao gravar um lote
+    INGEST_SHUTDOWN_TIMEOUT = 10      # segundos para esvaziar a fila ao encerrar
+    
+    # Configurações do spool em disco (ver spool.py)
+    # Com o spool ativo os eventos vão primeiro para o disco e são
+    # reprocessados com COPY; sem ele, usam a fila em memória acima.
+    SPOOL_ENABLED = True
+    SPOOL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spool')
+    SPOOL_SEGMENT_BYTES = 8 * 1024 * 1024  # tamanho máximo de um segmento
+    SPOOL_SEGMENT_MAX_AGE_MS = 1000        # sela o segmento ativo após N ms
+    SPOOL_FSYNC = 'interval'               # 'always', 'interval' ou 'never'
+    SPOOL_FSYNC_INTERVAL_MS = 1000         # intervalo de fsync na política 'interval'
+    SPOOL_REPLAY_INTERVAL_MS = 500         # intervalo entre drenagens
+    SPOOL_RETRY_INTERVAL_MS = 5000         # espera quando o banco está indisponível
+    
+    # Particionamento de image_views / boleto_views (ver partitions.py)
+    PARTITION_INTERVAL = 'month'   # 'month' ou 'day'
+    PARTITION_PREMAKE = 3          # partições futuras criadas com antecedência
+    PARTITION_RETENTION = 0        # intervalos mantidos além do atual (0 = manter tudo)
+    PARTITION_DROP_EXPIRED = True  # False apenas desanexa as partições expiradas
+    RECENT_VIEWS_WINDOW_DAYS = 31  # janela das "visualizações recentes" do dashboard
+    TOP_FATURAS = 100              # faturas mais vistas no dashboard e em /api/stats
+    
+    # Paginação de /api/views/<id_fatura> e /api/boletos/<empresa>
+    API_PAGE_SIZE = 100       # itens por página quando limit não é informado
+    API_MAX_PAGE_SIZE = 1000  # maior limit aceito
+    
+    # Consulta em lote (/api/views/batch e /api/boletos/batch)
+    BATCH_LOOKUP_MAX_IDS = 50000  # maior número de ids por requisição
+    
+    # Exportação em streaming (/api/export/<tabela>)
+    EXPORT_ITERSIZE = 10000   # linhas buscadas por vez no cursor do servidor
+    
+    # Cadastro das empresas de boleto (empresas.py); recarregado quando o
+    # arquivo muda, sem reiniciar a aplicação
+    EMPRESAS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'empresas.json')
+    EMPRESAS_RELOAD_INTERVAL = 5  # segundos entre verificações do arquivo; 0 desativa
+    
+    # Tokens assinados dos links /t/<token>.png e /b/<token> (tokens.py)
+    # Sem segredo configurado as rotas de token ficam desativadas
+    TRACKING_TOKEN_SECRET = os.environ.get('TRACKING_TOKEN_SECRET', '')
+    TRACKING_TOKEN_OLD_SECRETS = [s for s in os.environ.get('TRACKING_TOKEN_OLD_SECRETS', '').split(',') if s]
+    TRACKING_TOKEN_MAC_BYTES = 8  # bytes do HMAC-SHA256 mantidos no token
+    
+    # Gerador de URLs para mala direta (urlgen.py)
+    TRACKING_BASE_URL = os.environ.get('TRACKING_BASE_URL', 'http://localhost:5001')
+    URLGEN_WORKERS = 0         # processos; 0 = um por CPU
+    URLGEN_CHUNK_ROWS = 5000   # linhas por bloco enviado a cada processo
+    
+    # Renderização dos e-mails de campanha (emails.py)
+    EMAIL_TEMPLATE = 'email/fatura_boleto.html'  # relativo a templates/
+    EMAIL_TEMPLATE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.jinja_cache')
+    EMAIL_CHUNK_ROWS = 500     # e-mails por bloco enviado a cada processo
+    
+    # Faixas de IP de proxies de imagem e scanners/pré-busca (opens.py);
+    # linhas "CIDR proxy|prefetch". Vazio desativa a classificação por IP.
+    OPEN_CIDR_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'machine_opens.txt')
+    
+    # Janela de deduplicação das aberturas (dedup.py): a mesma fatura aberta
+    # pelo mesmo IP e User-Agent dentro da janela só incrementa os contadores
+    OPEN_DEDUP_WINDOW_S = 1800      # 0 desativa (toda abertura vira uma linha)
+    OPEN_DEDUP_MAX_KEYS = 200000    # chaves em memória por processo
+    
+    # Séries temporais pré-agregadas (rollups.py, /api/timeseries)
+    ROLLUP_TIMEZONE = 'America/Sao_Paulo'   # fuso dos buckets de minuto/hora/dia
+    # Fuso em que os timestamps dos eventos são gravados (sem fuso, com
+    # datetime.now()); None = fuso local do servidor, que pode diferir de
+    # ROLLUP_TIMEZONE (ex.: servidor em UTC)
+    EVENT_TIMEZONE = None
+    ROLLUP_MINUTE_RETENTION_DAYS = 14       # 0 mantém os buckets de minuto para sempre
+    ROLLUP_BACKFILL_CHUNK_ROWS = 20000      # linhas por transação em python rollups.py backfill
+    ROLLUP_MAX_POINTS = 5000                # buckets por resposta de /api/timeseries
+    ROLLUP_DEFAULT_SPAN_HOURS = {           # período padrão sem from/to, por bucket
+        'minute': 6,
+        'hour': 48,
+        'day': 90 * 24,
+        'hour_of_day': 30 * 24,
+    }
+    
+    # Base local de IP -> ASN e estado (geoip.py); linhas "CIDR ASN UF [nome]".
+    # Vazio desativa o enriquecimento (eventos gravados com ASN 0).
+    GEOIP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'ip_geo.tsv')
+    GEOIP_BACKFILL_CHUNK_ROWS = 10000  # linhas por transação em python geo.py backfill
+    GEO_API_ASN_LIMIT = 50             # provedores listados por /api/geo
+    GEO_API_MAX_ASN_LIMIT = 1000
+    
+    # Imagens de rastreamento servidas por /image/<filename>
+    # Carregadas em memória na inicialização; pixel.gif e pixel.png (1x1
+    # transparentes) estão sempre disponíveis.
+    TRACKING_IMAGES_DIR = os.path.dirname(os.path.abspath(__file__))
+    TRACKING_IMAGES = ['img1.png']
+    
     # Configurações de segurança
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
     
     # Configurações de logging
     LOG_LEVEL = 'INFO'
     
+    # Feed ao vivo do dashboard (/api/stream, ver live.py)
+    LIVE_ENABLED = True
+    LIVE_CHANNEL = 'tracking_events'  # canal LISTEN/NOTIFY do PostgreSQL
+    LIVE_CLIENT_QUEUE_SIZE = 256      # mensagens pendentes por dashboard
+    LIVE_HEARTBEAT_S = 15             # intervalo do keepalive SSE
+    LIVE_RECENT_EVENTS = 10           # eventos individuais publicados por lote
+    
     # Configurações de cache
-    CACHE_TYPE = 'simple'
+    CACHE_TYPE = 'simple'        # 'null' desativa o cache de estatísticas
     CACHE_DEFAULT_TIMEOUT = 300  # 5 minutos
+    CACHE_STALE_TIMEOUT = 60     # serve o valor expirado por até N s enquanto recalcula
+    CACHE_TTLS = {               # TTL por chave (segundos)
+        'dashboard': 10,
+        'api_stats': 10,
+    }
     
     # Configurações de rate limiting
     RATELIMIT_ENABLED = True
@@ -0,0 +1,280 @@
+# Contadores por fatura e por empresa mantidos incrementalmente na ingestão
+#
+# O dashboard e /api/stats leem estas tabelas em vez de agregar todo o
+# histórico de image_views / boleto_views a cada requisição. views conta
+# todas as aberturas; repeat_views, as repetidas dentro da janela de
+# deduplicação (dedup.py), que não viram linhas nas tabelas brutas.
+#
+# Uso: python counters.py rebuild   (recalcula tudo a partir das tabelas brutas)
+
+import sys
+
+import psycopg2
+import psycopg2.extras
+
+import ingest
+import opens
+
+UPSERT_FATURA = '''
+    INSERT INTO fatura_view_counters (id_fatura, views, first_view, last_view, proxy_views,
+                                      prefetch_views, repeat_views, changed_txid)
+    VALUES %s
+    ON CONFLICT (id_fatura) DO UPDATE SET
+        views = fatura_view_counters.views + EXCLUDED.views,
+        proxy_views = fatura_view_counters.proxy_views + EXCLUDED.proxy_views,
+        prefetch_views = fatura_view_counters.prefetch_views + EXCLUDED.prefetch_views,
+        repeat_views = fatura_view_counters.repeat_views + EXCLUDED.repeat_views,
+        first_view = LEAST(fatura_view_counters.first_view, EXCLUDED.first_view),
+        last_view = GREATEST(fatura_view_counters.last_view, EXCLUDED.last_view),
+        changed_txid = EXCLUDED.changed_txid
+    RETURNING (xmax = 0)
+'''
+# RETURNING (xmax = 0) é verdadeiro nas linhas inseridas (faturas novas),
+# somadas em view_totals.faturas
+
+UPSERT_EMPRESA = '''
+    INSERT INTO empresa_boleto_counters (empresa, views, first_view, last_view, proxy_views,
+                                         prefetch_views, changed_txid)
+    VALUES %s
+    ON CONFLICT (empresa) DO UPDATE SET
+        views = empresa_boleto_counters.views + EXCLUDED.views,
+        proxy_views = empresa_boleto_counters.proxy_views + EXCLUDED.proxy_views,
+        prefetch_views = empresa_boleto_counters.prefetch_views + EXCLUDED.prefetch_views,
+        first_view = LEAST(empresa_boleto_counters.first_view, EXCLUDED.first_view),
+        last_view = GREATEST(empresa_boleto_counters.last_view, EXCLUDED.last_view),
+        changed_txid = EXCLUDED.changed_txid
+'''
+
+UPSERT_TOTALS = '''
+    INSERT INTO view_totals (kind, views, proxy_views, prefetch_views, repeat_views, faturas)
+    VALUES %s
+    ON CONFLICT (kind) DO UPDATE SET
+        views = view_totals.views + EXCLUDED.views,
+        proxy_views = view_totals.proxy_views + EXCLUDED.proxy_views,
+        prefetch_views = view_totals.prefetch_views + EXCLUDED.prefetch_views,
+        repeat_views = view_totals.repeat_views + EXCLUDED.repeat_views,
+        faturas = view_totals.faturas + EXCLUDED.faturas
+'''
+
+# Cada linha alterada guarda o id da transação que a alterou
+# (txid_current()). Um cliente que leu os contadores quando o menor id de
+# transação ainda em andamento era W (o "cursor") só precisa das linhas com
+# changed_txid >= W: transações com id menor já estavam confirmadas e
+# visíveis na leitura anterior.
+COUNTER_TEMPLATE = '(%s, %s, %s, %s, %s, %s, txid_current())'
+FATURA_TEMPLATE = '(%s, %s, %s, %s, %s, %s, %s, txid_current())'
+
+WATERMARK_SQL = 'SELECT txid_snapshot_xmin(txid_current_snapshot())'
+
+# proxy_views, prefetch_views no recálculo a partir das tabelas brutas
+MACHINE_COUNTS = (
+    'COUNT(*) FILTER (WHERE open_class = {}) AS proxy_views, '
+    'COUNT(*) FILTER (WHERE open_class = {}) AS prefetch_views'
+    .format(opens.OPEN_PROXY, opens.OPEN_PREFETCH))
+
+
+def views_column(exclude=()):
+    """Expressão SQL das visualizações descontando as classes de
+    opens.parse_exclude (ex.: ('prefetch',) -> 'views - prefetch_views')"""
+    return ' - '.join(('views',) + tuple(f'{name}_views' for name in exclude))
+
+
+def aggregate(events, key):
+    """Agrupa eventos por chave: {chave: [views, first_view, last_view]}"""
+    groups = {}
+    for event in events:
+        k = key(event)
+        ts = event.timestamp
+        group = groups.get(k)
+        if group is None:
+            groups[k] = [1, ts, ts]
+        else:
+            group[0] += 1
+            if ts is not None:
+                if group[1] is None or ts < group[1]:
+                    group[1] = ts
+                if group[2] is None or ts > group[2]:
+                    group[2] = ts
+    # Ordena as chaves para que transações concorrentes travem as linhas na
+    # mesma ordem (evita deadlocks entre processos)
+    return [(k,) + tuple(v) for k, v in sorted(groups.items())]
+
+
+def class_counts(events, key, classes):
+    """Aberturas de máquina por chave: {chave: [proxy, prefetch]}, com as
+    classes já calculadas na gravação (ingest.open_classes)"""
+    counts = {}
+    for event in events:
+        open_class = classes[event]
+        if open_class == opens.OPEN_HUMAN:
+            continue
+        group = counts.setdefault(key(event), [0, 0])
+        group[0 if open_class == opens.OPEN_PROXY else 1] += 1
+    return counts
+
+
+def aggregate_counters(events, key, classes):
+    """Linhas (chave, views, first, last, proxy_views, prefetch_views)"""
+    machine = class_counts(events, key, classes)
+    return [row + tuple(machine.get(row[0], (0, 0))) for row in aggregate(events, key)]
+
+
+def repeat_counts(events):
+    """Aberturas repetidas por fatura: {id_fatura: repetições}"""
+    counts = {}
+    for event in events:
+        if isinstance(event, ingest.ImageRepeatEvent):
+            counts[event.id_fatura] = counts.get(event.id_fatura, 0) + 1
+    return counts
+
+
+def update_counters(cursor, events):
+    """Hook de ingestão: soma o lote aos contadores com um upsert por tabela"""
+    classes = ingest.open_classes(events)
+    image_events = [e for e in events if isinstance(e, ingest.IMAGE_EVENTS)]
+    boleto_events = [e for e in events if isinstance(e, ingest.BoletoViewEvent)]
+    repeats = repeat_counts(image_events)
+    new_faturas = 0
+
+    if image_events:
+        rows = [row + (repeats.get(row[0], 0),)
+                for row in aggregate_counters(image_events, lambda e: e.id_fatura, classes)]
+        inserted = psycopg2.extras.execute_values(cursor, UPSERT_FATURA, rows, template=FATURA_TEMPLATE,
+                                                  page_size=len(rows), fetch=True)
+        new_faturas = sum(1 for (new,) in inserted if new)
+    if isinstance(events, ingest.EventBatch):
+        # Lido pelo hook do feed ao vivo (live.py), registrado depois deste
+        events.new_faturas = new_faturas
+    if boleto_events:
+        rows = aggregate_counters(boleto_events, lambda e: e.empresa, classes)
+        psycopg2.extras.execute_values(cursor, UPSERT_EMPRESA, rows, template=COUNTER_TEMPLATE,
+                                       page_size=len(rows))
+
+    totals = []
+    for kind, kind_events, kind_repeats, kind_faturas in (
+            ('boleto', boleto_events, 0, 0),
+            ('image', image_events, sum(repeats.values()), new_faturas)):
+        if kind_events:
+            machine = class_counts(kind_events, lambda e: None, classes).get(None, (0, 0))
+            totals.append((kind, len(kind_events)) + tuple(machine) + (kind_repeats, kind_faturas))
+    if totals:
+        psycopg2.extras.execute_values(cursor, UPSERT_TOTALS, totals)
+
+
+def rebuild_counters(conn):
+    """Recalcula todos os contadores a partir de image_views / boleto_views.
+
+    As tabelas brutas ficam bloqueadas para escrita durante o recálculo, para
+    que nenhum lote seja contado duas vezes ou perdido. As aberturas
+    repetidas não têm linhas: repeat_views de cada fatura é preservado e
+    somado de volta a views (sem a classe proxy / prefetch delas).
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute('LOCK TABLE image_views, boleto_views IN SHARE MODE')
+        cursor.execute('''
+            CREATE TEMP TABLE saved_repeats ON COMMIT DROP AS
+            SELECT id_fatura, repeat_views FROM fatura_view_counters WHERE repeat_views > 0
+        ''')
+        cursor.execute('TRUNCATE fatura_view_counters, empresa_boleto_counters, view_totals')
+        cursor.execute('''
+            INSERT INTO fatura_view_counters (id_fatura, views, first_view, last_view, proxy_views,
+                                              prefetch_views, repeat_views, changed_txid)
+            SELECT v.id_fatura, v.views + COALESCE(r.repeat_views, 0), v.first_view, v.last_view,
+                   v.proxy_views, v.prefetch_views, COALESCE(r.repeat_views, 0), txid_current()
+            FROM (
+                SELECT id_fatura, COUNT(*) AS views, MIN(timestamp) AS first_view,
+                       MAX(timestamp) AS last_view, {machine}
+                FROM image_views
+                GROUP BY id_fatura
+            ) v
+            LEFT JOIN saved_repeats r ON r.id_fatura = v.id_fatura
+        '''.format(machine=MACHINE_COUNTS))
+        cursor.execute('''
+            INSERT INTO empresa_boleto_counters (empresa, views, first_view, last_view, proxy_views,
+                                                 prefetch_views, changed_txid)
+            SELECT empresa, COUNT(*), MIN(timestamp), MAX(timestamp), {machine}, txid_current()
+            FROM boleto_views
+            GROUP BY empresa
+        '''.format(machine=MACHINE_COUNTS))
+        cursor.execute('''
+            INSERT INTO view_totals (kind, views, proxy_views, prefetch_views, repeat_views, faturas)
+            SELECT 'image', SUM(views), SUM(proxy_views), SUM(prefetch_views), SUM(repeat_views), COUNT(*)
+            FROM fatura_view_counters
+            HAVING COUNT(*) > 0
+            UNION ALL
+            SELECT 'boleto', COUNT(*), {machine}, 0, 0 FROM boleto_views
+        '''.format(machine=MACHINE_COUNTS))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def current_watermark(cursor):
+    """Cursor de mudanças a entregar junto com uma leitura dos contadores.
+
+    Deve ser lido antes da consulta aos contadores: alterações confirmadas
+    entre as duas leituras apenas reaparecem na próxima chamada.
+    """
+    cursor.execute(WATERMARK_SQL)
+    return cursor.fetchone()[0]
+
+
+def encode_watermark(watermark):
+    return str(watermark)
+
+
+def decode_watermark(value):
+    """Levanta ValueError se o cursor for inválido"""
+    try:
+        watermark = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('Cursor inválido')
+    if watermark < 0:
+        raise ValueError('Cursor inválido')
+    return watermark
+
+
+def changed_since(cursor, since, exclude=()):
+    """Contadores alterados a partir do cursor ``since``.
+
+    Retorna (faturas, empresas) como listas de (chave, views) com o valor
+    atual, e nas faturas também as aberturas únicas; repetir uma linha já
+    entregue é inofensivo para o cliente.
+    """
+    views = views_column(exclude)
+    cursor.execute('''
+        SELECT id_fatura, {}, views - repeat_views
+        FROM fatura_view_counters
+        WHERE changed_txid >= %s
+    '''.format(views), (since,))
+    faturas = cursor.fetchall()
+    cursor.execute('''
+        SELECT empresa, {}
+        FROM empresa_boleto_counters
+        WHERE changed_txid >= %s
+    '''.format(views), (since,))
+    empresas = cursor.fetchall()
+    return faturas, empresas
+
+
+ingest.register_batch_hook(update_counters)
+
+
+if __name__ == '__main__':
+    from config import config
+    import db_pool
+
+    if len(sys.argv) != 2 or sys.argv[1] != 'rebuild':
+        print("Uso: python counters.py rebuild")
+        sys.exit(2)
+
+    conn = psycopg2.connect(**db_pool.connect_kwargs_from_config(config))
+    try:
+        rebuild_counters(conn)
+        print("Contadores recalculados com sucesso!")
+    finally:
+        conn.close()
@@ -0,0 +1,327 @@
+# Pool de conexões PostgreSQL compartilhado pelo processo
+
+import os
+import threading
+import time
+from collections import deque
+
+import psycopg2
+import psycopg2.extensions
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    """Nenhuma conexão ficou disponível dentro do tempo de espera"""
+
+
+class PooledConnection:
+    """Conexão emprestada do pool.
+
+    Repassa todos os atributos para a conexão psycopg2 original; ``close()``
+    devolve a conexão ao pool em vez de encerrar a sessão no servidor.
+    Como no psycopg2, ``with conn:`` faz commit ao sair sem erro e rollback
+    com erro; em seguida a conexão volta ao pool.
+    """
+
+    def __init__(self, pool, conn, created_at):
+        self._pool = pool
+        self._conn = conn
+        self._created_at = created_at
+        self._uses = 0
+        self._returned = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        # Atributos públicos (autocommit, isolation_level...) vão para a conexão
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._conn, name, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if not self._conn.closed:
+                if exc_type is None:
+                    self._conn.commit()
+                else:
+                    self._conn.rollback()
+        finally:
+            self.close()
+
+    @property
+    def raw(self):
+        """Conexão psycopg2 subjacente"""
+        return self._conn
+
+    def close(self):
+        """Devolve a conexão ao pool (pode ser chamado mais de uma vez)"""
+        if self._returned:
+            return
+        self._returned = True
+        self._pool.putconn(self)
+
+
+class ConnectionPool:
+    """Pool de conexões com limite mínimo/máximo, timeout de checkout,
+    verificação de saúde no empréstimo e reciclagem por uso/idade."""
+
+    def __init__(self, connect_kwargs, min_size=1, max_size=10, timeout=5.0,
+                 max_uses=0, max_age=0, max_idle=0, health_check=True):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Tamanhos de pool inválidos: min=%r max=%r" % (min_size, max_size))
+
+        self.connect_kwargs = dict(connect_kwargs)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.max_idle = max_idle
+        self.health_check = health_check
+
+        self._lock = threading.Condition()
+        self._idle = deque()  # (PooledConnection, instante em que ficou ociosa)
+        self._size = 0
+        self._closed = False
+        self._pid = os.getpid()
+
+        self._stats = {
+            'checkouts': 0,
+            'checkout_timeouts': 0,
+            'connections_created': 0,
+            'connections_closed': 0,
+            'connections_recycled': 0,
+            'health_check_failures': 0,
+            'connect_errors': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+        for _ in range(min_size):
+            self._size += 1
+            try:
+                self._idle.append((self._open(), time.monotonic()))
+            except psycopg2.Error as e:
+                print(f"Erro ao pré-abrir conexão do pool: {e}")
+                break
+
+    def _open(self):
+        """Abre uma conexão nova numa vaga já reservada em ``_size``"""
+        try:
+            conn = psycopg2.connect(**self.connect_kwargs)
+        except psycopg2.Error:
+            with self._lock:
+                self._size -= 1
+                self._stats['connect_errors'] += 1
+                self._lock.notify()
+            raise
+        with self._lock:
+            self._stats['connections_created'] += 1
+        return PooledConnection(self, conn, time.monotonic())
+
+    def _discard(self, pooled, recycled=False):
+        """Fecha definitivamente uma conexão e libera sua vaga"""
+        try:
+            pooled._conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._size -= 1
+            self._stats['connections_closed'] += 1
+            if recycled:
+                self._stats['connections_recycled'] += 1
+            self._lock.notify()
+
+    def _expired(self, pooled, idle_since=None):
+        now = time.monotonic()
+        if self.max_uses and pooled._uses >= self.max_uses:
+            return True
+        if self.max_age and now - pooled._created_at >= self.max_age:
+            return True
+        if self.max_idle and idle_since is not None and now - idle_since >= self.max_idle:
+            return True
+        return False
+
+    def _healthy(self, pooled):
+        conn = pooled._conn
+        if conn.closed:
+            return False
+        if not self.health_check:
+            return True
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute('SELECT 1')
+                cursor.fetchone()
+            finally:
+                cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _check_fork(self):
+        """Após um fork (gunicorn, multiprocessing) as conexões herdadas não
+        podem ser reutilizadas: o filho começa com um pool vazio."""
+        pid = os.getpid()
+        if pid != self._pid:
+            with self._lock:
+                if pid != self._pid:
+                    self._idle.clear()
+                    self._size = 0
+                    self._pid = pid
+
+    def getconn(self, timeout=None):
+        """Empresta uma conexão; levanta PoolTimeout se o pool estiver esgotado"""
+        self._check_fork()
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+
+        while True:
+            pooled = None
+            idle_since = None
+            must_open = False
+            with self._lock:
+                if self._closed:
+                    raise psycopg2.InterfaceError("Pool de conexões encerrado")
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['checkout_timeouts'] += 1
+                        raise PoolTimeout(
+                            "Tempo esgotado aguardando conexão do pool (%.1fs)" % timeout)
+                    self._lock.wait(remaining)
+                if self._idle:
+                    # LIFO: reutiliza a conexão mais "quente"
+                    pooled, idle_since = self._idle.pop()
+                else:
+                    # Reserva a vaga antes de conectar, fora do lock
+                    self._size += 1
+                    must_open = True
+
+            if must_open:
+                pooled = self._open()
+            elif self._expired(pooled, idle_since):
+                self._discard(pooled, recycled=True)
+                continue
+            elif not self._healthy(pooled):
+                with self._lock:
+                    self._stats['health_check_failures'] += 1
+                self._discard(pooled)
+                continue
+
+            waited = time.monotonic() - start
+            with self._lock:
+                self._stats['checkouts'] += 1
+                self._stats['wait_time_total'] += waited
+                if waited > self._stats['wait_time_max']:
+                    self._stats['wait_time_max'] = waited
+            pooled._uses += 1
+            pooled._returned = False
+            return pooled
+
+    def putconn(self, pooled):
+        """Devolve uma conexão ao pool, descartando-a se estiver inutilizável"""
+        if pooled._pool is not self:
+            raise ValueError("Conexão não pertence a este pool")
+        if os.getpid() != self._pid:
+            return
+
+        conn = pooled._conn
+        if conn.closed or self._closed:
+            self._discard(pooled)
+            return
+
+        # Nunca devolve uma transação aberta para o próximo usuário
+        try:
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                self._discard(pooled)
+                return
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            self._discard(pooled)
+            return
+
+        if self._expired(pooled):
+            self._discard(pooled, recycled=True)
+            return
+
+        with self._lock:
+            self._idle.append((pooled, time.monotonic()))
+            self._lock.notify()
+
+    def closeall(self):
+        """Encerra o pool e todas as conexões ociosas"""
+        with self._lock:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+        for pooled, _ in idle:
+            self._discard(pooled)
+
+    def stats(self):
+        """Retorna um retrato das métricas do pool"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+            })
+        checkouts = stats['checkouts']
+        stats['wait_time_avg'] = stats['wait_time_total'] / checkouts if checkouts else 0.0
+        return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def connect_kwargs_from_config(config):
+    """Monta os parâmetros de psycopg2.connect a partir de config.Config"""
+    db = config.DATABASE_CONFIG
+    return {
+        'host': db['HOST'],
+        'database': db['NAME'],
+        'user': db['USER'],
+        'password': db['PASSWORD'],
+        'port': db['PORT'],
+        'connect_timeout': getattr(config, 'DB_CONNECT_TIMEOUT', 5),
+    }
+
+
+def get_pool(config):
+    """Retorna o pool do processo, criando-o na primeira chamada"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    connect_kwargs_from_config(config),
+                    min_size=config.DB_POOL_MIN_SIZE,
+                    max_size=config.DB_POOL_MAX_SIZE,
+                    timeout=config.DB_POOL_TIMEOUT,
+                    max_uses=config.DB_POOL_MAX_USES,
+                    max_age=config.DB_POOL_MAX_AGE,
+                    max_idle=config.DB_POOL_MAX_IDLE,
+                    health_check=config.DB_POOL_HEALTH_CHECK,
+                )
+    return _pool
+
+
+def close_pool():
+    """Fecha o pool do processo (usado no encerramento)"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
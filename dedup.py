@@ -0,0 +1,78 @@
+# Janela de supressão de aberturas repetidas
+#
+# O mesmo leitor reabrindo o e-mail (ou o cliente buscando a imagem de novo a
+# cada rolagem) gera dezenas de linhas iguais por fatura. A janela guarda em
+# memória as chaves (id_fatura, IP, hash do User-Agent) vistas nos últimos
+# OPEN_DEDUP_WINDOW_S segundos: a primeira abertura vira uma linha em
+# image_views e as repetições só incrementam os contadores
+# (ingest.ImageRepeatEvent).
+#
+# As chaves ficam numa fila ordenada pelo momento da primeira abertura, então
+# expirar é retirar do início; com mais de max_keys chaves a mais antiga é
+# descartada antes do prazo (a próxima abertura dela volta a gravar uma
+# linha). A janela é por processo.
+
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+
+def open_key(id_fatura, ip_address, user_agent):
+    """Chave de deduplicação; o User-Agent entra só como CRC32"""
+    return id_fatura, ip_address, zlib.crc32((user_agent or '').encode('utf-8'))
+
+
+class DedupWindow:
+    """Conjunto de chaves com prazo fixo a partir da primeira ocorrência"""
+
+    def __init__(self, window_s, max_keys=100000):
+        self.window = window_s
+        self.max_keys = max_keys
+        self._entries = OrderedDict()  # chave -> primeira ocorrência (monotonic)
+        self._lock = threading.Lock()
+        self._stats = {'unique': 0, 'repeats': 0, 'expired': 0, 'evicted': 0}
+
+    @property
+    def enabled(self):
+        return self.window > 0 and self.max_keys > 0
+
+    def seen(self, key, now=None):
+        """True se a chave já ocorreu dentro da janela (repetição); senão a
+        registra e retorna False"""
+        if not self.enabled:
+            return False
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._expire(now)
+            if key in self._entries:
+                self._stats['repeats'] += 1
+                return True
+            self._entries[key] = now
+            self._stats['unique'] += 1
+            if len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+                self._stats['evicted'] += 1
+            return False
+
+    def _expire(self, now):
+        limit = now - self.window
+        entries = self._entries
+        while entries:
+            if next(iter(entries.values())) > limit:
+                break
+            entries.popitem(last=False)
+            self._stats['expired'] += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['keys'] = len(self._entries)
+        seen = stats['unique'] + stats['repeats']
+        stats['window_s'] = self.window
+        stats['max_keys'] = self.max_keys
+        stats['repeat_ratio'] = stats['repeats'] / seen if seen else 0.0
+        return stats
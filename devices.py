@@ -0,0 +1,157 @@
+# Estatísticas de dispositivos pré-agregadas por dia, empresa e User-Agent
+#
+# A cada lote ingerido, os eventos são somados em device_daily_stats por
+# (dia, tipo, empresa, cliente, sistema, dispositivo), com os códigos de
+# useragent.py. /api/devices e o dashboard leem só esta tabela, que tem
+# poucas linhas por dia, em vez de agrupar o User-Agent bruto.
+#
+# Uso: python devices.py rebuild   (recalcula tudo a partir das tabelas brutas)
+
+import sys
+
+import psycopg2
+import psycopg2.extras
+
+import ingest
+import useragent
+
+UPSERT_STATS = '''
+    INSERT INTO device_daily_stats (day, kind, empresa, ua_client, ua_os, ua_device, views)
+    VALUES %s
+    ON CONFLICT (day, kind, empresa, ua_client, ua_os, ua_device) DO UPDATE SET
+        views = device_daily_stats.views + EXCLUDED.views
+'''
+
+KINDS = ('image', 'boleto')
+BUCKETS = ('day', 'week', 'month')
+
+
+def _event_key(event):
+    if isinstance(event, ingest.ImageViewEvent):
+        kind, empresa = 'image', ''
+    else:
+        kind, empresa = 'boleto', event.empresa
+    return (event.timestamp.date(), kind, empresa) + useragent.classify(event.user_agent)
+
+
+def aggregate(events):
+    groups = {}
+    for event in events:
+        key = _event_key(event)
+        groups[key] = groups.get(key, 0) + 1
+    # Ordem fixa das chaves: evita deadlocks entre lotes concorrentes
+    return [key + (views,) for key, views in sorted(groups.items())]
+
+
+def update_device_stats(cursor, events):
+    """Hook de ingestão: soma o lote em device_daily_stats"""
+    rows = aggregate(e for e in ingest.stored_events(events) if e.timestamp is not None)
+    if rows:
+        psycopg2.extras.execute_values(cursor, UPSERT_STATS, rows, page_size=len(rows))
+
+
+def load_breakdown(cursor, kind=None, empresa=None, date_from=None, date_to=None, bucket='day'):
+    """Totais e série por período, quebrados por cliente, sistema e dispositivo"""
+    conditions = []
+    params = []
+    if kind:
+        conditions.append('kind = %s')
+        params.append(kind)
+    if empresa:
+        conditions.append('empresa = %s')
+        params.append(empresa)
+    if date_from is not None:
+        conditions.append('day >= %s')
+        params.append(date_from)
+    if date_to is not None:
+        conditions.append('day < %s')
+        params.append(date_to)
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    cursor.execute('''
+        SELECT date_trunc(%s, day)::date AS bucket, empresa, ua_client, ua_os, ua_device, SUM(views)
+        FROM device_daily_stats{}
+        GROUP BY 1, 2, 3, 4, 5
+        ORDER BY 1
+    '''.format(where), [bucket] + params)
+
+    totals = _new_breakdown()
+    series = {}
+    empresas = {}
+    for day, row_empresa, client, os_code, device, views in cursor.fetchall():
+        info = useragent.describe(useragent.UserAgentInfo(client, os_code, device))
+        _add(totals, info, views)
+        _add(series.setdefault(day, _new_breakdown()), info, views)
+        if row_empresa:
+            _add(empresas.setdefault(row_empresa, _new_breakdown()), info, views)
+    return {
+        'totals': totals,
+        'series': [dict(breakdown, bucket=day.isoformat()) for day, breakdown in series.items()],
+        'empresas': empresas,
+    }
+
+
+def _new_breakdown():
+    return {'views': 0, 'client': {}, 'os': {}, 'device': {}}
+
+
+def _add(breakdown, info, views):
+    views = int(views)
+    breakdown['views'] += views
+    for field in ('client', 'os', 'device'):
+        counts = breakdown[field]
+        counts[info[field]] = counts.get(info[field], 0) + views
+
+
+def rebuild_stats(conn, itersize=10000):
+    """Recalcula device_daily_stats a partir de image_views / boleto_views.
+
+    Os User-Agents brutos são agrupados no banco e classificados aqui; as
+    tabelas brutas ficam bloqueadas para escrita durante o recálculo.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute('LOCK TABLE image_views, boleto_views IN SHARE MODE')
+        cursor.execute('TRUNCATE device_daily_stats')
+        groups = {}
+        source = conn.cursor(name='device_stats_rebuild')
+        source.itersize = itersize
+        source.execute('''
+            SELECT timestamp::date, 'image', '', user_agent, COUNT(*)
+            FROM image_views
+            GROUP BY 1, 4
+            UNION ALL
+            SELECT timestamp::date, 'boleto', empresa, user_agent, COUNT(*)
+            FROM boleto_views
+            GROUP BY 1, 3, 4
+        ''')
+        for day, kind, empresa, ua, views in source:
+            key = (day, kind, empresa) + useragent.classify(ua)
+            groups[key] = groups.get(key, 0) + views
+        source.close()
+        rows = [key + (views,) for key, views in sorted(groups.items())]
+        psycopg2.extras.execute_values(cursor, UPSERT_STATS, rows, page_size=1000)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+ingest.register_batch_hook(update_device_stats)
+
+
+if __name__ == '__main__':
+    from config import config
+    import db_pool
+
+    if len(sys.argv) != 2 or sys.argv[1] != 'rebuild':
+        print("Uso: python devices.py rebuild")
+        sys.exit(2)
+
+    conn = psycopg2.connect(**db_pool.connect_kwargs_from_config(config))
+    try:
+        rebuild_stats(conn)
+        print("Estatísticas de dispositivos recalculadas com sucesso!")
+    finally:
+        conn.close()
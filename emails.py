@@ -0,0 +1,246 @@
+# Renderização em lote dos e-mails de fatura para campanhas
+#
+# O template (templates/email/fatura_boleto.html, derivado de
+# exemplo_email_boleto.html) é compilado uma vez e guardado no cache de
+# bytecode do Jinja; cada processo do pool carrega o bytecode em vez de
+# recompilar. As faturas chegam em fluxo (CSV ou NDJSON com empresa, codigo,
+# id_fatura e colunas livres como nome, valor e vencimento) e cada uma vira
+# um HTML com as URLs de rastreamento já montadas (ver urlgen.py).
+#
+# Uso: python emails.py --input faturas.csv --output campanha.zip [--tokens]
+#      (saída .zip, .tar, .tar.gz/.tgz ou um diretório)
+
+import argparse
+import csv
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import sys
+import tarfile
+import time
+import zipfile
+
+import jinja2
+
+import empresas
+import tokens
+import urlgen
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+_UNSAFE_NAME = re.compile(r'[^A-Za-z0-9._-]')
+
+
+def make_environment(template_dir, cache_dir):
+    """Ambiente Jinja com cache de bytecode em disco"""
+    os.makedirs(cache_dir, exist_ok=True)
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(template_dir),
+        autoescape=jinja2.select_autoescape(['html']),
+        bytecode_cache=jinja2.FileSystemBytecodeCache(cache_dir),
+        auto_reload=False,
+    )
+
+
+def file_name(record, line):
+    """Nome do arquivo da fatura; a linha da entrada evita colisões sem id"""
+    id_fatura = _UNSAFE_NAME.sub('_', record.get('id_fatura') or '')
+    return '%s.html' % (id_fatura or 'linha-%d' % line)
+
+
+def candidate_names(name, line):
+    """Nomes a tentar, em ordem, para a fatura: o próprio nome e, se já foi
+    usado (id repetido na entrada ou ids diferentes que viram o mesmo nome),
+    o nome com a linha da entrada e depois com um contador"""
+    stem = name[:-len('.html')]
+    yield name
+    yield '%s-linha-%d.html' % (stem, line)
+    for n in itertools.count(2):
+        yield '%s-linha-%d-%d.html' % (stem, line, n)
+
+
+def read_csv_records(stream):
+    for record in csv.DictReader(stream):
+        yield {(k or '').strip().lower(): (v or '').strip() for k, v in record.items()}
+
+
+def read_records(stream, input_format):
+    """Registros (dict) da entrada; NDJSON é decodificado nos processos"""
+    if input_format == 'ndjson':
+        return urlgen.read_ndjson_lines(stream)
+    return read_csv_records(stream)
+
+
+# Estado de cada processo de trabalho (definido por _init_worker)
+_worker = {}
+
+
+def _init_worker(template_dir, template_name, cache_dir, builder, input_format, output_dir):
+    env = make_environment(template_dir, cache_dir)
+    _worker['template'] = env.get_template(template_name)
+    _worker['builder'] = builder
+    _worker['input_format'] = input_format
+    _worker['output_dir'] = output_dir
+
+
+def render_chunk(first_line, items):
+    """Renderiza um bloco; retorna (arquivos, quantidade, erros).
+
+    Com saída em diretório os arquivos são gravados pelo próprio processo e a
+    lista volta vazia; um nome já existente recebe a linha da entrada. Para
+    arquivos compactados volta [(nome, linha, bytes)].
+    """
+    template = _worker['template']
+    builder = _worker['builder']
+    output_dir = _worker['output_dir']
+    files = []
+    errors = []
+    rendered = 0
+    for n, record in enumerate(items, first_line):
+        try:
+            if _worker['input_format'] == 'ndjson':
+                record = {k: '' if v is None else str(v) for k, v in json.loads(record).items()}
+            id_fatura, empresa, codigo, pixel_url, boleto_url = builder.build(
+                record.get('empresa'), record.get('codigo'), record.get('id_fatura'))
+        except (ValueError, AttributeError) as e:
+            errors.append((n, str(e)))
+            continue
+        context = dict(record, id_fatura=id_fatura, empresa=empresa, codigo=codigo,
+                       pixel_url=pixel_url, boleto_url=boleto_url)
+        data = template.render(context).encode('utf-8')
+        name = file_name(record, n)
+        if output_dir is not None:
+            for candidate in candidate_names(name, n):
+                try:
+                    f = open(os.path.join(output_dir, candidate), 'xb')
+                    break
+                except FileExistsError:
+                    continue
+            with f:
+                f.write(data)
+        else:
+            files.append((name, n, data))
+        rendered += 1
+    return files, rendered, errors
+
+
+class ZipOutput:
+    def __init__(self, path):
+        self._zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+
+    def write(self, name, data):
+        self._zip.writestr(name, data)
+
+    def close(self):
+        self._zip.close()
+
+
+class TarOutput:
+    def __init__(self, path):
+        mode = 'w:gz' if path.endswith(('.tar.gz', '.tgz')) else 'w'
+        self._tar = tarfile.open(path, mode)
+        self._mtime = time.time()
+
+    def write(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = self._mtime
+        self._tar.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self._tar.close()
+
+
+def open_output(path):
+    """Arquivo compactado pela extensão; None para saída em diretório"""
+    if path.endswith('.zip'):
+        return ZipOutput(path)
+    if path.endswith(('.tar', '.tar.gz', '.tgz')):
+        return TarOutput(path)
+    os.makedirs(path, exist_ok=True)
+    # Arquivos de outra execução seriam tomados por faturas repetidas
+    if os.listdir(path):
+        raise ValueError(f'Diretório de saída não está vazio: {path}')
+    return None
+
+
+def render_campaign(input_stream, output_path, builder, template_name, template_dir=TEMPLATES_DIR,
+                    cache_dir=None, input_format='csv', workers=None, chunk_rows=500, progress=None):
+    """Renderiza todos os e-mails da entrada; retorna {'rows', 'errors', 'seconds', 'rows_per_s'}"""
+    cache_dir = cache_dir or os.path.join(template_dir, '.jinja_cache')
+    # Compila uma vez no processo principal: os processos do pool só leem o
+    # bytecode (e um template inexistente falha antes de abrir o pool)
+    make_environment(template_dir, cache_dir).get_template(template_name)
+
+    archive = open_output(output_path)
+    output_dir = output_path if archive is None else None
+    workers = workers or multiprocessing.cpu_count()
+
+    stats = {'rows': 0, 'errors': 0}
+    seen = set()
+    started = time.perf_counter()
+    try:
+        results = urlgen.map_chunks(
+            render_chunk, urlgen.chunked(read_records(input_stream, input_format), chunk_rows), workers,
+            _init_worker, (template_dir, template_name, cache_dir, builder, input_format, output_dir))
+        for files, rendered, errors in results:
+            for name, line, data in files:
+                name = next(c for c in candidate_names(name, line) if c not in seen)
+                seen.add(name)
+                archive.write(name, data)
+            urlgen.report_errors(errors, stats)
+            stats['rows'] += rendered
+            if progress:
+                progress(stats['rows'], time.perf_counter() - started)
+    finally:
+        if archive is not None:
+            archive.close()
+
+    seconds = time.perf_counter() - started
+    stats['seconds'] = seconds
+    stats['rows_per_s'] = stats['rows'] / seconds if seconds > 0 else 0.0
+    return stats
+
+
+def main(argv=None):
+    from config import config
+
+    parser = argparse.ArgumentParser(description='Renderiza os e-mails de fatura de uma campanha')
+    parser.add_argument('--input', default='-', help='arquivo de entrada (padrão: stdin)')
+    parser.add_argument('--output', required=True, help='.zip, .tar, .tar.gz ou diretório')
+    parser.add_argument('--format', choices=('csv', 'ndjson'), default='csv', help='formato da entrada')
+    parser.add_argument('--template', default=config.EMAIL_TEMPLATE)
+    parser.add_argument('--base-url', default=config.TRACKING_BASE_URL)
+    parser.add_argument('--image', default='img1.png', help='imagem do pixel')
+    parser.add_argument('--tokens', action='store_true', help='usa links /t/ e /b/ com token assinado')
+    parser.add_argument('--workers', type=int, default=config.URLGEN_WORKERS or None)
+    parser.add_argument('--chunk-rows', type=int, default=config.EMAIL_CHUNK_ROWS)
+    args = parser.parse_args(argv)
+
+    registry = empresas.load_file(config.EMPRESAS_FILE)
+    codec = tokens.codec_from_config(config, registry.token_ids) if args.tokens else None
+    builder = urlgen.UrlBuilder(args.base_url, codec, args.image, registry.empresas)
+
+    input_stream = sys.stdin if args.input == '-' else open(args.input, newline='', encoding='utf-8')
+    try:
+        stats = render_campaign(input_stream, args.output, builder, args.template,
+                                cache_dir=config.EMAIL_TEMPLATE_CACHE_DIR, input_format=args.format,
+                                workers=args.workers, chunk_rows=args.chunk_rows,
+                                progress=urlgen.Progress())
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    finally:
+        if input_stream is not sys.stdin:
+            input_stream.close()
+
+    print(f"{stats['rows']} e-mails renderizados em {stats['seconds']:.1f}s "
+          f"({stats['rows_per_s']:.0f} e-mails/s), {stats['errors']} linhas com erro", file=sys.stderr)
+    return 1 if stats['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
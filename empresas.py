@@ -0,0 +1,148 @@
+# Cadastro das empresas (tenants hubsoft) dos links de boleto
+#
+# As empresas ficam em empresas.json (EMPRESAS_FILE) e são carregadas num
+# snapshot imutável: /boleto, /b/<token>, /api/empresas e as validações leem
+# sempre o snapshot atual, sem montar dicionários por requisição. Quando o
+# arquivo muda (mtime verificado no máximo a cada EMPRESAS_RELOAD_INTERVAL
+# segundos) um novo snapshot é carregado e trocado de uma vez; um arquivo
+# inválido é ignorado e o snapshot anterior continua valendo.
+#
+# Formato:
+#   {"megalink": {"nome": "Megalink Telecom",
+#                 "url_base": "https://.../pdf/fatura/",
+#                 "token_id": 1}}
+# token_id é o código da empresa nos tokens assinados (1 a 255): nunca
+# reaproveite nem altere um código já usado.
+
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+Empresa = namedtuple('Empresa', ['slug', 'nome', 'url_base', 'token_id'])
+
+EXEMPLO_CODIGO = 'c42f66f6bc19678efa2a983f93170cb31ed23d0c6e1cefe03f72fe62cf5ea9b21f71e4e61850ef5c'
+
+
+class Snapshot:
+    """Empresas carregadas de uma versão do arquivo (somente leitura)"""
+
+    __slots__ = ('empresas', 'token_ids', 'api_body', 'mtime')
+
+    def __init__(self, empresas, mtime=None):
+        self.empresas = MappingProxyType(dict(empresas))
+        self.token_ids = MappingProxyType({e.slug: e.token_id for e in empresas.values()})
+        self.api_body = _api_body(self.empresas)
+        self.mtime = mtime
+
+    def get(self, slug):
+        return self.empresas.get(slug)
+
+    def url(self, slug, codigo):
+        """URL do boleto; None se a empresa não existe"""
+        empresa = self.empresas.get(slug)
+        return empresa.url_base + codigo if empresa is not None else None
+
+    def __contains__(self, slug):
+        return slug in self.empresas
+
+
+def parse(data):
+    """Valida o conteúdo do arquivo; levanta ValueError"""
+    if not isinstance(data, dict) or not data:
+        raise ValueError('O arquivo de empresas deve ser um objeto com ao menos uma empresa')
+    empresas = {}
+    token_ids = set()
+    for slug, info in data.items():
+        if not isinstance(info, dict) or slug != slug.lower() or not slug:
+            raise ValueError(f'Empresa inválida: {slug!r}')
+        url_base = info.get('url_base')
+        if not isinstance(url_base, str) or not url_base.startswith(('http://', 'https://')):
+            raise ValueError(f'url_base inválida para {slug}')
+        token_id = info.get('token_id')
+        if not isinstance(token_id, int) or not 1 <= token_id <= 255:
+            raise ValueError(f'token_id de {slug} deve ser um inteiro entre 1 e 255')
+        if token_id in token_ids:
+            raise ValueError(f'token_id {token_id} repetido ({slug})')
+        token_ids.add(token_id)
+        empresas[slug] = Empresa(slug, info.get('nome', slug), url_base, token_id)
+    return empresas
+
+
+def load_file(path):
+    """Snapshot do arquivo; levanta OSError ou ValueError"""
+    mtime = os.stat(path).st_mtime
+    with open(path, encoding='utf-8') as f:
+        return Snapshot(parse(json.load(f)), mtime)
+
+
+def _api_body(empresas):
+    """Corpo de /api/empresas, serializado uma vez por snapshot"""
+    return json.dumps({
+        'empresas': {
+            e.slug: {
+                'nome': e.nome,
+                'url_base': e.url_base,
+                'exemplo': f'/boleto?empresa={e.slug}&codigo={EXEMPLO_CODIGO}'
+            } for e in empresas.values()
+        },
+        'instrucoes': {
+            'rota': '/boleto',
+            'parametros_obrigatorios': ['empresa', 'codigo'],
+            'parametros_opcionais': ['id_fatura'],
+            'formato_url': '/boleto?empresa={empresa}&codigo={codigo_boleto}&id_fatura={id_fatura}',
+            'exemplo_uso': f'https://seudominio.com/boleto?empresa=megalink&codigo={EXEMPLO_CODIGO}&id_fatura=FAT001'
+        }
+    }, ensure_ascii=False, indent=2).encode('utf-8')
+
+
+class EmpresaRegistry:
+    """Snapshot atual das empresas, recarregado quando o arquivo muda"""
+
+    def __init__(self, path, reload_interval=5.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._snapshot = load_file(path)
+        self._next_check = time.monotonic() + reload_interval
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def on_reload(self, callback):
+        """callback(snapshot) é chamado após cada recarga"""
+        self._listeners.append(callback)
+
+    def current(self):
+        if self.reload_interval and time.monotonic() >= self._next_check:
+            self._check()
+        return self._snapshot
+
+    def _check(self):
+        # Só um thread verifica; os demais seguem com o snapshot atual
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = time.monotonic() + self.reload_interval
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError as e:
+                print(f"Erro ao verificar {self.path}: {e}")
+                return
+            if mtime != self._snapshot.mtime:
+                self.reload()
+        finally:
+            self._lock.release()
+
+    def reload(self):
+        """Carrega o arquivo e troca o snapshot; retorna True se trocou"""
+        try:
+            snapshot = load_file(self.path)
+        except (OSError, ValueError) as e:
+            print(f"Erro ao recarregar empresas de {self.path}: {e}")
+            return False
+        self._snapshot = snapshot
+        print(f"Empresas recarregadas: {', '.join(snapshot.empresas)}")
+        for callback in self._listeners:
+            callback(snapshot)
+        return True
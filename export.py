@@ -0,0 +1,119 @@
+# Exportação em streaming das visualizações brutas (CSV / NDJSON, gzip opcional)
+#
+# As linhas são lidas com um cursor nomeado (server-side) em blocos de
+# ``itersize`` e escritas em pedaços, então a memória usada não depende do
+# número de linhas exportadas.
+
+import csv
+import io
+import itertools
+import json
+import zlib
+
+EXPORTS = {
+    'image_views': {
+        'columns': ['id', 'id_fatura', 'ip_address', 'user_agent', 'referer', 'timestamp'],
+        'filters': ['id_fatura'],
+    },
+    'boleto_views': {
+        'columns': ['id', 'empresa', 'codigo_boleto', 'id_fatura', 'ip_address', 'user_agent',
+                    'referer', 'timestamp'],
+        'filters': ['empresa', 'id_fatura'],
+    },
+}
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def build_query(table, filters, date_from=None, date_to=None):
+    """Monta a consulta de exportação; filters é {coluna: valor}"""
+    spec = EXPORTS[table]
+    conditions = []
+    params = []
+    for column in spec['filters']:
+        if filters.get(column):
+            conditions.append('%s = %%s' % column)
+            params.append(filters[column])
+    if date_from is not None:
+        conditions.append('timestamp >= %s')
+        params.append(date_from)
+    if date_to is not None:
+        conditions.append('timestamp < %s')
+        params.append(date_to)
+    query = 'SELECT %s FROM %s' % (', '.join(spec['columns']), table)
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    # Sem ORDER BY: evita ordenar milhões de linhas no servidor antes de
+    # entregar a primeira; as partições são lidas em sequência de tempo
+    return query, params
+
+
+def iter_rows(conn, query, params, itersize=10000, name='export_cursor'):
+    """Itera as linhas por um cursor nomeado e devolve a conexão ao final"""
+    try:
+        cursor = conn.cursor(name=name)
+        cursor.itersize = itersize
+        try:
+            cursor.execute(query, params)
+            for row in cursor:
+                yield row
+        finally:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+    finally:
+        conn.close()
+
+
+def _value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def csv_chunks(columns, rows, chunk_rows=1000):
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+    writer.writerow(columns)
+    yield buf.getvalue().encode('utf-8')
+    while True:
+        batch = list(itertools.islice(rows, chunk_rows))
+        if not batch:
+            return
+        buf.seek(0)
+        buf.truncate()
+        writer.writerows([_value(v) for v in row] for row in batch)
+        yield buf.getvalue().encode('utf-8')
+
+
+def ndjson_chunks(columns, rows, chunk_rows=1000):
+    while True:
+        batch = list(itertools.islice(rows, chunk_rows))
+        if not batch:
+            return
+        yield ''.join(
+            json.dumps(dict(zip(columns, (_value(v) for v in row))), ensure_ascii=False) + '\n'
+            for row in batch
+        ).encode('utf-8')
+
+
+def gzip_chunks(chunks, level=6):
+    """Comprime um fluxo de bytes em formato gzip, pedaço por pedaço"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_export(conn, table, fmt, filters, date_from=None, date_to=None,
+                  itersize=10000, gzip=False):
+    """Gerador de bytes com a exportação completa da tabela"""
+    columns = EXPORTS[table]['columns']
+    query, params = build_query(table, filters, date_from, date_to)
+    rows = iter_rows(conn, query, params, itersize)
+    chunks = csv_chunks(columns, rows) if fmt == 'csv' else ndjson_chunks(columns, rows)
+    return gzip_chunks(chunks) if gzip else chunks
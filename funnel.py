@@ -0,0 +1,410 @@
+# Funil abertura -> clique por fatura, mantido incrementalmente na ingestão
+#
+# fatura_funnel guarda o estado de cada fatura (empresa, campanha, envio,
+# primeira abertura da imagem, primeiro clique no boleto). A cada lote, as
+# faturas tocadas são travadas, o estado novo é calculado e a diferença entre
+# a contribuição antiga e a nova de cada fatura é somada em:
+#
+# - funnel_stats: faturas, enviadas, abertas, clicadas e abertas+clicadas
+#   por (empresa, campanha)
+# - funnel_ttc: histograma do tempo entre a primeira abertura e o primeiro
+#   clique, em faixas de potência de 2 segundos, por (empresa, campanha)
+# - funnel_tto: o mesmo para o tempo entre o envio e a primeira abertura
+#
+# As taxas e percentis de /api/funnel leem só estas tabelas, sem juntar
+# image_views, boleto_views e sends. Empresa, campanha e envio vêm do
+# primeiro envio da fatura no registro de envios (sends.py); sem ele a
+# empresa vem do primeiro clique no boleto. Cliques sem id_fatura entram pelo
+# codigo_boleto registrado no envio; sem envio não entram no funil.
+#
+# Uso: python funnel.py rebuild   (recalcula tudo a partir das tabelas brutas)
+
+import sys
+from collections import namedtuple
+
+import psycopg2
+import psycopg2.extras
+
+import ingest
+
+# Histogramas de tempo: abertura -> clique e envio -> abertura
+TIME_TO_CLICK = 'funnel_ttc'
+TIME_TO_OPEN = 'funnel_tto'
+HISTOGRAMS = (TIME_TO_CLICK, TIME_TO_OPEN)
+
+INSERT_NEW = '''
+    INSERT INTO fatura_funnel (id_fatura) VALUES %s
+    ON CONFLICT (id_fatura) DO NOTHING
+    RETURNING id_fatura
+'''
+
+SELECT_STATES = '''
+    SELECT id_fatura, empresa, campaign, sent_at, first_open, first_click
+    FROM fatura_funnel
+    WHERE id_fatura = ANY(%s)
+    ORDER BY id_fatura
+    FOR UPDATE
+'''
+
+UPDATE_STATES = '''
+    UPDATE fatura_funnel f SET
+        empresa = v.empresa, campaign = v.campaign, sent_at = v.sent_at,
+        first_open = v.first_open, first_click = v.first_click
+    FROM (VALUES %s) AS v (id_fatura, empresa, campaign, sent_at, first_open, first_click)
+    WHERE f.id_fatura = v.id_fatura
+'''
+UPDATE_TEMPLATE = '(%s, %s, %s, %s::timestamp, %s::timestamp, %s::timestamp)'
+
+UPSERT_STATS = '''
+    INSERT INTO funnel_stats (empresa, campaign, faturas, sent, opened, clicked, opened_clicked)
+    VALUES %s
+    ON CONFLICT (empresa, campaign) DO UPDATE SET
+        faturas = funnel_stats.faturas + EXCLUDED.faturas,
+        sent = funnel_stats.sent + EXCLUDED.sent,
+        opened = funnel_stats.opened + EXCLUDED.opened,
+        clicked = funnel_stats.clicked + EXCLUDED.clicked,
+        opened_clicked = funnel_stats.opened_clicked + EXCLUDED.opened_clicked
+'''
+
+UPSERT_HISTOGRAM = '''
+    INSERT INTO {table} (empresa, campaign, bucket, faturas)
+    VALUES %s
+    ON CONFLICT (empresa, campaign, bucket) DO UPDATE SET
+        faturas = {table}.faturas + EXCLUDED.faturas
+'''
+
+# Fatura de cliques sem id_fatura, pelo boleto do primeiro envio
+SELECT_BOLETO_FATURAS = '''
+    SELECT DISTINCT ON (codigo_boleto) codigo_boleto, id_fatura
+    FROM sends
+    WHERE codigo_boleto = ANY(%s)
+    ORDER BY codigo_boleto, sent_at
+'''
+
+# Faixa b do histograma: [2^b, 2^(b+1)) segundos (a faixa 0 inclui < 1s);
+# a última acumula tudo acima de 2^23 s (~97 dias)
+TTC_BUCKETS = 24
+
+PERCENTILES = (50, 90, 99)
+
+GROUP_BY = {
+    'empresa': 'empresa',
+    'campaign': 'campaign',
+    'total': "''::text",
+}
+
+FunnelState = namedtuple('FunnelState', ['empresa', 'campaign', 'sent_at', 'first_open', 'first_click'])
+
+EMPTY = FunnelState(None, None, None, None, None)
+
+
+def time_bucket(seconds):
+    if seconds < 1:
+        return 0
+    return min(int(seconds).bit_length() - 1, TTC_BUCKETS - 1)
+
+
+def _min(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+def merge(state, update):
+    """Estado novo de uma fatura a partir das mudanças de um lote.
+
+    ``update`` pode ter first_open / first_click (vale o menor), empresa
+    (preenche se ainda vazia) e send = (empresa, campanha, enviado_em); a
+    fatura é atribuída ao envio mais antigo, cuja empresa prevalece. Reenvios
+    em campanhas posteriores não contam para elas (ver README).
+    """
+    empresa = state.empresa or update.get('empresa')
+    campaign = state.campaign
+    sent_at = state.sent_at
+    send = update.get('send')
+    if send is not None and (sent_at is None or send[2] < sent_at):
+        empresa = send[0] or empresa
+        campaign = send[1]
+        sent_at = send[2]
+    return FunnelState(empresa, campaign, sent_at,
+                       _min(state.first_open, update.get('first_open')),
+                       _min(state.first_click, update.get('first_click')))
+
+
+def _add_time(histograms, table, key, start, end, sign):
+    # Evento anterior ao início (clique antes da imagem carregar, com imagens
+    # bloqueadas; relógios diferentes no envio) não entra no histograma
+    if start is None or end is None or end < start:
+        return
+    bucket_key = (table,) + key + (time_bucket((end - start).total_seconds()),)
+    histograms[bucket_key] = histograms.get(bucket_key, 0) + sign
+
+
+def contribute(state, sign, stats, histograms):
+    """Soma (sign=1) ou retira (sign=-1) a contribuição da fatura aos
+    contadores e histogramas do funil"""
+    key = (state.empresa or '', state.campaign or '')
+    counts = stats.setdefault(key, [0, 0, 0, 0, 0])
+    opened = state.first_open is not None
+    clicked = state.first_click is not None
+    counts[0] += sign
+    counts[1] += sign if state.sent_at is not None else 0
+    counts[2] += sign if opened else 0
+    counts[3] += sign if clicked else 0
+    counts[4] += sign if opened and clicked else 0
+    _add_time(histograms, TIME_TO_CLICK, key, state.first_open, state.first_click, sign)
+    _add_time(histograms, TIME_TO_OPEN, key, state.sent_at, state.first_open, sign)
+
+
+def write_deltas(cursor, stats, histograms):
+    # Ordem fixa das chaves: evita deadlocks entre lotes concorrentes
+    rows = [key + tuple(counts) for key, counts in sorted(stats.items()) if any(counts)]
+    if rows:
+        psycopg2.extras.execute_values(cursor, UPSERT_STATS, rows, page_size=len(rows))
+    for table in HISTOGRAMS:
+        rows = [key[1:] + (n,) for key, n in sorted(histograms.items()) if n and key[0] == table]
+        if rows:
+            psycopg2.extras.execute_values(cursor, UPSERT_HISTOGRAM.format(table=table), rows,
+                                           page_size=len(rows))
+
+
+def apply_updates(cursor, updates):
+    """Aplica {id_fatura: update} (ver merge) ao estado e aos contadores"""
+    if not updates:
+        return
+    ids = sorted(updates)
+    # Cria antes as faturas novas, para que o FOR UPDATE abaixo serialize
+    # também os lotes concorrentes que as veem pela primeira vez
+    inserted = {row[0] for row in psycopg2.extras.execute_values(
+        cursor, INSERT_NEW, [(i,) for i in ids], page_size=len(ids), fetch=True)}
+    cursor.execute(SELECT_STATES, (ids,))
+
+    stats = {}
+    histograms = {}
+    rows = []
+    for row in cursor.fetchall():
+        id_fatura = row[0]
+        old = FunnelState(*row[1:])
+        new = merge(old, updates[id_fatura])
+        if id_fatura in inserted:
+            contribute(new, 1, stats, histograms)
+        elif new != old:
+            contribute(old, -1, stats, histograms)
+            contribute(new, 1, stats, histograms)
+        else:
+            continue
+        rows.append((id_fatura,) + tuple(new))
+
+    if rows:
+        psycopg2.extras.execute_values(cursor, UPDATE_STATES, rows, template=UPDATE_TEMPLATE,
+                                       page_size=len(rows))
+    write_deltas(cursor, stats, histograms)
+
+
+def update_funnel(cursor, events):
+    """Hook de ingestão: primeira abertura e primeiro clique das faturas do lote"""
+    events = [e for e in events if e.timestamp is not None]
+    codigos = sorted({e.codigo_boleto for e in events
+                      if isinstance(e, ingest.BoletoViewEvent) and not e.id_fatura and e.codigo_boleto})
+    by_boleto = {}
+    if codigos:
+        cursor.execute(SELECT_BOLETO_FATURAS, (codigos,))
+        by_boleto = dict(cursor.fetchall())
+
+    updates = {}
+    for event in events:
+        id_fatura = event.id_fatura
+        if not id_fatura and isinstance(event, ingest.BoletoViewEvent):
+            id_fatura = by_boleto.get(event.codigo_boleto)
+        if not id_fatura:
+            continue
+        update = updates.setdefault(id_fatura, {})
+        if isinstance(event, ingest.BoletoViewEvent):
+            update['first_click'] = _min(update.get('first_click'), event.timestamp)
+            update.setdefault('empresa', event.empresa)
+        else:
+            update['first_open'] = _min(update.get('first_open'), event.timestamp)
+    apply_updates(cursor, updates)
+
+
+def register_sends(cursor, sends):
+    """Atribui ao funil envios [(id_fatura, empresa, campanha, enviado_em)]"""
+    updates = {}
+    for id_fatura, empresa, campaign, sent_at in sends:
+        update = updates.setdefault(id_fatura, {})
+        previous = update.get('send')
+        if previous is None or sent_at < previous[2]:
+            update['send'] = (empresa, campaign, sent_at)
+    apply_updates(cursor, updates)
+
+
+def percentiles(histogram, wanted=PERCENTILES):
+    """Percentis (limite superior da faixa, em segundos) de {faixa: faturas}"""
+    total = sum(histogram.values())
+    if not total:
+        return {f'p{p}': None for p in wanted}
+    result = {}
+    for p in wanted:
+        target = total * p / 100.0
+        seen = 0
+        for bucket in sorted(histogram):
+            seen += histogram[bucket]
+            if seen >= target:
+                result[f'p{p}'] = 2 ** (bucket + 1)
+                break
+    return result
+
+
+def _rate(part, whole):
+    return round(part / whole, 4) if whole else None
+
+
+def _time_percentiles(histogram):
+    return dict(percentiles(histogram), samples=sum(histogram.values()))
+
+
+def load_funnel(cursor, by='empresa', empresa=None, campaign=None):
+    """Conversão e tempos até abertura e clique agrupados por empresa,
+    campanha ou total"""
+    key = GROUP_BY[by]
+    conditions = []
+    params = []
+    if empresa is not None:
+        conditions.append('empresa = %s')
+        params.append(empresa)
+    if campaign is not None:
+        conditions.append('campaign = %s')
+        params.append(campaign)
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+    cursor.execute('''
+        SELECT {0}, SUM(faturas), SUM(sent), SUM(opened), SUM(clicked), SUM(opened_clicked)
+        FROM funnel_stats{1}
+        GROUP BY 1
+        HAVING SUM(faturas) > 0
+        ORDER BY 2 DESC
+    '''.format(key, where), params)
+    groups = cursor.fetchall()
+    histograms = {}
+    for table in HISTOGRAMS:
+        cursor.execute('''
+            SELECT {0}, bucket, SUM(faturas)
+            FROM {1}{2}
+            GROUP BY 1, 2
+            HAVING SUM(faturas) > 0
+        '''.format(key, table, where), params)
+        for group, bucket, n in cursor.fetchall():
+            histograms.setdefault((table, group), {})[bucket] = int(n)
+
+    result = []
+    for group, faturas, sent, opened, clicked, opened_clicked in groups:
+        faturas, sent, opened, clicked, opened_clicked = (
+            int(faturas), int(sent), int(opened), int(clicked), int(opened_clicked))
+        item = {
+            'faturas': faturas,
+            'sent': sent,
+            'opened': opened,
+            'clicked': clicked,
+            'opened_clicked': opened_clicked,
+            # Com envios registrados as taxas são sobre os enviados; senão
+            # sobre as faturas vistas pelo rastreamento
+            'open_rate': _rate(opened, sent or faturas),
+            'click_rate': _rate(clicked, sent or faturas),
+            'click_to_open_rate': _rate(opened_clicked, opened),
+            'time_to_open_s': _time_percentiles(histograms.get((TIME_TO_OPEN, group), {})),
+            'time_to_click_s': _time_percentiles(histograms.get((TIME_TO_CLICK, group), {})),
+        }
+        if by != 'total':
+            item[by] = group
+        result.append(item)
+    return result
+
+
+def load_fatura(cursor, id_fatura):
+    cursor.execute('''
+        SELECT empresa, campaign, sent_at, first_open, first_click
+        FROM fatura_funnel
+        WHERE id_fatura = %s
+    ''', (id_fatura,))
+    row = cursor.fetchone()
+    return FunnelState(*row) if row else None
+
+
+def rebuild_funnel(conn, itersize=10000):
+    """Recalcula o estado das faturas a partir de sends, image_views e
+    boleto_views e refaz funnel_stats e os histogramas.
+
+    As tabelas de origem ficam bloqueadas para escrita durante o recálculo.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute('LOCK TABLE sends, image_views, boleto_views IN SHARE MODE')
+        cursor.execute('TRUNCATE fatura_funnel, funnel_stats, {}'.format(', '.join(HISTOGRAMS)))
+        cursor.execute('''
+            INSERT INTO fatura_funnel (id_fatura, empresa, campaign, sent_at)
+            SELECT DISTINCT ON (id_fatura) id_fatura, empresa, campaign, sent_at
+            FROM sends
+            ORDER BY id_fatura, sent_at
+        ''')
+        cursor.execute('''
+            INSERT INTO fatura_funnel (id_fatura, first_open)
+            SELECT id_fatura, MIN(timestamp) FROM image_views GROUP BY id_fatura
+            ON CONFLICT (id_fatura) DO UPDATE SET first_open = EXCLUDED.first_open
+        ''')
+        # Cliques sem id_fatura entram pelo boleto do primeiro envio
+        cursor.execute('''
+            WITH boleto_faturas AS (
+                SELECT DISTINCT ON (codigo_boleto) codigo_boleto, id_fatura
+                FROM sends
+                WHERE codigo_boleto IS NOT NULL
+                ORDER BY codigo_boleto, sent_at
+            )
+            INSERT INTO fatura_funnel (id_fatura, empresa, first_click)
+            SELECT COALESCE(NULLIF(b.id_fatura, ''), s.id_fatura),
+                   (array_agg(b.empresa ORDER BY b.timestamp))[1], MIN(b.timestamp)
+            FROM boleto_views b
+            LEFT JOIN boleto_faturas s ON s.codigo_boleto = b.codigo_boleto
+                                      AND (b.id_fatura IS NULL OR b.id_fatura = '')
+            WHERE COALESCE(NULLIF(b.id_fatura, ''), s.id_fatura) IS NOT NULL
+            GROUP BY 1
+            ON CONFLICT (id_fatura) DO UPDATE SET
+                first_click = EXCLUDED.first_click,
+                empresa = COALESCE(fatura_funnel.empresa, EXCLUDED.empresa)
+        ''')
+
+        stats = {}
+        histograms = {}
+        source = conn.cursor(name='funnel_rebuild')
+        source.itersize = itersize
+        source.execute('SELECT empresa, campaign, sent_at, first_open, first_click FROM fatura_funnel')
+        for row in source:
+            contribute(FunnelState(*row), 1, stats, histograms)
+        source.close()
+        write_deltas(cursor, stats, histograms)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+ingest.register_batch_hook(update_funnel)
+
+
+if __name__ == '__main__':
+    from config import config
+    import db_pool
+
+    if len(sys.argv) != 2 or sys.argv[1] != 'rebuild':
+        print("Uso: python funnel.py rebuild")
+        sys.exit(2)
+
+    conn = psycopg2.connect(**db_pool.connect_kwargs_from_config(config))
+    try:
+        rebuild_funnel(conn)
+        print("Funil recalculado com sucesso!")
+    finally:
+        conn.close()
@@ -0,0 +1,192 @@
+# Estatísticas de provedor (ASN) e estado pré-agregadas por dia e empresa
+#
+# A cada lote ingerido, os eventos são somados em geo_daily_stats por
+# (dia, tipo, empresa, ASN, estado), com os códigos de geoip.py. /api/geo lê
+# só esta tabela em vez de agrupar os IPs brutos.
+#
+# Uso: python geo.py backfill [--all]   (resolve os eventos gravados sem ASN
+#                                        e recalcula as estatísticas)
+#      python geo.py rebuild            (só recalcula as estatísticas)
+
+import argparse
+import sys
+
+import psycopg2
+import psycopg2.extras
+
+import geoip
+import ingest
+
+UPSERT_STATS = '''
+    INSERT INTO geo_daily_stats (day, kind, empresa, asn, region, views)
+    VALUES %s
+    ON CONFLICT (day, kind, empresa, asn, region) DO UPDATE SET
+        views = geo_daily_stats.views + EXCLUDED.views
+'''
+
+KINDS = ('image', 'boleto')
+TABLES = {'image': 'image_views', 'boleto': 'boleto_views'}
+
+
+def aggregate(events):
+    events = [e for e in ingest.stored_events(events) if e.timestamp is not None]
+    groups = {}
+    for event, location in zip(events, geoip.resolve_many([e.ip_address for e in events])):
+        if isinstance(event, ingest.ImageViewEvent):
+            key = (event.timestamp.date(), 'image', '') + location
+        else:
+            key = (event.timestamp.date(), 'boleto', event.empresa) + location
+        groups[key] = groups.get(key, 0) + 1
+    # Ordem fixa das chaves: evita deadlocks entre lotes concorrentes
+    return [key + (views,) for key, views in sorted(groups.items())]
+
+
+def update_geo_stats(cursor, events):
+    """Hook de ingestão: soma o lote em geo_daily_stats"""
+    rows = aggregate(events)
+    if rows:
+        psycopg2.extras.execute_values(cursor, UPSERT_STATS, rows, page_size=len(rows))
+
+
+def load_breakdown(cursor, kind=None, empresa=None, date_from=None, date_to=None, limit=50):
+    """Totais por estado e pelos ``limit`` provedores (ASN) com mais eventos"""
+    conditions = []
+    params = []
+    if kind:
+        conditions.append('kind = %s')
+        params.append(kind)
+    if empresa:
+        conditions.append('empresa = %s')
+        params.append(empresa)
+    if date_from is not None:
+        conditions.append('day >= %s')
+        params.append(date_from)
+    if date_to is not None:
+        conditions.append('day < %s')
+        params.append(date_to)
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    cursor.execute('''
+        SELECT asn, region, SUM(views)
+        FROM geo_daily_stats{}
+        GROUP BY 1, 2
+    '''.format(where), params)
+
+    total = 0
+    regions = {}
+    asns = {}
+    for asn, region, views in cursor.fetchall():
+        views = int(views)
+        total += views
+        regions[region] = regions.get(region, 0) + views
+        by_asn = asns.setdefault(asn, {'views': 0, 'regions': {}})
+        by_asn['views'] += views
+        by_asn['regions'][geoip.region_name(region)] = views
+    top_asns = sorted(asns.items(), key=lambda item: (-item[1]['views'], item[0]))[:limit]
+    return {
+        'views': total,
+        'regions': [{'region': geoip.region_name(code), 'views': views}
+                    for code, views in sorted(regions.items(), key=lambda item: (-item[1], item[0]))],
+        'asns': [dict(stats, asn=asn, name=geoip.asn_name(asn)) for asn, stats in top_asns],
+    }
+
+
+def backfill(conn, reprocess=False, chunk_rows=10000):
+    """Resolve ASN e estado dos eventos já gravados, em blocos por id.
+
+    Sem ``reprocess`` só as linhas com asn nulo (gravadas antes do
+    enriquecimento) são atualizadas; com ``reprocess`` todas, depois de
+    trocar a base. Cada bloco é uma transação curta. Retorna as linhas
+    atualizadas por tabela.
+    """
+    updated = {}
+    cursor = conn.cursor()
+    try:
+        for table in TABLES.values():
+            updated[table] = 0
+            last_id = 0
+            while True:
+                cursor.execute('''
+                    SELECT id, timestamp, ip_address
+                    FROM {}
+                    WHERE id > %s{}
+                    ORDER BY id
+                    LIMIT %s
+                '''.format(table, '' if reprocess else ' AND asn IS NULL'), (last_id, chunk_rows))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                locations = geoip.resolve_many([row[2] for row in rows])
+                values = [(row[0], row[1]) + location for row, location in zip(rows, locations)]
+                psycopg2.extras.execute_values(cursor, '''
+                    UPDATE {0} SET asn = v.asn, region = v.region
+                    FROM (VALUES %s) AS v (id, timestamp, asn, region)
+                    WHERE {0}.id = v.id AND {0}.timestamp = v.timestamp
+                '''.format(table), values, template='(%s, %s::timestamp, %s, %s::smallint)',
+                    page_size=len(values))
+                conn.commit()
+                updated[table] += len(rows)
+                last_id = rows[-1][0]
+                print(f"{table}: {updated[table]} linhas resolvidas")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return updated
+
+
+def rebuild_stats(conn):
+    """Recalcula geo_daily_stats a partir das colunas asn / region.
+
+    Linhas ainda sem ASN (ver backfill) contam como desconhecidas; as
+    tabelas brutas ficam bloqueadas para escrita durante o recálculo.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute('LOCK TABLE image_views, boleto_views IN SHARE MODE')
+        cursor.execute('TRUNCATE geo_daily_stats')
+        cursor.execute('''
+            INSERT INTO geo_daily_stats (day, kind, empresa, asn, region, views)
+            SELECT timestamp::date, 'image', '', COALESCE(asn, 0), COALESCE(region, 0), COUNT(*)
+            FROM image_views
+            WHERE timestamp IS NOT NULL
+            GROUP BY 1, 4, 5
+            UNION ALL
+            SELECT timestamp::date, 'boleto', empresa, COALESCE(asn, 0), COALESCE(region, 0), COUNT(*)
+            FROM boleto_views
+            WHERE timestamp IS NOT NULL
+            GROUP BY 1, 3, 4, 5
+        ''')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+ingest.register_batch_hook(update_geo_stats)
+
+
+if __name__ == '__main__':
+    from config import config
+    import db_pool
+
+    parser = argparse.ArgumentParser(description='Enriquecimento de IP (ASN e estado) dos eventos gravados')
+    parser.add_argument('command', choices=('backfill', 'rebuild'))
+    parser.add_argument('--all', action='store_true', help='reprocessa também as linhas já resolvidas')
+    parser.add_argument('--chunk-rows', type=int, default=config.GEOIP_BACKFILL_CHUNK_ROWS)
+    args = parser.parse_args()
+
+    if not geoip.load_from_config(config):
+        print("Base de IPs vazia ou não encontrada (GEOIP_FILE)")
+        sys.exit(1)
+
+    conn = psycopg2.connect(**db_pool.connect_kwargs_from_config(config))
+    try:
+        if args.command == 'backfill':
+            backfill(conn, args.all, args.chunk_rows)
+        rebuild_stats(conn)
+        print("Estatísticas de provedor e estado recalculadas com sucesso!")
+    finally:
+        conn.close()
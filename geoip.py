@@ -0,0 +1,121 @@
+# Enriquecimento offline dos IPs: sistema autônomo (ASN/provedor) e estado
+#
+# A base é um arquivo local de faixas (GEOIP_FILE, ver data/ip_geo.tsv)
+# carregado em ipranges.RangeIndex; cada evento é resolvido na ingestão, em
+# lote, e o ASN e o código da UF são gravados em image_views / boleto_views
+# (colunas asn e region). Nenhuma consulta externa é feita.
+#
+# Os estados usam o código IBGE da UF (gravado no banco como SMALLINT).
+#
+# Uso: python geoip.py 177.37.0.1 200.137.1.1 ...   (ou uma lista em stdin)
+
+import sys
+import time
+
+import ipranges
+
+REGION_UNKNOWN = 0
+REGION_EXTERIOR = 99
+
+REGIONS = {
+    REGION_UNKNOWN: 'desconhecido',
+    11: 'RO', 12: 'AC', 13: 'AM', 14: 'RR', 15: 'PA', 16: 'AP', 17: 'TO',
+    21: 'MA', 22: 'PI', 23: 'CE', 24: 'RN', 25: 'PB', 26: 'PE', 27: 'AL', 28: 'SE', 29: 'BA',
+    31: 'MG', 32: 'ES', 33: 'RJ', 35: 'SP',
+    41: 'PR', 42: 'SC', 43: 'RS',
+    50: 'MS', 51: 'MT', 52: 'GO', 53: 'DF',
+    REGION_EXTERIOR: 'exterior',
+}
+REGION_CODES = {name: code for code, name in REGIONS.items()}
+
+ASN_UNKNOWN = 0
+
+# (asn, região) de um IP fora da base
+UNKNOWN = (ASN_UNKNOWN, REGION_UNKNOWN)
+
+_index = ipranges.RangeIndex()
+_asn_names = {}
+
+
+def read_file(path):
+    """Entradas (cidr, (asn, região)) e nomes {asn: nome} de um arquivo
+    "CIDR ASN UF [nome do AS]"; levanta ValueError com a linha inválida"""
+    entries = []
+    names = {}
+    with open(path, encoding='utf-8') as f:
+        for n, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            parts = line.split(None, 3)
+            if len(parts) < 3:
+                raise ValueError(f'{path}:{n}: esperado "CIDR ASN UF [nome]"')
+            network, asn, region = parts[:3]
+            try:
+                asn = int(asn[2:] if asn.upper().startswith('AS') else asn)
+            except ValueError:
+                raise ValueError(f'{path}:{n}: ASN inválido: {parts[1]}')
+            if region not in REGION_CODES:
+                raise ValueError(f'{path}:{n}: UF inválida: {region}')
+            entries.append((network, (asn, REGION_CODES[region])))
+            if len(parts) > 3:
+                names[asn] = parts[3].strip()
+    return entries, names
+
+
+def load(path):
+    """Carrega a base de faixas; retorna o número de trechos"""
+    global _index, _asn_names
+    entries, names = read_file(path)
+    try:
+        index = ipranges.RangeIndex(entries)
+    except ValueError as e:
+        raise ValueError(f'{path}: {e}')
+    _index, _asn_names = index, names
+    return len(index)
+
+
+def load_from_config(config):
+    if not config.GEOIP_FILE:
+        return 0
+    try:
+        return load(config.GEOIP_FILE)
+    except (OSError, ValueError) as e:
+        print(f"Erro ao carregar a base de IPs de {config.GEOIP_FILE}: {e}")
+        return 0
+
+
+def resolve(ip_address):
+    """(asn, região) do IP; UNKNOWN fora da base"""
+    return _index.lookup(ip_address, UNKNOWN)
+
+
+def resolve_many(ip_addresses):
+    """(asn, região) de cada IP, na mesma ordem (busca em lote)"""
+    return _index.lookup_many(ip_addresses, UNKNOWN)
+
+
+def asn_name(asn):
+    return _asn_names.get(asn, '')
+
+
+def region_name(code):
+    return REGIONS.get(code, 'desconhecido')
+
+
+def loaded():
+    return len(_index)
+
+
+if __name__ == '__main__':
+    from config import config
+
+    load(config.GEOIP_FILE)
+    ips = sys.argv[1:] or [line.strip() for line in sys.stdin if line.strip()]
+    started = time.perf_counter()
+    results = resolve_many(ips)
+    seconds = time.perf_counter() - started
+    for ip, (asn, region) in zip(ips, results):
+        print(f"{ip}\tAS{asn}\t{region_name(region)}\t{asn_name(asn)}")
+    if seconds > 0:
+        print(f"{len(ips)} IPs em {seconds:.3f}s ({len(ips) / seconds:.0f} consultas/s)", file=sys.stderr)
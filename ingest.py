@@ -0,0 +1,440 @@
+# Ingestão write-behind dos eventos de rastreamento (image_views / boleto_views)
+
+import io
+import os
+import queue
+import threading
+import time
+from collections import deque, namedtuple
+
+import psycopg2
+import psycopg2.extras
+
+import geoip
+import opens
+import useragent
+
+
+# Eventos capturados no momento da requisição
+ImageViewEvent = namedtuple('ImageViewEvent', [
+    'id_fatura', 'ip_address', 'user_agent', 'referer', 'timestamp',
+])
+
+BoletoViewEvent = namedtuple('BoletoViewEvent', [
+    'empresa', 'codigo_boleto', 'id_fatura', 'ip_address', 'user_agent', 'referer', 'timestamp',
+])
+
+# Abertura repetida dentro da janela de deduplicação (dedup.py): soma nos
+# contadores, mas não vira linha em image_views
+ImageRepeatEvent = namedtuple('ImageRepeatEvent', ImageViewEvent._fields)
+
+IMAGE_EVENTS = (ImageViewEvent, ImageRepeatEvent)
+
+# Colunas gravadas: os campos do evento seguidos dos códigos do User-Agent,
+# da classe de abertura e do ASN / estado do IP
+IMAGE_VIEWS_COLUMNS = ('id_fatura', 'ip_address', 'user_agent', 'referer', 'timestamp',
+                       'ua_client', 'ua_os', 'ua_device', 'open_class', 'asn', 'region')
+BOLETO_VIEWS_COLUMNS = ('empresa', 'codigo_boleto', 'id_fatura', 'ip_address', 'user_agent', 'referer',
+                        'timestamp', 'ua_client', 'ua_os', 'ua_device', 'open_class', 'asn', 'region')
+
+INSERT_IMAGE_VIEWS = '''
+    INSERT INTO image_views (%s)
+    VALUES %%s
+''' % ', '.join(IMAGE_VIEWS_COLUMNS)
+
+INSERT_BOLETO_VIEWS = '''
+    INSERT INTO boleto_views (%s)
+    VALUES %%s
+''' % ', '.join(BOLETO_VIEWS_COLUMNS)
+
+# Funções hook(cursor, events) executadas na mesma transação de cada lote
+# gravado (tabelas derivadas: contadores, agregados etc.)
+_batch_hooks = []
+
+
+def register_batch_hook(hook):
+    """Registra uma função chamada com (cursor, events) a cada lote gravado"""
+    if hook not in _batch_hooks:
+        _batch_hooks.append(hook)
+
+
+def run_batch_hooks(cursor, events):
+    for hook in _batch_hooks:
+        hook(cursor, events)
+
+
+def stored_events(events):
+    """Eventos do lote que viram linhas (sem as aberturas repetidas)"""
+    return [e for e in events if not isinstance(e, ImageRepeatEvent)]
+
+
+class EventBatch(list):
+    """Eventos de um lote em gravação, com a classe de abertura de cada um
+    já calculada ({evento: classe}), reaproveitada pelos hooks.
+
+    new_faturas é preenchido pelo hook dos contadores (faturas vistas pela
+    primeira vez no lote).
+    """
+
+    def __init__(self, events, open_classes):
+        super().__init__(events)
+        self.open_classes = open_classes
+        self.new_faturas = 0
+
+
+def open_classes(events):
+    """Classe de abertura de cada evento do lote: {evento: classe}"""
+    classes = getattr(events, 'open_classes', None)
+    if classes is None:
+        classes = {e: opens.classify(e.ip_address, e.user_agent) for e in events}
+    return classes
+
+
+def classified_batch(events):
+    return EventBatch(events, open_classes(events))
+
+
+def event_rows(events):
+    """Linhas (image_rows, boleto_rows) do lote, com User-Agent, abertura e IP classificados"""
+    image_rows = []
+    boleto_rows = []
+    classes = open_classes(events)
+    events = stored_events(events)
+    locations = geoip.resolve_many([e.ip_address for e in events])
+    for e, location in zip(events, locations):
+        row = tuple(e) + useragent.classify(e.user_agent) + (classes[e],) + location
+        if isinstance(e, ImageViewEvent):
+            image_rows.append(row)
+        else:
+            boleto_rows.append(row)
+    return image_rows, boleto_rows
+
+
+# Erros de conexão: o lote é regravado depois. Os demais (dados que o banco
+# recusa, como texto longo demais para a coluna ou byte NUL) não se resolvem
+# tentando de novo.
+RETRYABLE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+# Resultado de write_isolating: eventos gravados, [(evento, erro)] recusados,
+# eventos não tentados por falha de conexão e o erro dessa falha
+WriteResult = namedtuple('WriteResult', ['written', 'rejected', 'remaining', 'error'])
+
+
+def write_isolating(writer, conn, events):
+    """Grava ``events`` com ``writer``; se o banco recusar o lote, divide-o
+    ao meio até isolar os eventos recusados, e grava os demais.
+
+    Um erro de conexão (RETRYABLE_ERRORS) interrompe a gravação: os eventos
+    ainda não gravados voltam em ``remaining``.
+    """
+    written = 0
+    rejected = []
+    parts = [list(events)]
+    while parts:
+        part = parts.pop()
+        try:
+            writer(conn, part)
+        except RETRYABLE_ERRORS as e:
+            remaining = part + [event for rest in reversed(parts) for event in rest]
+            return WriteResult(written, rejected, remaining, e)
+        except (psycopg2.Error, ValueError) as e:
+            if len(part) == 1:
+                rejected.append((part[0], e))
+            else:
+                middle = len(part) // 2
+                parts.append(part[middle:])
+                parts.append(part[:middle])
+            continue
+        written += len(part)
+    return WriteResult(written, rejected, [], None)
+
+
+def write_events(conn, events):
+    """Grava um lote de eventos com INSERTs multi-linha numa única transação"""
+    events = classified_batch(events)
+    image_rows, boleto_rows = event_rows(events)
+
+    cursor = conn.cursor()
+    try:
+        if image_rows:
+            psycopg2.extras.execute_values(cursor, INSERT_IMAGE_VIEWS, image_rows,
+                                           page_size=len(image_rows))
+        if boleto_rows:
+            psycopg2.extras.execute_values(cursor, INSERT_BOLETO_VIEWS, boleto_rows,
+                                           page_size=len(boleto_rows))
+        run_batch_hooks(cursor, events)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def _csv_field(value):
+    # No CSV do COPY, NULL é o campo vazio sem aspas; todo valor vai entre aspas
+    if value is None:
+        return ''
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def _copy_rows(cursor, table, columns, rows):
+    buf = io.StringIO()
+    for row in rows:
+        buf.write(','.join(_csv_field(v) for v in row))
+        buf.write('\n')
+    buf.seek(0)
+    cursor.copy_expert(
+        'COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (table, ', '.join(columns)),
+        buf
+    )
+
+
+def copy_events(conn, events):
+    """Grava um lote grande de eventos com COPY numa única transação"""
+    events = classified_batch(events)
+    image_rows, boleto_rows = event_rows(events)
+
+    cursor = conn.cursor()
+    try:
+        if image_rows:
+            _copy_rows(cursor, 'image_views', IMAGE_VIEWS_COLUMNS, image_rows)
+        if boleto_rows:
+            _copy_rows(cursor, 'boleto_views', BOLETO_VIEWS_COLUMNS, boleto_rows)
+        run_batch_hooks(cursor, events)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+class WriteBehindBuffer:
+    """Fila limitada em memória esvaziada por uma thread em segundo plano.
+
+    Os handlers chamam ``enqueue()`` (nunca bloqueia); a thread grava os
+    eventos em lote a cada ``batch_size`` eventos ou ``flush_interval_ms``
+    milissegundos, o que ocorrer primeiro.
+    """
+
+    def __init__(self, get_connection, batch_size=500, flush_interval_ms=200,
+                 max_queue_size=50000, retry_interval_ms=1000, writer=write_events):
+        self.get_connection = get_connection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.retry_interval = retry_interval_ms / 1000.0
+        self.writer = writer
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._pending = []  # lote que falhou e será regravado
+        self._stop = threading.Event()
+        self._flush_now = threading.Event()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+        self._stats = {
+            'queued': 0,
+            'flushed': 0,
+            'dropped': 0,
+            'rejected': 0,
+            'batches': 0,
+            'flush_errors': 0,
+            'last_flush_ms': 0.0,
+        }
+
+    def _ensure_started(self):
+        # A thread é criada no primeiro evento e recriada após fork
+        pid = os.getpid()
+        if self._pid == pid and self._thread is not None:
+            return
+        with self._lock:
+            if self._pid == pid and self._thread is not None:
+                return
+            if self._pid is not None and self._pid != pid:
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+                self._pending = []
+            self._pid = pid
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    def enqueue(self, event):
+        """Enfileira um evento; retorna False se a fila estiver cheia"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._count('dropped')
+            return False
+        self._count('queued')
+        if self._queue.qsize() >= self.batch_size:
+            self._flush_now.set()
+        return True
+
+    def _drain(self, limit):
+        batch = self._pending
+        self._pending = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self):
+        """Grava um lote pendente; retorna o número de eventos processados
+        (gravados ou recusados pelo banco)"""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        batch = self._drain(self.batch_size)
+        if not batch:
+            return 0
+
+        start = time.monotonic()
+        conn = self.get_connection()
+        if not conn:
+            self._pending = batch
+            self._count('flush_errors')
+            return 0
+        try:
+            result = write_isolating(self.writer, conn, batch)
+        except Exception as e:
+            # Falha inesperada (ex: erro num hook): descarta o lote em vez
+            # de derrubar a thread ou regravá-lo para sempre
+            print(f"Erro inesperado ao gravar lote de {len(batch)} eventos, descartado: {e!r}")
+            self._count('dropped', len(batch))
+            self._count('flush_errors')
+            return 0
+        finally:
+            conn.close()
+
+        for event, error in result.rejected:
+            print(f"Evento recusado pelo banco, descartado ({error}): {event!r}")
+        if result.remaining:
+            print(f"Erro ao gravar lote de {len(batch)} eventos: {result.error}")
+            self._pending = result.remaining
+            self._count('flush_errors')
+
+        with self._lock:
+            self._stats['flushed'] += result.written
+            self._stats['rejected'] += len(result.rejected)
+            if result.written:
+                self._stats['batches'] += 1
+                self._stats['last_flush_ms'] = (time.monotonic() - start) * 1000.0
+        return result.written + len(result.rejected)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._flush_now.wait(self.flush_interval)
+            self._flush_now.clear()
+            while True:
+                had_pending = bool(self._pending)
+                try:
+                    written = self.flush()
+                except Exception as e:
+                    print(f"Erro inesperado na thread de gravação: {e!r}")
+                    written = 0
+                if written == 0 and (had_pending or self._pending):
+                    # Banco indisponível: espera antes de tentar de novo
+                    self._stop.wait(self.retry_interval)
+                    break
+                if written < self.batch_size:
+                    break
+
+    def stop(self, timeout=10.0):
+        """Encerra a thread e grava o que restou na fila (flush-on-shutdown)"""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stop.set()
+        self._flush_now.set()
+        self._thread.join(timeout)
+        deadline = time.monotonic() + timeout
+        while (self._pending or not self._queue.empty()) and time.monotonic() < deadline:
+            if self.flush() == 0 and self._pending:
+                break
+        remaining = len(self._pending) + self._queue.qsize()
+        if remaining:
+            self._count('dropped', remaining)
+            print(f"{remaining} eventos descartados no encerramento")
+
+    def stats(self):
+        """Retorna os contadores da fila"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['queue_size'] = self._queue.qsize()
+        stats['pending_retry'] = len(self._pending)
+        return stats
+
+
+class SyncWriter:
+    """Sink síncrono: grava cada evento durante a requisição (depuração)"""
+
+    def __init__(self, get_connection, writer=write_events):
+        self.get_connection = get_connection
+        self.writer = writer
+        self._lock = threading.Lock()
+        self._stats = {'written': 0, 'write_errors': 0}
+
+    def enqueue(self, event):
+        """Grava o evento imediatamente; retorna False em caso de erro"""
+        conn = self.get_connection()
+        if not conn:
+            print("Não foi possível conectar ao banco para registrar visualização")
+            with self._lock:
+                self._stats['write_errors'] += 1
+            return False
+        try:
+            self.writer(conn, [event])
+        except (psycopg2.Error, ValueError) as e:
+            print(f"Erro ao registrar evento: {e}")
+            with self._lock:
+                self._stats['write_errors'] += 1
+            return False
+        finally:
+            conn.close()
+        with self._lock:
+            self._stats['written'] += 1
+        return True
+
+    def stop(self, timeout=None):
+        pass
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+class LatencyRecorder:
+    """Janela das últimas N latências para calcular percentis sob demanda"""
+
+    def __init__(self, window=10000):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds * 1000.0)
+
+    def percentiles(self, points=(50, 90, 99)):
+        """Retorna {'count': n, 'p50_ms': ..., ...} sobre a janela atual"""
+        with self._lock:
+            samples = sorted(self._samples)
+        result = {'count': len(samples)}
+        for p in points:
+            if samples:
+                index = min(len(samples) - 1, int(len(samples) * p / 100.0))
+                result['p%d_ms' % p] = round(samples[index], 3)
+            else:
+                result['p%d_ms' % p] = None
+        return result
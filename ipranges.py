@@ -0,0 +1,176 @@
+# Índice de faixas de IP (CIDR) em vetores ordenados com busca binária
+#
+# As faixas são achatadas em trechos disjuntos e contíguos que cobrem todo o
+# espaço de endereços (os buracos ficam com valor None), com o valor do
+# prefixo mais específico em cada trecho; a consulta de um IP é um bisect
+# sobre os inícios. Os IPv4 ficam em array('I') (4 bytes por posição), o que
+# mantém listas com centenas de milhares de prefixos compactas na memória, e
+# uma tabela pelos 16 bits altos do endereço limita cada busca aos trechos
+# daquele /16.
+
+import bisect
+import ipaddress
+import operator
+import socket
+import struct
+from array import array
+from functools import partial
+from itertools import repeat
+
+MAX_ADDRESS = {4: 2 ** 32 - 1, 6: 2 ** 128 - 1}
+
+# Mesmo parser estrito de ip_to_int, para lookup e lookup_many concordarem
+_parse_ipv4 = partial(socket.inet_pton, socket.AF_INET)
+
+
+def ip_to_int(ip):
+    """(versão, inteiro) do endereço; None se inválido"""
+    try:
+        if ':' in ip:
+            value = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big')
+            if value >> 32 == 0xffff:
+                return 4, value & 0xffffffff  # IPv4 mapeado (::ffff:a.b.c.d)
+            return 6, value
+        # inet_pton (e não inet_aton) para recusar formas como "10.1"
+        return 4, int.from_bytes(_parse_ipv4(ip), 'big')
+    except (OSError, TypeError):
+        return None
+
+
+def _flatten(intervals):
+    """Intervalos aninhados ou disjuntos (como CIDRs) -> trechos disjuntos.
+
+    Em cada trecho vale o intervalo mais interno; trechos vizinhos com o mesmo
+    valor são unidos.
+    """
+    out = []
+
+    def emit(start, end, value):
+        if start > end:
+            return
+        if out and out[-1][2] == value and out[-1][1] + 1 == start:
+            out[-1] = (out[-1][0], end, value)
+        else:
+            out.append((start, end, value))
+
+    stack = []  # (fim, valor) dos intervalos abertos, do mais externo ao mais interno
+    cursor = 0  # próximo endereço ainda não emitido
+    for start, end, value in sorted(intervals, key=lambda i: (i[0], -i[1])):
+        while stack and stack[-1][0] < start:
+            top_end, top_value = stack.pop()
+            emit(cursor, top_end, top_value)
+            cursor = max(cursor, top_end + 1)
+        if stack:
+            emit(cursor, start - 1, stack[-1][1])
+        stack.append((end, value))
+        cursor = start
+    while stack:
+        top_end, top_value = stack.pop()
+        emit(cursor, top_end, top_value)
+        cursor = max(cursor, top_end + 1)
+    return out
+
+
+def _dense(segments, max_address):
+    """Trechos disjuntos -> (inícios, valores) cobrindo [0, max_address].
+
+    ``values[i]`` é o valor do trecho que começa em ``starts[i - 1]``
+    (``values[0]`` nunca é usado), de modo que ``values[bisect_right(starts,
+    ip)]`` é o valor do IP sem subtrair 1 do índice.
+    """
+    starts = []
+    values = [None]
+    cursor = 0
+    for start, end, value in segments:
+        if start > cursor:
+            starts.append(cursor)
+            values.append(None)
+        starts.append(start)
+        values.append(value)
+        cursor = end + 1
+    if cursor <= max_address or not starts:
+        starts.append(cursor)
+        values.append(None)
+    return starts, values
+
+
+class RangeIndex:
+    """Mapa CIDR -> valor com consulta O(log n)"""
+
+    def __init__(self, entries=()):
+        by_version = {4: [], 6: []}
+        for network, value in entries:
+            network = ipaddress.ip_network(network, strict=False)
+            by_version[network.version].append(
+                (int(network.network_address), int(network.broadcast_address), value))
+        self._tables = {}
+        self._size = 0
+        for version, intervals in by_version.items():
+            segments = _flatten(intervals)
+            self._size += len(segments)
+            starts, values = _dense(segments, MAX_ADDRESS[version])
+            self._tables[version] = (array('I', starts) if version == 4 else starts, values)
+
+        # Janela [lo, hi] de bisect_right para cada /16 IPv4
+        starts = self._tables[4][0]
+        self._bucket_lo = array('I', (bisect.bisect_right(starts, b << 16) for b in range(1 << 16)))
+        self._bucket_hi = array('I', (bisect.bisect_right(starts, (b << 16) | 0xffff)
+                                      for b in range(1 << 16)))
+
+    def __len__(self):
+        return self._size
+
+    def lookup(self, ip, default=None):
+        """Valor da faixa que contém o IP (texto), ou ``default``"""
+        parsed = ip_to_int(ip) if ip else None
+        if parsed is None:
+            return default
+        version, value = parsed
+        starts, values = self._tables[version]
+        found = values[bisect.bisect_right(starts, value)]
+        return default if found is None else found
+
+    def lookup_many(self, ips, default=None):
+        """Valores de uma sequência de IPs (texto), na mesma ordem.
+
+        Lotes só com IPv4 são convertidos e buscados sem laço em Python (map
+        sobre funções em C); um lote com IPv6 ou endereço inválido cai na
+        consulta individual.
+        """
+        ips = ips if isinstance(ips, list) else list(ips)
+        try:
+            ints = struct.unpack('!%dI' % len(ips), b''.join(map(_parse_ipv4, ips)))
+        except (OSError, TypeError):
+            return [self.lookup(ip, default) for ip in ips]
+        starts, values = self._tables[4]
+        buckets = list(map(operator.rshift, ints, repeat(16)))
+        found = map(values.__getitem__,
+                    map(bisect.bisect_right, repeat(starts), ints,
+                        map(self._bucket_lo.__getitem__, buckets),
+                        map(self._bucket_hi.__getitem__, buckets)))
+        if default is None:
+            return list(found)
+        return [default if value is None else value for value in found]
+
+
+def read_cidr_file(path, parse_value=str):
+    """Entradas (cidr, valor) de um arquivo "CIDR valor [comentário]".
+
+    Linhas vazias ou iniciadas por # são ignoradas; levanta ValueError com a
+    linha de um CIDR ou valor inválido.
+    """
+    entries = []
+    with open(path, encoding='utf-8') as f:
+        for n, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            parts = line.split(None, 2)
+            if len(parts) < 2:
+                raise ValueError(f'{path}:{n}: esperado "CIDR valor"')
+            try:
+                ipaddress.ip_network(parts[0], strict=False)
+                entries.append((parts[0], parse_value(parts[1])))
+            except ValueError as e:
+                raise ValueError(f'{path}:{n}: {e}')
+    return entries
@@ -0,0 +1,192 @@
+# Feed ao vivo (Server-Sent Events) dos eventos de rastreamento
+#
+# Cada lote ingerido publica um resumo via NOTIFY (entregue no commit), então
+# dashboards conectados a qualquer processo recebem os eventos de todos. Cada
+# processo mantém uma única conexão LISTEN e distribui as mensagens para
+# filas limitadas por cliente: o custo é O(eventos), não O(dashboards x
+# agregação completa).
+
+import json
+import queue
+import select
+import threading
+import time
+
+import psycopg2
+
+import counters
+import ingest
+
+# Limite do payload do NOTIFY é 8000 bytes; deixa margem
+MAX_PAYLOAD = 7500
+
+
+def _ts(value):
+    return value.isoformat() if value is not None else None
+
+
+def build_messages(events, max_recent=10):
+    """Mensagens do lote: deltas dos contadores + eventos mais recentes"""
+    image_events = [e for e in events if isinstance(e, ingest.IMAGE_EVENTS)]
+    unique_events = [e for e in image_events if isinstance(e, ingest.ImageViewEvent)]
+    boleto_events = [e for e in events if isinstance(e, ingest.BoletoViewEvent)]
+
+    messages = []
+    deltas = {
+        'totals': {'image': len(image_events), 'unique_image': len(unique_events),
+                   'boleto': len(boleto_events), 'faturas': getattr(events, 'new_faturas', 0)},
+        'faturas': [[k, n, _ts(first), _ts(last)]
+                    for k, n, first, last in counters.aggregate(image_events, lambda e: e.id_fatura)],
+        'empresas': [[k, n, _ts(first), _ts(last)]
+                     for k, n, first, last in counters.aggregate(boleto_events, lambda e: e.empresa)],
+    }
+    # Quebra os deltas de faturas em várias mensagens se não couberem
+    faturas = deltas.pop('faturas')
+    message = dict(deltas, faturas=[])
+    for item in faturas:
+        message['faturas'].append(item)
+        if len(json.dumps(message)) > MAX_PAYLOAD:
+            message['faturas'].pop()
+            messages.append({'type': 'deltas', 'data': message})
+            message = {'totals': {'image': 0, 'unique_image': 0, 'boleto': 0, 'faturas': 0}, 'empresas': [],
+                       'faturas': [item]}
+    messages.append({'type': 'deltas', 'data': message})
+
+    recent = []
+    for e in sorted(unique_events, key=lambda e: e.timestamp)[-max_recent:]:
+        recent.append({'kind': 'image', 'id_fatura': e.id_fatura, 'ip_address': e.ip_address,
+                       'timestamp': _ts(e.timestamp), 'user_agent': (e.user_agent or '')[:200]})
+    for e in sorted(boleto_events, key=lambda e: e.timestamp)[-max_recent:]:
+        recent.append({'kind': 'boleto', 'empresa': e.empresa, 'codigo_boleto': e.codigo_boleto[:40],
+                       'id_fatura': e.id_fatura, 'ip_address': e.ip_address,
+                       'timestamp': _ts(e.timestamp)})
+    if recent:
+        messages.append({'type': 'events', 'data': recent})
+    return messages
+
+
+def make_notify_hook(channel, max_recent=10):
+    """Hook de ingestão que publica o lote com pg_notify na mesma transação"""
+    def notify_batch(cursor, events):
+        for message in build_messages(events, max_recent):
+            payload = json.dumps(message, separators=(',', ':'))
+            if len(payload) > MAX_PAYLOAD:
+                payload = json.dumps({'type': 'resync', 'data': None})
+            cursor.execute('SELECT pg_notify(%s, %s)', (channel, payload))
+    return notify_batch
+
+
+class Subscription:
+    """Fila limitada de um cliente SSE"""
+
+    def __init__(self, max_size):
+        self.queue = queue.Queue(maxsize=max_size)
+        self.lagged = False
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class LiveHub:
+    """Distribui as notificações do PostgreSQL para os clientes conectados"""
+
+    def __init__(self, connect_kwargs, channel, client_queue_size=256, reconnect_interval=5.0):
+        self.connect_kwargs = connect_kwargs
+        self.channel = channel
+        self.client_queue_size = client_queue_size
+        self.reconnect_interval = reconnect_interval
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stats = {'published': 0, 'dropped': 0, 'listener_errors': 0}
+
+    def subscribe(self):
+        self._ensure_listener()
+        subscription = Subscription(self.client_queue_size)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, message):
+        """Entrega a mensagem a todos os clientes sem bloquear"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+            self._stats['published'] += 1
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(message)
+            except queue.Full:
+                # Cliente lento: descarta e pede que ele recarregue os totais
+                subscription.lagged = True
+                with self._lock:
+                    self._stats['dropped'] += 1
+
+    def _ensure_listener(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._listen, name='live-listener', daemon=True)
+            self._thread.start()
+
+    def _listen(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.connect_kwargs)
+                conn.autocommit = True
+                cursor = conn.cursor()
+                cursor.execute('LISTEN %s' % self.channel)
+                cursor.close()
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            self.publish(json.loads(notify.payload))
+                        except ValueError:
+                            continue
+            except (psycopg2.Error, OSError) as e:
+                print(f"Erro no listener do feed ao vivo: {e}")
+                with self._lock:
+                    self._stats['listener_errors'] += 1
+                # Os clientes perderam eventos durante a queda
+                self.publish({'type': 'resync', 'data': None})
+            finally:
+                if conn is not None:
+                    conn.close()
+            time.sleep(self.reconnect_interval)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['clients'] = len(self._subscribers)
+        return stats
+
+
+def sse_stream(hub, subscription, heartbeat=15.0):
+    """Gerador de texto SSE para um cliente; remove a inscrição ao terminar"""
+    try:
+        yield 'retry: 5000\n\n'
+        while True:
+            if subscription.lagged:
+                subscription.lagged = False
+                yield 'event: resync\ndata: null\n\n'
+            message = subscription.get(heartbeat)
+            if message is None:
+                yield ': keepalive\n\n'
+                continue
+            yield 'event: %s\ndata: %s\n\n' % (
+                message['type'], json.dumps(message['data'], separators=(',', ':')))
+    finally:
+        hub.unsubscribe(subscription)
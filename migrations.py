@@ -0,0 +1,439 @@
+# Migrações versionadas do esquema do banco
+#
+# Cada migração tem uma versão crescente e uma lista de passos: comandos SQL
+# ou funções step(cursor). Migrações com transactional=False rodam em
+# autocommit, necessário para CREATE INDEX CONCURRENTLY; seus passos devem
+# ser idempotentes, pois uma falha no meio não é desfeita.
+#
+# O SQL de cada versão fica escrito aqui e não muda depois de publicado:
+# mudanças de esquema entram como uma nova versão, nunca editando uma
+# anterior (nem o DDL de outro módulo).
+#
+# Uso: python migrations.py [--dry-run]
+
+import sys
+from collections import namedtuple
+
+import psycopg2
+
+import partitions
+
+Migration = namedtuple('Migration', ['version', 'name', 'steps', 'transactional'])
+
+# Serializa a execução das migrações entre processos / servidores
+MIGRATION_LOCK_ID = 7305002
+
+CREATE_VERSIONS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name VARCHAR(255) NOT NULL,
+        applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+
+def _index_is_invalid(cursor, name):
+    cursor.execute('''
+        SELECT NOT i.indisvalid FROM pg_index i
+        WHERE i.indexrelid = to_regclass(%s)
+    ''', (name,))
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+def concurrent_index(name, table, definition, method='btree'):
+    """Passo que cria um índice sem bloquear escritas (CREATE INDEX CONCURRENTLY).
+
+    Em tabelas particionadas, onde CONCURRENTLY não é suportado, cria o índice
+    do pai com ON ONLY, o índice de cada partição concorrentemente e os anexa.
+    Índices inválidos deixados por uma tentativa anterior são recriados.
+    """
+    def step(cursor):
+        if partitions.table_kind(cursor, table) == 'partitioned':
+            cursor.execute('CREATE INDEX IF NOT EXISTS %s ON ONLY %s USING %s (%s)'
+                           % (name, table, method, definition))
+            for partition in sorted(partitions.list_partitions(cursor, table)):
+                child = partitions.partition_index_name(partition, name)
+                _create_concurrently(cursor, child, partition, definition, method)
+                cursor.execute('''
+                    SELECT 1 FROM pg_inherits
+                    WHERE inhrelid = to_regclass(%s) AND inhparent = to_regclass(%s)
+                ''', (child, name))
+                if not cursor.fetchone():
+                    cursor.execute('ALTER INDEX %s ATTACH PARTITION %s' % (name, child))
+        else:
+            _create_concurrently(cursor, name, table, definition, method)
+
+    step.description = 'CREATE INDEX CONCURRENTLY %s ON %s USING %s (%s)' % (
+        name, table, method, definition)
+    return step
+
+
+def _create_concurrently(cursor, name, table, definition, method):
+    if _index_is_invalid(cursor, name):
+        cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % name)
+    cursor.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON %s USING %s (%s)'
+                   % (name, table, method, definition))
+
+
+# Versão 1: eventos particionados por timestamp e contadores
+BASE_EVENT_TABLES = {
+    'image_views': '''
+        id BIGSERIAL,
+        id_fatura VARCHAR(255) NOT NULL,
+        ip_address VARCHAR(45),
+        user_agent TEXT,
+        timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        referer TEXT,
+        PRIMARY KEY (id, timestamp)
+    ''',
+    'boleto_views': '''
+        id BIGSERIAL,
+        empresa VARCHAR(50) NOT NULL,
+        codigo_boleto VARCHAR(255) NOT NULL,
+        id_fatura VARCHAR(255),
+        ip_address VARCHAR(45),
+        user_agent TEXT,
+        timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        referer TEXT,
+        PRIMARY KEY (id, timestamp)
+    ''',
+}
+
+BASE_COUNTER_TABLES = [
+    '''
+    CREATE TABLE IF NOT EXISTS fatura_view_counters (
+        id_fatura VARCHAR(255) PRIMARY KEY,
+        views BIGINT NOT NULL DEFAULT 0,
+        first_view TIMESTAMP,
+        last_view TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS empresa_boleto_counters (
+        empresa VARCHAR(50) PRIMARY KEY,
+        views BIGINT NOT NULL DEFAULT 0,
+        first_view TIMESTAMP,
+        last_view TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS view_totals (
+        kind VARCHAR(20) PRIMARY KEY,
+        views BIGINT NOT NULL DEFAULT 0
+    )
+    ''',
+]
+
+
+def _base_tables(cursor):
+    for table, columns in BASE_EVENT_TABLES.items():
+        if partitions.table_kind(cursor, table) == 'plain':
+            print(f"Tabela {table} não é particionada; execute 'python partitions.py convert'")
+            continue
+        cursor.execute('CREATE TABLE IF NOT EXISTS %s (%s) PARTITION BY RANGE (timestamp)'
+                       % (table, columns))
+        cursor.execute('CREATE TABLE IF NOT EXISTS %s_default PARTITION OF %s DEFAULT'
+                       % (table, table))
+    for ddl in BASE_COUNTER_TABLES:
+        cursor.execute(ddl)
+
+
+_base_tables.description = 'tabelas image_views / boleto_views (particionadas) e contadores'
+
+
+def _adopt_legacy_indexes(cursor):
+    for table in partitions.TABLES:
+        legacy = '%s_legacy' % table
+        if partitions.table_kind(cursor, table) == 'partitioned' and partitions.table_kind(cursor, legacy):
+            partitions.adopt_partition_indexes(cursor, table, legacy)
+
+
+_adopt_legacy_indexes.description = 'índices de <tabela>_legacy passam a ser do pai particionado'
+
+
+MIGRATIONS = [
+    Migration(1, 'tabelas base', [_base_tables], True),
+    Migration(2, 'índices de consulta por fatura, empresa e timestamp', [
+        concurrent_index('idx_image_views_fatura_ts', 'image_views', 'id_fatura, timestamp DESC'),
+        concurrent_index('idx_boleto_views_empresa_ts', 'boleto_views', 'empresa, timestamp DESC'),
+        concurrent_index('idx_image_views_ts_brin', 'image_views', 'timestamp', method='brin'),
+        concurrent_index('idx_boleto_views_ts_brin', 'boleto_views', 'timestamp', method='brin'),
+        concurrent_index('idx_fatura_view_counters_views', 'fatura_view_counters', 'views DESC'),
+    ], False),
+    Migration(3, 'cursor de mudanças dos contadores (/api/stats?since=)', [
+        'ALTER TABLE fatura_view_counters ADD COLUMN IF NOT EXISTS changed_txid BIGINT NOT NULL DEFAULT 0',
+        'ALTER TABLE empresa_boleto_counters ADD COLUMN IF NOT EXISTS changed_txid BIGINT NOT NULL DEFAULT 0',
+        concurrent_index('idx_fatura_view_counters_txid', 'fatura_view_counters', 'changed_txid'),
+        concurrent_index('idx_empresa_boleto_counters_txid', 'empresa_boleto_counters', 'changed_txid'),
+    ], False),
+    Migration(4, 'índices de boleto_views por fatura e código (consulta em lote)', [
+        concurrent_index('idx_boleto_views_fatura_ts', 'boleto_views', 'id_fatura, timestamp DESC'),
+        concurrent_index('idx_boleto_views_codigo', 'boleto_views', 'codigo_boleto'),
+    ], False),
+    Migration(5, 'User-Agent classificado e estatísticas de dispositivos', [
+        '''ALTER TABLE image_views
+               ADD COLUMN IF NOT EXISTS ua_client SMALLINT,
+               ADD COLUMN IF NOT EXISTS ua_os SMALLINT,
+               ADD COLUMN IF NOT EXISTS ua_device SMALLINT''',
+        '''ALTER TABLE boleto_views
+               ADD COLUMN IF NOT EXISTS ua_client SMALLINT,
+               ADD COLUMN IF NOT EXISTS ua_os SMALLINT,
+               ADD COLUMN IF NOT EXISTS ua_device SMALLINT''',
+        '''CREATE TABLE IF NOT EXISTS device_daily_stats (
+               day DATE NOT NULL,
+               kind VARCHAR(10) NOT NULL,
+               empresa VARCHAR(50) NOT NULL DEFAULT '',
+               ua_client SMALLINT NOT NULL,
+               ua_os SMALLINT NOT NULL,
+               ua_device SMALLINT NOT NULL,
+               views BIGINT NOT NULL DEFAULT 0,
+               PRIMARY KEY (day, kind, empresa, ua_client, ua_os, ua_device)
+           )''',
+    ], True),
+    Migration(6, 'classe da abertura (humana, proxy, pré-busca) nos eventos e contadores', [
+        'ALTER TABLE image_views ADD COLUMN IF NOT EXISTS open_class SMALLINT',
+        'ALTER TABLE boleto_views ADD COLUMN IF NOT EXISTS open_class SMALLINT',
+        '''ALTER TABLE fatura_view_counters
+               ADD COLUMN IF NOT EXISTS proxy_views BIGINT NOT NULL DEFAULT 0,
+               ADD COLUMN IF NOT EXISTS prefetch_views BIGINT NOT NULL DEFAULT 0''',
+        '''ALTER TABLE empresa_boleto_counters
+               ADD COLUMN IF NOT EXISTS proxy_views BIGINT NOT NULL DEFAULT 0,
+               ADD COLUMN IF NOT EXISTS prefetch_views BIGINT NOT NULL DEFAULT 0''',
+        '''ALTER TABLE view_totals
+               ADD COLUMN IF NOT EXISTS proxy_views BIGINT NOT NULL DEFAULT 0,
+               ADD COLUMN IF NOT EXISTS prefetch_views BIGINT NOT NULL DEFAULT 0''',
+    ], True),
+    Migration(7, 'ASN e estado do IP nos eventos e estatísticas por provedor', [
+        '''ALTER TABLE image_views
+               ADD COLUMN IF NOT EXISTS asn INTEGER,
+               ADD COLUMN IF NOT EXISTS region SMALLINT''',
+        '''ALTER TABLE boleto_views
+               ADD COLUMN IF NOT EXISTS asn INTEGER,
+               ADD COLUMN IF NOT EXISTS region SMALLINT''',
+        '''CREATE TABLE IF NOT EXISTS geo_daily_stats (
+               day DATE NOT NULL,
+               kind VARCHAR(10) NOT NULL,
+               empresa VARCHAR(50) NOT NULL DEFAULT '',
+               asn INTEGER NOT NULL,
+               region SMALLINT NOT NULL,
+               views BIGINT NOT NULL DEFAULT 0,
+               PRIMARY KEY (day, kind, empresa, asn, region)
+           )''',
+    ], True),
+    Migration(8, 'aberturas repetidas (janela de deduplicação) nos contadores', [
+        'ALTER TABLE fatura_view_counters ADD COLUMN IF NOT EXISTS repeat_views BIGINT NOT NULL DEFAULT 0',
+        'ALTER TABLE view_totals ADD COLUMN IF NOT EXISTS repeat_views BIGINT NOT NULL DEFAULT 0',
+    ], True),
+    Migration(9, 'rollups por minuto, hora e dia (/api/timeseries)', [
+        '''CREATE TABLE IF NOT EXISTS rollup_minute (
+               bucket TIMESTAMP NOT NULL,
+               metric SMALLINT NOT NULL,
+               empresa VARCHAR(50) NOT NULL DEFAULT '',
+               id_fatura VARCHAR(255) NOT NULL DEFAULT '',
+               views BIGINT NOT NULL DEFAULT 0,
+               PRIMARY KEY (bucket, metric, empresa, id_fatura)
+           )''',
+        '''CREATE TABLE IF NOT EXISTS rollup_hour (
+               bucket TIMESTAMP NOT NULL,
+               metric SMALLINT NOT NULL,
+               empresa VARCHAR(50) NOT NULL DEFAULT '',
+               id_fatura VARCHAR(255) NOT NULL DEFAULT '',
+               views BIGINT NOT NULL DEFAULT 0,
+               PRIMARY KEY (bucket, metric, empresa, id_fatura)
+           )''',
+        'CREATE INDEX IF NOT EXISTS idx_rollup_hour_fatura ON rollup_hour (id_fatura, bucket)',
+        '''CREATE TABLE IF NOT EXISTS rollup_day (
+               bucket TIMESTAMP NOT NULL,
+               metric SMALLINT NOT NULL,
+               empresa VARCHAR(50) NOT NULL DEFAULT '',
+               id_fatura VARCHAR(255) NOT NULL DEFAULT '',
+               views BIGINT NOT NULL DEFAULT 0,
+               PRIMARY KEY (bucket, metric, empresa, id_fatura)
+           )''',
+        'CREATE INDEX IF NOT EXISTS idx_rollup_day_fatura ON rollup_day (id_fatura, bucket)',
+        '''CREATE TABLE IF NOT EXISTS rollup_watermarks (
+               source VARCHAR(50) PRIMARY KEY,
+               last_id BIGINT NOT NULL DEFAULT 0,
+               until_id BIGINT NOT NULL DEFAULT 0
+           )''',
+        '''INSERT INTO rollup_watermarks (source, last_id, until_id)
+               SELECT 'image_views', 0, COALESCE(MAX(id), 0) FROM image_views
+               ON CONFLICT (source) DO NOTHING''',
+        '''INSERT INTO rollup_watermarks (source, last_id, until_id)
+               SELECT 'boleto_views', 0, COALESCE(MAX(id), 0) FROM boleto_views
+               ON CONFLICT (source) DO NOTHING''',
+    ], True),
+    Migration(10, 'funil abertura -> clique por fatura (/api/funnel)', [
+        '''CREATE TABLE IF NOT EXISTS fatura_funnel (
+               id_fatura VARCHAR(255) PRIMARY KEY,
+               empresa VARCHAR(50),
+               campaign VARCHAR(100),
+               sent_at TIMESTAMP,
+               first_open TIMESTAMP,
+               first_click TIMESTAMP
+           )''',
+        '''CREATE TABLE IF NOT EXISTS funnel_stats (
+               empresa VARCHAR(50) NOT NULL,
+               campaign VARCHAR(100) NOT NULL,
+               faturas BIGINT NOT NULL DEFAULT 0,
+               sent BIGINT NOT NULL DEFAULT 0,
+               opened BIGINT NOT NULL DEFAULT 0,
+               clicked BIGINT NOT NULL DEFAULT 0,
+               opened_clicked BIGINT NOT NULL DEFAULT 0,
+               PRIMARY KEY (empresa, campaign)
+           )''',
+        '''CREATE TABLE IF NOT EXISTS funnel_ttc (
+               empresa VARCHAR(50) NOT NULL,
+               campaign VARCHAR(100) NOT NULL,
+               bucket SMALLINT NOT NULL,
+               faturas BIGINT NOT NULL DEFAULT 0,
+               PRIMARY KEY (empresa, campaign, bucket)
+           )''',
+    ], True),
+    Migration(11, 'registro de envios por campanha e histograma envio -> abertura', [
+        '''CREATE TABLE IF NOT EXISTS sends (
+               id BIGSERIAL PRIMARY KEY,
+               campaign VARCHAR(100) NOT NULL,
+               empresa VARCHAR(50),
+               id_fatura VARCHAR(255) NOT NULL,
+               codigo_boleto VARCHAR(255),
+               sent_at TIMESTAMP NOT NULL,
+               UNIQUE (campaign, id_fatura)
+           )''',
+        'CREATE INDEX IF NOT EXISTS idx_sends_fatura ON sends (id_fatura, sent_at)',
+        'CREATE INDEX IF NOT EXISTS idx_sends_codigo_boleto ON sends (codigo_boleto)',
+        '''CREATE TABLE IF NOT EXISTS funnel_tto (
+               empresa VARCHAR(50) NOT NULL,
+               campaign VARCHAR(100) NOT NULL,
+               bucket SMALLINT NOT NULL,
+               faturas BIGINT NOT NULL DEFAULT 0,
+               PRIMARY KEY (empresa, campaign, bucket)
+           )''',
+    ], True),
+    # Bancos convertidos por partitions.py convert antes desta versão ficaram
+    # com os índices das versões 2 e 4 só na partição <tabela>_legacy
+    Migration(12, 'índices dos eventos em tabelas convertidas para particionadas', [
+        _adopt_legacy_indexes,
+    ], True),
+    Migration(13, 'índices dos eventos nas demais partições', [
+        concurrent_index('idx_image_views_fatura_ts', 'image_views', 'id_fatura, timestamp DESC'),
+        concurrent_index('idx_boleto_views_empresa_ts', 'boleto_views', 'empresa, timestamp DESC'),
+        concurrent_index('idx_image_views_ts_brin', 'image_views', 'timestamp', method='brin'),
+        concurrent_index('idx_boleto_views_ts_brin', 'boleto_views', 'timestamp', method='brin'),
+        concurrent_index('idx_boleto_views_fatura_ts', 'boleto_views', 'id_fatura, timestamp DESC'),
+        concurrent_index('idx_boleto_views_codigo', 'boleto_views', 'codigo_boleto'),
+    ], False),
+    # Envios registrados pelo antigo 'funnel.py sent' só existiam em
+    # fatura_funnel; sem esta cópia o funnel.py rebuild os perderia
+    Migration(14, 'envios registrados só no funil copiados para sends', [
+        '''INSERT INTO sends (campaign, empresa, id_fatura, sent_at)
+               SELECT COALESCE(campaign, ''), empresa, id_fatura, sent_at
+               FROM fatura_funnel
+               WHERE sent_at IS NOT NULL
+               ON CONFLICT (campaign, id_fatura) DO NOTHING''',
+    ], True),
+    Migration(15, 'número de faturas em view_totals (dashboard sem ler todos os contadores)', [
+        'ALTER TABLE view_totals ADD COLUMN IF NOT EXISTS faturas BIGINT NOT NULL DEFAULT 0',
+        '''INSERT INTO view_totals (kind, views, faturas)
+               SELECT 'image', 0, COUNT(*) FROM fatura_view_counters
+               ON CONFLICT (kind) DO UPDATE SET faturas = EXCLUDED.faturas''',
+    ], True),
+]
+
+
+def describe(step):
+    return step if isinstance(step, str) else getattr(step, 'description', step.__name__)
+
+
+def applied_versions(cursor, create=True):
+    if create:
+        cursor.execute(CREATE_VERSIONS_TABLE)
+    else:
+        cursor.execute("SELECT to_regclass('schema_migrations')")
+        if cursor.fetchone()[0] is None:
+            return set()
+    cursor.execute('SELECT version FROM schema_migrations')
+    return {row[0] for row in cursor.fetchall()}
+
+
+def pending_migrations(conn, migrations=None):
+    migrations = MIGRATIONS if migrations is None else migrations
+    cursor = conn.cursor()
+    try:
+        applied = applied_versions(cursor, create=False)
+        conn.rollback()
+    finally:
+        cursor.close()
+    return [m for m in sorted(migrations, key=lambda m: m.version) if m.version not in applied]
+
+
+def _run_steps(cursor, steps):
+    for step in steps:
+        if isinstance(step, str):
+            cursor.execute(step)
+        else:
+            step(cursor)
+
+
+def migrate(conn, dry_run=False, migrations=None):
+    """Aplica as migrações pendentes em ordem; retorna as versões aplicadas.
+
+    Com dry_run=True apenas imprime o que seria executado.
+    """
+    pending = pending_migrations(conn, migrations)
+    if dry_run:
+        for m in pending:
+            mode = '' if m.transactional else ' (sem transação)'
+            print(f"[{m.version}] {m.name}{mode}")
+            for step in m.steps:
+                print(f"    {' '.join(describe(step).split())}")
+        return []
+
+    applied = []
+    previous_autocommit = conn.autocommit
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        cursor.execute('SELECT pg_advisory_lock(%s)', (MIGRATION_LOCK_ID,))
+        try:
+            done = applied_versions(cursor)
+            for m in pending:
+                if m.version in done:
+                    continue  # aplicada por outro processo enquanto esperávamos
+                if m.transactional:
+                    cursor.execute('BEGIN')
+                    try:
+                        _run_steps(cursor, m.steps)
+                        cursor.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)',
+                                       (m.version, m.name))
+                        cursor.execute('COMMIT')
+                    except Exception:
+                        cursor.execute('ROLLBACK')
+                        raise
+                else:
+                    _run_steps(cursor, m.steps)
+                    cursor.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)',
+                                   (m.version, m.name))
+                print(f"Migração {m.version} aplicada: {m.name}")
+                applied.append(m.version)
+        finally:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', (MIGRATION_LOCK_ID,))
+    finally:
+        cursor.close()
+        conn.autocommit = previous_autocommit
+    return applied
+
+
+if __name__ == '__main__':
+    from config import config
+    import db_pool
+
+    dry_run = '--dry-run' in sys.argv[1:]
+    conn = psycopg2.connect(**db_pool.connect_kwargs_from_config(config))
+    try:
+        applied = migrate(conn, dry_run=dry_run)
+        if not dry_run and not applied:
+            print("Nenhuma migração pendente")
+    finally:
+        conn.close()
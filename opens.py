@@ -0,0 +1,88 @@
+# Classificação das aberturas: humana, proxy de imagens ou busca automática
+#
+# Roda na ingestão, junto com a classificação do User-Agent: cada evento
+# recebe open_class (HUMAN, PROXY ou PREFETCH), gravado em image_views /
+# boleto_views e somado nos contadores (proxy_views / prefetch_views), então
+# as estatísticas podem descontar aberturas de máquina sem ler as linhas
+# brutas.
+#
+# - PROXY: o provedor (Gmail, Yahoo) busca a imagem quando o leitor abre o
+#   e-mail; é uma abertura real, mas sem o IP/dispositivo do leitor.
+# - PREFETCH: busca sem o leitor (Apple Mail Privacy Protection, scanners de
+#   segurança, bots).
+#
+# As faixas de IP vêm de um arquivo CIDR local (OPEN_CIDR_FILE, ver
+# data/machine_opens.txt) indexado em ipranges.RangeIndex.
+
+import ipranges
+import useragent
+
+OPEN_HUMAN = 0
+OPEN_PROXY = 1
+OPEN_PREFETCH = 2
+
+OPEN_CLASSES = {
+    OPEN_HUMAN: 'human',
+    OPEN_PROXY: 'proxy',
+    OPEN_PREFETCH: 'prefetch',
+}
+CLASS_CODES = {name: code for code, name in OPEN_CLASSES.items()}
+
+# O Apple Mail com Privacy Protection busca as imagens com este User-Agent
+APPLE_MPP_USER_AGENT = 'Mozilla/5.0'
+
+_index = ipranges.RangeIndex()
+
+
+def _parse_class(value):
+    code = CLASS_CODES.get(value)
+    if code is None or code == OPEN_HUMAN:
+        raise ValueError(f'classe inválida: {value} (use proxy ou prefetch)')
+    return code
+
+
+def load(path):
+    """Carrega as faixas de IP de máquinas; retorna o número de trechos"""
+    global _index
+    _index = ipranges.RangeIndex(ipranges.read_cidr_file(path, _parse_class))
+    return len(_index)
+
+
+def load_from_config(config):
+    if not config.OPEN_CIDR_FILE:
+        return 0
+    try:
+        return load(config.OPEN_CIDR_FILE)
+    except (OSError, ValueError) as e:
+        print(f"Erro ao carregar faixas de IP de {config.OPEN_CIDR_FILE}: {e}")
+        return 0
+
+
+def classify(ip_address, user_agent):
+    """Código da classe de abertura do evento"""
+    device = useragent.classify(user_agent).device
+    if device == useragent.DEVICE_PROXY:
+        return OPEN_PROXY
+    open_class = _index.lookup(ip_address)
+    if open_class is not None:
+        return open_class
+    if device == useragent.DEVICE_BOT or user_agent == APPLE_MPP_USER_AGENT:
+        return OPEN_PREFETCH
+    return OPEN_HUMAN
+
+
+def parse_exclude(value):
+    """Classes a descontar de ?exclude=proxy,prefetch (ou "machine" para as
+    duas); levanta ValueError"""
+    if not value:
+        return ()
+    names = set()
+    for name in value.split(','):
+        name = name.strip()
+        if name == 'machine':
+            names.update(('proxy', 'prefetch'))
+        elif name in ('proxy', 'prefetch'):
+            names.add(name)
+        else:
+            raise ValueError('Parâmetro exclude aceita proxy, prefetch ou machine')
+    return tuple(sorted(names))
@@ -0,0 +1,85 @@
+# Paginação keyset (timestamp, id) das APIs de visualizações
+
+import base64
+import json
+from datetime import datetime
+
+
+def encode_cursor(timestamp, row_id):
+    """Cursor opaco que aponta para a última linha entregue"""
+    raw = json.dumps([timestamp.isoformat(), row_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Retorna (timestamp, id) do cursor; levanta ValueError se inválido"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        timestamp, row_id = json.loads(raw.decode('utf-8'))
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise ValueError('Cursor inválido')
+
+
+def parse_datetime(value, name):
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'Parâmetro {name} deve estar no formato ISO (ex: 2024-01-31 ou 2024-01-31T12:00:00)')
+
+
+def parse_page_args(args, default_limit, max_limit):
+    """Lê limit, cursor, from e to da query string.
+
+    Retorna um dict com 'limit', 'after' ((timestamp, id) ou None), 'from' e
+    'to'; levanta ValueError com a mensagem para o cliente.
+    """
+    try:
+        limit = int(args.get('limit', default_limit))
+    except ValueError:
+        raise ValueError('Parâmetro limit deve ser um número inteiro')
+    if limit < 1 or limit > max_limit:
+        raise ValueError(f'Parâmetro limit deve estar entre 1 e {max_limit}')
+
+    cursor = args.get('cursor')
+    date_from = args.get('from')
+    date_to = args.get('to')
+    return {
+        'limit': limit,
+        'after': decode_cursor(cursor) if cursor else None,
+        'from': parse_datetime(date_from, 'from') if date_from else None,
+        'to': parse_datetime(date_to, 'to') if date_to else None,
+    }
+
+
+def keyset_filters(page):
+    """Condições SQL e parâmetros para cursor e intervalo de datas.
+
+    As condições comparam a coluna timestamp diretamente, o que permite o
+    pruning de partições e o uso dos índices (<chave>, timestamp DESC).
+    """
+    conditions = []
+    params = []
+    if page['after'] is not None:
+        conditions.append('(timestamp, id) < (%s, %s)')
+        params.extend(page['after'])
+    if page['from'] is not None:
+        conditions.append('timestamp >= %s')
+        params.append(page['from'])
+    if page['to'] is not None:
+        conditions.append('timestamp < %s')
+        params.append(page['to'])
+    return conditions, params
+
+
+def next_cursor(rows, limit, timestamp_index, id_index):
+    """Separa a página (limit linhas) e calcula o próximo cursor.
+
+    A consulta deve buscar limit + 1 linhas; a linha extra só indica que há
+    mais resultados.
+    """
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(last[timestamp_index], last[id_index])
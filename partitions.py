@@ -0,0 +1,294 @@
+# Particionamento por intervalo de tempo de image_views / boleto_views
+#
+# As tabelas são particionadas por RANGE (timestamp), por mês ou por dia.
+# A manutenção cria partições futuras com antecedência e desanexa/apaga as
+# que passaram do prazo de retenção. Uma partição DEFAULT recebe eventos
+# fora de qualquer intervalo; suas linhas são movidas para a partição certa
+# quando ela é criada.
+#
+# Uso:
+#   python partitions.py maintain   (cria futuras / remove expiradas; use no cron)
+#   python partitions.py convert    (converte tabelas antigas não particionadas)
+
+import sys
+from datetime import date, datetime, timedelta
+
+import psycopg2
+import psycopg2.errors
+
+TABLES = ('image_views', 'boleto_views')
+
+INTERVAL_MONTH = 'month'
+INTERVAL_DAY = 'day'
+
+# Serializa a manutenção entre processos / servidores
+MAINTENANCE_LOCK_ID = 7305001
+
+
+def interval_start(day, interval):
+    """Início do intervalo (mês ou dia) que contém ``day``"""
+    if interval == INTERVAL_MONTH:
+        return date(day.year, day.month, 1)
+    return date(day.year, day.month, day.day)
+
+
+def next_interval(start, interval, n=1):
+    """Início do intervalo ``n`` posições depois (ou antes, se negativo)"""
+    if interval == INTERVAL_MONTH:
+        months = start.year * 12 + start.month - 1 + n
+        return date(months // 12, months % 12 + 1, 1)
+    return start + timedelta(days=n)
+
+
+def partition_name(table, start, interval):
+    if interval == INTERVAL_MONTH:
+        return '%s_p%s' % (table, start.strftime('%Y%m'))
+    return '%s_p%s' % (table, start.strftime('%Y%m%d'))
+
+
+def parse_partition_name(table, name, interval):
+    """Início do intervalo codificado no nome, ou None para outras partições"""
+    prefix = table + '_p'
+    if not name.startswith(prefix):
+        return None
+    suffix = name[len(prefix):]
+    try:
+        if interval == INTERVAL_MONTH and len(suffix) == 6:
+            return datetime.strptime(suffix, '%Y%m').date()
+        if interval == INTERVAL_DAY and len(suffix) == 8:
+            return datetime.strptime(suffix, '%Y%m%d').date()
+    except ValueError:
+        pass
+    return None
+
+
+def table_kind(cursor, table):
+    """'partitioned', 'plain' ou None se a tabela não existe"""
+    cursor.execute('''
+        SELECT c.relkind FROM pg_class c
+        WHERE c.oid = to_regclass(%s)
+    ''', (table,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return 'partitioned' if row[0] == 'p' else 'plain'
+
+
+def list_partitions(cursor, table):
+    cursor.execute('''
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.oid = to_regclass(%s)
+    ''', (table,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def partition_index_name(partition, index):
+    """Nome do índice de uma partição que corresponde a ``index`` do pai"""
+    suffix = index[len('idx_'):] if index.startswith('idx_') else index
+    return ('%s_%s' % (partition, suffix))[:63]
+
+
+def adopt_partition_indexes(cursor, table, partition):
+    """Transforma os índices soltos de ``partition`` em índices de ``table``.
+
+    Cada índice ainda não anexado a um pai é renomeado para o nome de
+    partição, recriado no pai com ON ONLY (sem construir nada) e anexado.
+    Usado na conversão, em que a tabela antiga vira <tabela>_legacy levando
+    os índices já construídos. Retorna os nomes dos índices do pai.
+    """
+    cursor.execute('''
+        SELECT c.relname, pg_get_indexdef(i.indexrelid)
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = to_regclass(%s)
+          AND NOT i.indisunique
+          AND NOT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = i.indexrelid)
+        ORDER BY c.relname
+    ''', (partition,))
+    adopted = []
+    for name, definition in cursor.fetchall():
+        child = partition_index_name(partition, name)
+        cursor.execute('ALTER INDEX %s RENAME TO %s' % (name, child))
+        cursor.execute('CREATE INDEX IF NOT EXISTS %s ON ONLY %s USING %s'
+                       % (name, table, definition.split(' USING ', 1)[1]))
+        cursor.execute('ALTER INDEX %s ATTACH PARTITION %s' % (name, child))
+        adopted.append(name)
+    return adopted
+
+
+def create_partition(cursor, table, start, interval):
+    """Cria a partição do intervalo iniciado em ``start``, se ainda não existe.
+
+    A tabela é criada fora da hierarquia, já com os índices do pai, recebe as
+    linhas do intervalo que estejam na partição DEFAULT e só então é anexada.
+    """
+    name = partition_name(table, start, interval)
+    existing = list_partitions(cursor, table)
+    if name in existing:
+        return False
+    end = next_interval(start, interval)
+    cursor.execute('SAVEPOINT create_partition')
+    try:
+        # Com os índices do pai, o ATTACH só os adota em vez de construí-los
+        cursor.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS '
+                       'INCLUDING INDEXES)' % (name, table))
+        default = '%s_default' % table
+        if default in existing:
+            cursor.execute('''
+                WITH moved AS (
+                    DELETE FROM %s WHERE timestamp >= %%s AND timestamp < %%s RETURNING *
+                )
+                INSERT INTO %s SELECT * FROM moved
+            ''' % (default, name), (start, end))
+        cursor.execute('ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (%%s) TO (%%s)'
+                       % (table, name), (start, end))
+    except psycopg2.errors.InvalidObjectDefinition:
+        # O intervalo já é coberto por outra partição (ex.: <tabela>_legacy)
+        cursor.execute('ROLLBACK TO SAVEPOINT create_partition')
+        return False
+    cursor.execute('RELEASE SAVEPOINT create_partition')
+    return True
+
+
+def drop_expired(cursor, table, cutoff, interval, drop=True):
+    """Desanexa (e apaga) partições que terminam antes de ``cutoff``"""
+    removed = []
+    for name in list_partitions(cursor, table):
+        start = parse_partition_name(table, name, interval)
+        if start is None or next_interval(start, interval) > cutoff:
+            continue
+        cursor.execute('ALTER TABLE %s DETACH PARTITION %s' % (table, name))
+        if drop:
+            cursor.execute('DROP TABLE %s' % name)
+        removed.append(name)
+    return removed
+
+
+def maintain(conn, interval=INTERVAL_MONTH, premake=3, retention=0, drop=True, today=None):
+    """Cria as próximas ``premake`` partições e remove as expiradas.
+
+    ``retention`` é o número de intervalos mantidos além do atual (0 = manter
+    tudo). Retorna {'created': [...], 'removed': [...]}.
+    """
+    today = today or date.today()
+    current = interval_start(today, interval)
+    result = {'created': [], 'removed': []}
+
+    cursor = conn.cursor()
+    try:
+        cursor.execute('SELECT pg_try_advisory_xact_lock(%s)', (MAINTENANCE_LOCK_ID,))
+        if not cursor.fetchone()[0]:
+            conn.rollback()
+            return result
+        for table in TABLES:
+            if table_kind(cursor, table) != 'partitioned':
+                continue
+            for n in range(premake + 1):
+                start = next_interval(current, interval, n)
+                if create_partition(cursor, table, start, interval):
+                    result['created'].append(partition_name(table, start, interval))
+            if retention:
+                cutoff = next_interval(current, interval, -retention)
+                result['removed'].extend(drop_expired(cursor, table, cutoff, interval, drop))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return result
+
+
+def convert_table(conn, table, interval=INTERVAL_MONTH):
+    """Converte uma tabela antiga (não particionada) em particionada.
+
+    A tabela original vira a partição ``<tabela>_legacy``, cobrindo tudo até o
+    fim do intervalo do evento mais recente; a sequência de ids e os índices
+    são preservados.
+    """
+    legacy = '%s_legacy' % table
+    cursor = conn.cursor()
+    try:
+        if table_kind(cursor, table) != 'plain':
+            conn.rollback()
+            return False
+
+        cursor.execute('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % table)
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", (table,))
+        sequence = cursor.fetchone()[0]
+        cursor.execute('SELECT MAX(timestamp) FROM %s' % table)
+        latest = cursor.fetchone()[0] or datetime.now()
+        upper = next_interval(interval_start(latest.date(), interval), interval)
+
+        cursor.execute('ALTER TABLE %s RENAME TO %s' % (table, legacy))
+        cursor.execute('UPDATE %s SET timestamp = %%s WHERE timestamp IS NULL' % legacy,
+                       (datetime(1970, 1, 1),))
+        cursor.execute('ALTER TABLE %s ALTER COLUMN timestamp SET NOT NULL' % legacy)
+        cursor.execute('ALTER TABLE %s ALTER COLUMN id TYPE BIGINT' % legacy)
+        cursor.execute('ALTER TABLE %s ALTER COLUMN id DROP DEFAULT' % legacy)
+
+        # O pai copia as colunas da tabela antiga (inclusive as acrescentadas
+        # por migrações) para que ela possa ser anexada
+        cursor.execute('''
+            CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS, PRIMARY KEY (id, timestamp))
+            PARTITION BY RANGE (timestamp)
+        ''' % (table, legacy))
+        if sequence:
+            # Reaproveita a sequência antiga para não repetir ids
+            cursor.execute("ALTER TABLE %s ALTER COLUMN id SET DEFAULT nextval('%s')"
+                           % (table, sequence))
+            cursor.execute('ALTER SEQUENCE %s AS BIGINT OWNED BY %s.id' % (sequence, table))
+        else:
+            sequence = '%s_id_seq' % table
+            cursor.execute('CREATE SEQUENCE %s AS BIGINT OWNED BY %s.id' % (sequence, table))
+            cursor.execute("SELECT setval('%s', COALESCE(MAX(id), 0) + 1, false) FROM %s"
+                           % (sequence, legacy))
+            cursor.execute("ALTER TABLE %s ALTER COLUMN id SET DEFAULT nextval('%s')"
+                           % (table, sequence))
+        cursor.execute("ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (MINVALUE) TO (%%s)"
+                       % (table, legacy), (upper,))
+        # Índices já construídos na tabela antiga (migrações 2 e 4) passam a
+        # ser do pai; a partição DEFAULT e as futuras os herdam
+        adopt_partition_indexes(cursor, table, legacy)
+        cursor.execute('CREATE TABLE %s_default PARTITION OF %s DEFAULT' % (table, table))
+        conn.commit()
+        return True
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def maintain_from_config(conn, config):
+    return maintain(
+        conn,
+        interval=config.PARTITION_INTERVAL,
+        premake=config.PARTITION_PREMAKE,
+        retention=config.PARTITION_RETENTION,
+        drop=config.PARTITION_DROP_EXPIRED
+    )
+
+
+if __name__ == '__main__':
+    from config import config
+    import db_pool
+
+    if len(sys.argv) != 2 or sys.argv[1] not in ('maintain', 'convert'):
+        print("Uso: python partitions.py maintain|convert")
+        sys.exit(2)
+
+    conn = psycopg2.connect(**db_pool.connect_kwargs_from_config(config))
+    try:
+        if sys.argv[1] == 'convert':
+            for table in TABLES:
+                if convert_table(conn, table, config.PARTITION_INTERVAL):
+                    print(f"Tabela {table} convertida para particionada")
+        result = maintain_from_config(conn, config)
+        print(f"Partições criadas: {', '.join(result['created']) or 'nenhuma'}")
+        print(f"Partições removidas: {', '.join(result['removed']) or 'nenhuma'}")
+    finally:
+        conn.close()
@@ -0,0 +1,296 @@
+# Séries temporais pré-agregadas por minuto, hora e dia (rollups)
+#
+# A cada lote ingerido, os eventos são somados em rollup_minute / rollup_hour
+# / rollup_day no horário local de ROLLUP_TIMEZONE (America/Sao_Paulo por
+# padrão), na mesma transação da gravação. /api/timeseries lê só estas
+# tabelas, nunca image_views / boleto_views.
+#
+# - rollup_minute: por empresa (sem fatura), mantida por
+#   ROLLUP_MINUTE_RETENTION_DAYS dias
+# - rollup_hour e rollup_day: por empresa e id_fatura
+#
+# Métricas: opens (todas as aberturas, inclusive as repetidas da janela de
+# deduplicação), unique_opens (aberturas gravadas em image_views) e clicks
+# (acessos a boletos). Aberturas de imagem não têm empresa (empresa = '').
+#
+# Eventos gravados antes dos rollups existirem são agregados por
+# "python rollups.py backfill", em blocos por id a partir de uma marca
+# d'água salva em rollup_watermarks (o processo pode ser interrompido e
+# retomado).
+#
+# Uso: python rollups.py backfill|prune
+
+import sys
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import psycopg2
+import psycopg2.extras
+
+import ingest
+
+DEFAULT_TIMEZONE = 'America/Sao_Paulo'
+
+METRIC_OPENS = 1
+METRIC_UNIQUE_OPENS = 2
+METRIC_CLICKS = 3
+
+METRICS = {
+    'opens': METRIC_OPENS,
+    'unique_opens': METRIC_UNIQUE_OPENS,
+    'clicks': METRIC_CLICKS,
+}
+
+# Granularidade -> (tabela, tamanho do bucket, agrega por fatura)
+BUCKETS = {
+    'minute': ('rollup_minute', timedelta(minutes=1), False),
+    'hour': ('rollup_hour', timedelta(hours=1), True),
+    'day': ('rollup_day', timedelta(days=1), True),
+}
+
+# Consulta de horários de pico: soma de rollup_hour por hora do dia
+HOUR_OF_DAY = 'hour_of_day'
+
+UPSERT = '''
+    INSERT INTO {table} (bucket, metric, empresa, id_fatura, views)
+    VALUES %s
+    ON CONFLICT (bucket, metric, empresa, id_fatura) DO UPDATE SET
+        views = {table}.views + EXCLUDED.views
+'''
+
+_timezone = ZoneInfo(DEFAULT_TIMEZONE)
+# Fuso dos timestamps gravados sem fuso; None = fuso local do servidor
+_event_timezone = None
+
+
+def configure(timezone, event_timezone=None):
+    global _timezone, _event_timezone
+    _timezone = ZoneInfo(timezone)
+    _event_timezone = ZoneInfo(event_timezone) if event_timezone else None
+
+
+def configure_from_config(config):
+    configure(config.ROLLUP_TIMEZONE, config.EVENT_TIMEZONE)
+
+
+def local_time(ts):
+    """Horário local do rollup. Os timestamps dos eventos são gravados sem
+    fuso (datetime.now()) e são lidos no fuso EVENT_TIMEZONE, ou no do
+    servidor quando ele não está configurado; com fuso, são convertidos"""
+    if ts.tzinfo is None and _event_timezone is not None:
+        ts = ts.replace(tzinfo=_event_timezone)
+    return ts.astimezone(_timezone).replace(tzinfo=None)
+
+
+def now():
+    return datetime.now(_timezone).replace(tzinfo=None)
+
+
+def truncate(ts, bucket):
+    if bucket == 'minute':
+        return ts.replace(second=0, microsecond=0)
+    if bucket == 'hour':
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class Rollup:
+    """Acumula contagens por bucket para as três tabelas"""
+
+    def __init__(self):
+        self.groups = {bucket: {} for bucket in BUCKETS}
+
+    def add(self, ts, metric, empresa, id_fatura, n=1):
+        local = local_time(ts)
+        for bucket, (_, _, by_fatura) in BUCKETS.items():
+            key = (truncate(local, bucket), metric, empresa or '', (id_fatura or '') if by_fatura else '')
+            groups = self.groups[bucket]
+            groups[key] = groups.get(key, 0) + n
+
+    def add_event(self, event):
+        if event.timestamp is None:
+            return
+        if isinstance(event, ingest.BoletoViewEvent):
+            self.add(event.timestamp, METRIC_CLICKS, event.empresa, event.id_fatura)
+            return
+        self.add(event.timestamp, METRIC_OPENS, '', event.id_fatura)
+        if isinstance(event, ingest.ImageViewEvent):
+            self.add(event.timestamp, METRIC_UNIQUE_OPENS, '', event.id_fatura)
+
+    def write(self, cursor):
+        for bucket, groups in self.groups.items():
+            if not groups:
+                continue
+            # Ordem fixa das chaves: evita deadlocks entre lotes concorrentes
+            rows = [key + (views,) for key, views in sorted(groups.items())]
+            psycopg2.extras.execute_values(cursor, UPSERT.format(table=BUCKETS[bucket][0]), rows,
+                                           page_size=len(rows))
+
+
+def update_rollups(cursor, events):
+    """Hook de ingestão: soma o lote nos rollups de minuto, hora e dia"""
+    rollup = Rollup()
+    for event in events:
+        rollup.add_event(event)
+    rollup.write(cursor)
+
+
+def backfill(conn, chunk_rows=20000):
+    """Agrega nos rollups as linhas gravadas antes deles existirem.
+
+    Avança last_id até until_id em rollup_watermarks, um bloco por
+    transação; retorna as linhas agregadas por tabela.
+    """
+    done = {}
+    cursor = conn.cursor()
+    try:
+        for source, columns in (('image_views', "'' AS empresa, id_fatura"),
+                                ('boleto_views', 'empresa, id_fatura')):
+            done[source] = 0
+            while True:
+                cursor.execute('SELECT last_id, until_id FROM rollup_watermarks WHERE source = %s FOR UPDATE',
+                               (source,))
+                state = cursor.fetchone()
+                if state is None or state[0] >= state[1]:
+                    conn.rollback()
+                    break
+                last_id, until_id = state
+                cursor.execute('''
+                    SELECT id, timestamp, {}
+                    FROM {}
+                    WHERE id > %s AND id <= %s
+                    ORDER BY id
+                    LIMIT %s
+                '''.format(columns, source), (last_id, until_id, chunk_rows))
+                rows = cursor.fetchall()
+                rollup = Rollup()
+                for row_id, ts, empresa, id_fatura in rows:
+                    if ts is None:
+                        continue
+                    if source == 'boleto_views':
+                        rollup.add(ts, METRIC_CLICKS, empresa, id_fatura)
+                    else:
+                        rollup.add(ts, METRIC_OPENS, '', id_fatura)
+                        rollup.add(ts, METRIC_UNIQUE_OPENS, '', id_fatura)
+                rollup.write(cursor)
+                cursor.execute('UPDATE rollup_watermarks SET last_id = %s WHERE source = %s',
+                               (rows[-1][0] if rows else until_id, source))
+                conn.commit()
+                done[source] += len(rows)
+                print(f"{source}: {done[source]} linhas agregadas")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return done
+
+
+def backfill_pending(cursor):
+    """True enquanto houver linhas antigas fora dos rollups"""
+    cursor.execute('SELECT COUNT(*) FROM rollup_watermarks WHERE last_id < until_id')
+    return cursor.fetchone()[0] > 0
+
+
+def prune(conn, retention_days):
+    """Apaga de rollup_minute os buckets mais antigos que a retenção"""
+    if not retention_days:
+        return 0
+    cursor = conn.cursor()
+    try:
+        cursor.execute('DELETE FROM rollup_minute WHERE bucket < %s',
+                       (truncate(now(), 'day') - timedelta(days=retention_days),))
+        removed = cursor.rowcount
+        conn.commit()
+        return removed
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def default_range(bucket, span, date_from=None, date_to=None):
+    """(from, to) no horário local, com to exclusivo; sem limites, o período
+    ``span`` terminando no bucket atual. Limites com fuso são convertidos
+    para o horário local; sem fuso, já são horário local"""
+    unit = 'hour' if bucket == HOUR_OF_DAY else bucket
+    if date_from is not None and date_from.tzinfo is not None:
+        date_from = local_time(date_from)
+    if date_to is not None and date_to.tzinfo is not None:
+        date_to = local_time(date_to)
+    if date_to is None:
+        date_to = truncate(now(), unit) + BUCKETS[unit][1]
+    if date_from is None:
+        date_from = date_to - span
+    return date_from, date_to
+
+
+def _filters(metric, date_from, date_to, empresa, id_fatura):
+    conditions = ['metric = %s', 'bucket >= %s', 'bucket < %s']
+    params = [METRICS[metric], date_from, date_to]
+    if empresa:
+        conditions.append('empresa = %s')
+        params.append(empresa)
+    if id_fatura:
+        conditions.append('id_fatura = %s')
+        params.append(id_fatura)
+    return ' AND '.join(conditions), params
+
+
+def load_series(cursor, metric, bucket, date_from, date_to, empresa=None, id_fatura=None):
+    """Série [(bucket, views)] contínua (buckets sem eventos com 0)"""
+    table, step, _ = BUCKETS[bucket]
+    where, params = _filters(metric, date_from, date_to, empresa, id_fatura)
+    cursor.execute('''
+        SELECT bucket, SUM(views)
+        FROM {}
+        WHERE {}
+        GROUP BY bucket
+    '''.format(table, where), params)
+    found = {row[0]: int(row[1]) for row in cursor.fetchall()}
+    series = []
+    current = truncate(date_from, bucket)
+    if current < date_from:
+        current += step
+    while current < date_to:
+        series.append((current, found.get(current, 0)))
+        current += step
+    return series
+
+
+def load_hour_of_day(cursor, metric, date_from, date_to, empresa=None, id_fatura=None):
+    """Eventos por hora do dia (0-23), somados no período: horários de pico"""
+    where, params = _filters(metric, date_from, date_to, empresa, id_fatura)
+    cursor.execute('''
+        SELECT EXTRACT(HOUR FROM bucket)::int, SUM(views)
+        FROM rollup_hour
+        WHERE {}
+        GROUP BY 1
+    '''.format(where), params)
+    found = {row[0]: int(row[1]) for row in cursor.fetchall()}
+    return [(hour, found.get(hour, 0)) for hour in range(24)]
+
+
+ingest.register_batch_hook(update_rollups)
+
+
+if __name__ == '__main__':
+    from config import config
+    import db_pool
+
+    if len(sys.argv) != 2 or sys.argv[1] not in ('backfill', 'prune'):
+        print("Uso: python rollups.py backfill|prune")
+        sys.exit(2)
+
+    configure_from_config(config)
+    conn = psycopg2.connect(**db_pool.connect_kwargs_from_config(config))
+    try:
+        if sys.argv[1] == 'backfill':
+            backfill(conn, config.ROLLUP_BACKFILL_CHUNK_ROWS)
+            print("Backfill dos rollups concluído!")
+        # Também depois do backfill, que agrega minutos antigos
+        removed = prune(conn, config.ROLLUP_MINUTE_RETENTION_DAYS)
+        print(f"{removed} buckets de minuto removidos")
+    finally:
+        conn.close()
@@ -0,0 +1,164 @@
+# Registro de envios (campanha, empresa, fatura, boleto, data de envio)
+#
+# É o denominador das taxas de abertura e clique: cada linha diz que a
+# fatura foi enviada numa campanha. O arquivo CSV do disparador é enviado
+# direto ao PostgreSQL com COPY para uma tabela temporária, e de lá entra
+# em sends numa única instrução (envios repetidos da mesma fatura na mesma
+# campanha são ignorados). Depois do commit, os envios novos são lidos de
+# volta por faixa de id e atribuídos ao funil (funnel.register_sends) em
+# blocos de ATTRIBUTE_CHUNK, cada um na sua transação: a memória não cresce
+# com o arquivo e as linhas de fatura_funnel não ficam todas travadas até o
+# fim da carga. Reatribuir um envio não muda nada; se a atribuição for
+# interrompida, 'python funnel.py rebuild' recompõe o funil.
+#
+# O CSV tem cabeçalho; as colunas aceitas são as de SEND_COLUMNS, em
+# qualquer ordem, e só id_fatura é obrigatória. Sem coluna campaign vale a
+# campanha passada ao loader; sem sent_at, o horário da carga.
+#
+# Uso: python sends.py envios.csv[.gz] [--campaign NOME] [--sent-at 2024-11-05T08:00]
+
+import argparse
+import csv
+import gzip
+import io
+import sys
+import time
+from datetime import datetime
+
+import funnel
+
+SEND_COLUMNS = ('campaign', 'empresa', 'id_fatura', 'codigo_boleto', 'sent_at')
+
+CREATE_STAGING = '''
+    CREATE TEMP TABLE sends_staging (
+        campaign VARCHAR(100),
+        empresa VARCHAR(50),
+        id_fatura VARCHAR(255),
+        codigo_boleto VARCHAR(255),
+        sent_at TIMESTAMP
+    ) ON COMMIT DROP
+'''
+
+MERGE_STAGING = '''
+    WITH inserted AS (
+        INSERT INTO sends (campaign, empresa, id_fatura, codigo_boleto, sent_at)
+        SELECT DISTINCT ON (campaign, id_fatura) campaign, empresa, id_fatura, codigo_boleto, sent_at
+        FROM (
+            SELECT COALESCE(NULLIF(campaign, ''), %(campaign)s) AS campaign, NULLIF(empresa, '') AS empresa,
+                   id_fatura, NULLIF(codigo_boleto, '') AS codigo_boleto,
+                   COALESCE(sent_at, %(sent_at)s) AS sent_at
+            FROM sends_staging
+            WHERE id_fatura IS NOT NULL AND id_fatura <> ''
+        ) AS staged
+        ORDER BY campaign, id_fatura, sent_at
+        ON CONFLICT (campaign, id_fatura) DO NOTHING
+        RETURNING id
+    )
+    SELECT COUNT(*), MIN(id), MAX(id) FROM inserted
+'''
+
+SELECT_SENDS = '''
+    SELECT id_fatura, empresa, campaign, sent_at
+    FROM sends
+    WHERE id BETWEEN %s AND %s
+'''
+
+# Bloco lido do arquivo a cada chamada do COPY
+COPY_BUFFER_SIZE = 1 << 20
+
+# Envios atribuídos ao funil por transação
+ATTRIBUTE_CHUNK = 10000
+
+
+def read_header(f):
+    """Colunas do cabeçalho do CSV, validadas contra SEND_COLUMNS"""
+    # CSV exportado do Excel / disparador pode começar com BOM
+    header = next(csv.reader([f.readline().lstrip('\ufeff')]), [])
+    columns = [name.strip().lower() for name in header]
+    unknown = [name for name in columns if name not in SEND_COLUMNS]
+    if unknown:
+        raise ValueError(f"Colunas desconhecidas no CSV de envios: {', '.join(unknown)}")
+    if 'id_fatura' not in columns:
+        raise ValueError("CSV de envios sem a coluna id_fatura")
+    if len(set(columns)) != len(columns):
+        raise ValueError("Colunas repetidas no CSV de envios")
+    return columns
+
+
+def load_csv(conn, f, campaign=None, sent_at=None, chunk_size=ATTRIBUTE_CHUNK):
+    """Carrega um CSV de envios (arquivo texto já aberto) numa transação e
+    atribui os envios novos ao funil em blocos de ``chunk_size``.
+
+    Retorna (linhas do arquivo, envios novos).
+    """
+    columns = read_header(f)
+    if 'campaign' not in columns and not campaign:
+        raise ValueError("Informe a campanha: coluna campaign no CSV ou parâmetro campaign")
+    sent_at = sent_at or datetime.now()
+
+    cursor = conn.cursor()
+    try:
+        cursor.execute(CREATE_STAGING)
+        cursor.copy_expert(
+            'COPY sends_staging (%s) FROM STDIN WITH (FORMAT csv)' % ', '.join(columns),
+            f, size=COPY_BUFFER_SIZE)
+        rows = cursor.rowcount
+        cursor.execute(MERGE_STAGING, {'campaign': campaign, 'sent_at': sent_at})
+        new_sends, first_id, last_id = cursor.fetchone()
+        conn.commit()
+        if new_sends:
+            attribute_sends(conn, cursor, first_id, last_id, chunk_size)
+        return rows, new_sends
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def attribute_sends(conn, cursor, first_id, last_id, chunk_size=ATTRIBUTE_CHUNK):
+    """Atribui ao funil os envios com id entre first_id e last_id, um bloco
+    de ids por transação.
+
+    A faixa pode incluir envios de uma carga concorrente; atribuí-los de novo
+    não altera o funil.
+    """
+    for start in range(first_id, last_id + 1, chunk_size):
+        cursor.execute(SELECT_SENDS, (start, min(start + chunk_size - 1, last_id)))
+        funnel.register_sends(cursor, cursor.fetchall())
+        conn.commit()
+
+
+def open_csv(path):
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig', newline='')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8-sig', newline='')
+    return open(path, encoding='utf-8-sig', newline='')
+
+
+if __name__ == '__main__':
+    from config import config
+    import db_pool
+    import psycopg2
+
+    parser = argparse.ArgumentParser(description='Carga do registro de envios (CSV do disparador)')
+    parser.add_argument('file', help='CSV com cabeçalho (.gz aceito; - lê da entrada padrão)')
+    parser.add_argument('--campaign', help='campanha das linhas sem coluna campaign')
+    parser.add_argument('--sent-at', type=datetime.fromisoformat,
+                        help='data de envio das linhas sem sent_at (padrão: agora)')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**db_pool.connect_kwargs_from_config(config))
+    started = time.monotonic()
+    try:
+        with open_csv(args.file) as f:
+            rows, new_sends = load_csv(conn, f, args.campaign, args.sent_at)
+    except ValueError as e:
+        print(e)
+        sys.exit(2)
+    finally:
+        conn.close()
+    elapsed = time.monotonic() - started
+    print(f"{rows} linhas lidas, {new_sends} envios novos em {elapsed:.1f}s "
+          f"({rows / elapsed if elapsed else 0:.0f} linhas/s)")
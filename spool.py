@@ -0,0 +1,401 @@
+# Spool local em disco para eventos de rastreamento
+#
+# Cada processo grava num segmento próprio ("<ns>-<pid>.active"), só com
+# append. Cada registro é: tamanho (u32) + CRC32 (u32) + payload JSON.
+# Segmentos cheios ou antigos são selados (renomeados para ".seg") e o
+# replayer os drena para o banco com COPY, apagando-os após o commit.
+# A entrega é "pelo menos uma vez": uma queda entre o commit e a remoção
+# do segmento pode duplicar eventos.
+#
+# Eventos que o banco recusa (erro de dados, ex: valor longo demais para a
+# coluna) não são reprocessados: vão para "dead/<segmento>.ndjson", uma
+# linha JSON por evento com o erro, e o resto do segmento segue para o banco.
+
+import glob
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+
+import psycopg2
+
+import ingest
+
+HEADER = struct.Struct('>II')
+
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+
+
+EVENT_TAGS = {
+    'i': ingest.ImageViewEvent,
+    'b': ingest.BoletoViewEvent,
+    'r': ingest.ImageRepeatEvent,
+}
+
+
+def encode_event(event):
+    """Serializa um evento como payload de registro"""
+    if isinstance(event, ingest.ImageViewEvent):
+        tag = 'i'
+    elif isinstance(event, ingest.BoletoViewEvent):
+        tag = 'b'
+    elif isinstance(event, ingest.ImageRepeatEvent):
+        tag = 'r'
+    else:
+        raise TypeError("Evento desconhecido: %r" % (event,))
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in event]
+    return json.dumps([tag] + values, separators=(',', ':')).encode('utf-8')
+
+
+def decode_event(payload):
+    """Reconstrói um evento a partir do payload de um registro"""
+    data = json.loads(payload.decode('utf-8'))
+    tag, values = data[0], data[1:]
+    cls = EVENT_TAGS[tag]
+    event = cls(*values)
+    if event.timestamp:
+        event = event._replace(timestamp=datetime.fromisoformat(event.timestamp))
+    return event
+
+
+def read_segment(path):
+    """Lê os registros válidos de um segmento.
+
+    Retorna (eventos, registros_corrompidos). Registros com CRC inválido são
+    ignorados; um registro truncado no fim (queda durante a escrita) encerra
+    a leitura.
+    """
+    events = []
+    corrupt = 0
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        length, crc = HEADER.unpack_from(data, offset)
+        start = offset + HEADER.size
+        end = start + length
+        if end > len(data):
+            corrupt += 1
+            break
+        payload = data[start:end]
+        offset = end
+        if zlib.crc32(payload) != crc:
+            corrupt += 1
+            continue
+        try:
+            events.append(decode_event(payload))
+        except (ValueError, TypeError, IndexError):
+            corrupt += 1
+    return events, corrupt
+
+
+def encode_record(event):
+    payload = encode_event(event)
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def write_segment(path, events):
+    """Regrava um segmento só com ``events`` (troca atômica do arquivo)"""
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        for event in events:
+            f.write(encode_record(event))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Spool:
+    """Log append-only segmentado, com CRC por registro e política de fsync"""
+
+    def __init__(self, directory, segment_bytes=8 * 1024 * 1024, segment_max_age_ms=1000,
+                 fsync=FSYNC_INTERVAL, fsync_interval_ms=1000):
+        if fsync not in (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER):
+            raise ValueError("Política de fsync inválida: %r" % fsync)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_max_age = segment_max_age_ms / 1000.0
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval_ms / 1000.0
+
+        self._lock = threading.Lock()
+        self._file = None
+        self._path = None
+        self._opened_at = 0.0
+        self._last_fsync = 0.0
+        self._dirty = False
+        self._pid = None
+
+        self._stats = {
+            'appended': 0,
+            'append_errors': 0,
+            'bytes_written': 0,
+            'segments_sealed': 0,
+            'fsyncs': 0,
+        }
+
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+
+    def recover(self):
+        """Sela segmentos e devolve reivindicações deixadas por processos mortos"""
+        for path in glob.glob(os.path.join(self.directory, '*.active')):
+            pid = int(os.path.basename(path).split('.')[0].split('-')[1])
+            if pid != os.getpid() and not _pid_alive(pid):
+                os.replace(path, path[:-len('.active')] + '.seg')
+        for path in glob.glob(os.path.join(self.directory, '*.seg.claimed-*')):
+            pid = int(path.rsplit('-', 1)[1])
+            if pid != os.getpid() and not _pid_alive(pid):
+                os.replace(path, path.rsplit('.claimed-', 1)[0])
+
+    def _open_segment(self):
+        name = '%020d-%d.active' % (time.time_ns(), os.getpid())
+        self._path = os.path.join(self.directory, name)
+        self._file = open(self._path, 'ab')
+        self._opened_at = time.monotonic()
+        self._pid = os.getpid()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_fsync = time.monotonic()
+        self._dirty = False
+        self._stats['fsyncs'] += 1
+
+    def _seal(self):
+        # Chamado com o lock adquirido
+        if self._file is None:
+            return
+        if self._dirty and self.fsync != FSYNC_NEVER:
+            self._sync()
+        self._file.close()
+        if os.path.getsize(self._path):
+            os.replace(self._path, self._path[:-len('.active')] + '.seg')
+            self._stats['segments_sealed'] += 1
+        else:
+            os.remove(self._path)
+        self._file = None
+        self._path = None
+
+    def append(self, event):
+        """Grava um evento no segmento ativo; retorna False se o disco falhar"""
+        record = encode_record(event)
+        with self._lock:
+            try:
+                if self._file is not None and self._pid != os.getpid():
+                    # Processo filho: não escreve no segmento herdado do pai
+                    self._file = None
+                if self._file is None:
+                    self._open_segment()
+                self._file.write(record)
+                self._file.flush()
+                self._dirty = True
+                self._stats['appended'] += 1
+                self._stats['bytes_written'] += len(record)
+                if self.fsync == FSYNC_ALWAYS or (
+                        self.fsync == FSYNC_INTERVAL
+                        and time.monotonic() - self._last_fsync >= self.fsync_interval):
+                    self._sync()
+                if self._file.tell() >= self.segment_bytes:
+                    self._seal()
+            except OSError as e:
+                print(f"Erro ao gravar evento no spool: {e}")
+                self._stats['append_errors'] += 1
+                return False
+        return True
+
+    def tick(self):
+        """fsync periódico e selagem de segmentos antigos (chamado pelo replayer)"""
+        with self._lock:
+            if self._file is None or self._pid != os.getpid():
+                return
+            if self._dirty and self.fsync == FSYNC_INTERVAL \
+                    and time.monotonic() - self._last_fsync >= self.fsync_interval:
+                self._sync()
+            if time.monotonic() - self._opened_at >= self.segment_max_age:
+                self._seal()
+
+    def seal(self):
+        """Sela o segmento ativo imediatamente"""
+        with self._lock:
+            self._seal()
+
+    def claim_segments(self):
+        """Reivindica os segmentos selados (rename atômico) em ordem"""
+        claimed = []
+        suffix = '.claimed-%d' % os.getpid()
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.seg'))):
+            try:
+                os.replace(path, path + suffix)
+            except FileNotFoundError:
+                continue  # outro processo reivindicou antes
+            claimed.append(path + suffix)
+        return claimed
+
+    def dead_letter(self, path, rejected):
+        """Grava os eventos recusados pelo banco em dead/<segmento>.ndjson"""
+        directory = os.path.join(self.directory, 'dead')
+        os.makedirs(directory, exist_ok=True)
+        name = os.path.basename(path).rsplit('.claimed-', 1)[0]
+        with open(os.path.join(directory, name + '.ndjson'), 'a', encoding='utf-8') as f:
+            for event, error in rejected:
+                f.write(json.dumps({'error': str(error).strip(),
+                                    'event': json.loads(encode_event(event))}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def pending_segments(self):
+        return len(glob.glob(os.path.join(self.directory, '*.seg')))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['pending_segments'] = self.pending_segments()
+        return stats
+
+
+class SpoolReplayer:
+    """Thread que drena os segmentos selados para o banco com COPY"""
+
+    def __init__(self, spool, get_connection, interval_ms=500, retry_interval_ms=5000,
+                 writer=ingest.copy_events):
+        self.spool = spool
+        self.get_connection = get_connection
+        self.interval = interval_ms / 1000.0
+        self.retry_interval = retry_interval_ms / 1000.0
+        self.writer = writer
+
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+        self._stats = {
+            'replayed': 0,
+            'segments_replayed': 0,
+            'corrupt_records': 0,
+            'dead_letter': 0,
+            'replay_errors': 0,
+        }
+
+    def start(self):
+        pid = os.getpid()
+        if self._pid == pid and self._thread is not None:
+            return
+        with self._lock:
+            if self._pid == pid and self._thread is not None:
+                return
+            self._pid = pid
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='spool-replayer', daemon=True)
+            self._thread.start()
+
+    def _release(self, path):
+        os.replace(path, path.rsplit('.claimed-', 1)[0])
+
+    def replay(self):
+        """Drena os segmentos selados; retorna False se o banco falhar"""
+        claimed = self.spool.claim_segments()
+        for i, path in enumerate(claimed):
+            try:
+                ok = self._replay_segment(path)
+            except Exception as e:
+                print(f"Erro inesperado ao reprocessar segmento {os.path.basename(path)}: {e!r}")
+                ok = False
+            if not ok:
+                for rest in claimed[i:]:
+                    self._release(rest)
+                with self._lock:
+                    self._stats['replay_errors'] += 1
+                return False
+        return True
+
+    def _replay_segment(self, path):
+        events, corrupt = read_segment(path)
+        result = ingest.WriteResult(0, [], [], None)
+        if events:
+            conn = self.get_connection()
+            if not conn:
+                return False
+            try:
+                result = ingest.write_isolating(self.writer, conn, events)
+            finally:
+                conn.close()
+        if result.rejected:
+            self.spool.dead_letter(path, result.rejected)
+            print(f"{len(result.rejected)} eventos recusados pelo banco em {os.path.basename(path)} "
+                  f"movidos para dead/ ({result.rejected[0][1]})")
+        if result.remaining:
+            print(f"Erro ao reprocessar segmento {os.path.basename(path)}: {result.error}")
+            # O que já foi gravado (ou recusado) sai do segmento
+            if len(result.remaining) < len(events):
+                write_segment(path, result.remaining)
+        else:
+            os.remove(path)
+        with self._lock:
+            self._stats['replayed'] += result.written
+            self._stats['dead_letter'] += len(result.rejected)
+            self._stats['corrupt_records'] += corrupt
+            if not result.remaining:
+                self._stats['segments_replayed'] += 1
+        if corrupt:
+            print(f"{corrupt} registros corrompidos ignorados em {os.path.basename(path)}")
+        return not result.remaining
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.spool.tick()
+                ok = self.replay()
+            except Exception as e:
+                print(f"Erro inesperado no replayer do spool: {e!r}")
+                ok = False
+            self._stop.wait(self.interval if ok else self.retry_interval)
+
+    def stop(self, timeout=10.0):
+        """Sela o segmento ativo e tenta uma última drenagem"""
+        self._stop.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+        self.spool.seal()
+        self.replay()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+class SpoolSink:
+    """Sink de ingestão durável: o handler grava no spool, o replayer no banco"""
+
+    def __init__(self, spool, replayer):
+        self.spool = spool
+        self.replayer = replayer
+
+    def enqueue(self, event):
+        """Grava o evento no spool; retorna False se o disco falhar"""
+        self.replayer.start()
+        return self.spool.append(event)
+
+    def stop(self, timeout=10.0):
+        self.replayer.stop(timeout)
+
+    def stats(self):
+        stats = self.spool.stats()
+        stats.update(self.replayer.stats())
+        return stats
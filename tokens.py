@@ -0,0 +1,212 @@
+# Tokens compactos e assinados para os links de rastreamento
+#
+# No lugar de /image/img1.png?id_fatura=FAT001 e
+# /boleto?empresa=megalink&codigo=<80 hex>&id_fatura=FAT001 o e-mail leva
+# /t/<token>.png e /b/<token>. O token é base64url de um layout binário
+# versionado seguido de um HMAC-SHA256 truncado; a decodificação não consulta
+# o banco e links adulterados são rejeitados.
+#
+# Layout (versão 1):
+#   versão (1 byte) | tipo (1 byte) | campos | HMAC (MAC_BYTES)
+#   pixel:  id_fatura (str) | imagem (str, vazio = pixel transparente)
+#   boleto: empresa (1 byte) | formato do código (1 byte) | código (bytes) | id_fatura (str)
+# Cada campo de tamanho variável é precedido por 1 byte com o tamanho.
+#
+# Uso: python tokens.py pixel <id_fatura> [imagem]
+#      python tokens.py boleto <empresa> <codigo> [id_fatura]
+
+import base64
+import binascii
+import hashlib
+import hmac
+import sys
+from collections import namedtuple
+
+VERSION = 1
+
+KIND_PIXEL = 1
+KIND_BOLETO = 2
+
+# Formato do código do boleto: hexadecimal (minúsculo) vira metade dos bytes
+CODIGO_TEXT = 0
+CODIGO_HEX = 1
+
+MAC_BYTES = 8
+
+PixelToken = namedtuple('PixelToken', ['id_fatura', 'image'])
+BoletoToken = namedtuple('BoletoToken', ['empresa', 'codigo', 'id_fatura'])
+
+
+class InvalidToken(ValueError):
+    pass
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(token):
+    try:
+        return base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+    except (binascii.Error, ValueError):
+        raise InvalidToken('Token inválido')
+
+
+def _pack_field(data):
+    if len(data) > 255:
+        raise ValueError('Campo do token excede 255 bytes')
+    return bytes((len(data),)) + data
+
+
+def _pack_str(value):
+    return _pack_field((value or '').encode('utf-8'))
+
+
+class _Reader:
+    __slots__ = ('raw', 'pos')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.pos = 0
+
+    def byte(self):
+        if self.pos >= len(self.raw):
+            raise InvalidToken('Token inválido')
+        value = self.raw[self.pos]
+        self.pos += 1
+        return value
+
+    def field(self):
+        size = self.byte()
+        end = self.pos + size
+        if end > len(self.raw):
+            raise InvalidToken('Token inválido')
+        data = self.raw[self.pos:end]
+        self.pos = end
+        return data
+
+    def str(self):
+        try:
+            return self.field().decode('utf-8')
+        except UnicodeDecodeError:
+            raise InvalidToken('Token inválido')
+
+
+class TokenCodec:
+    """Codifica e valida tokens.
+
+    ``secret`` assina os tokens novos; ``old_secrets`` continuam aceitos na
+    validação (rotação de chave sem invalidar e-mails já enviados).
+    ``empresa_ids`` mapeia empresa -> código no token (token_id de
+    empresas.json).
+    """
+
+    def __init__(self, secret, empresa_ids, old_secrets=(), mac_bytes=MAC_BYTES):
+        if not secret:
+            raise ValueError('TRACKING_TOKEN_SECRET não configurado')
+        self.mac_bytes = mac_bytes
+        self._secrets = (secret,) + tuple(old_secrets)
+        # Estado HMAC já com a chave aplicada; cada token só copia e atualiza
+        self._macs = [hmac.new(_key(s), digestmod=hashlib.sha256) for s in self._secrets]
+        self.empresa_ids = dict(empresa_ids)
+        self._empresas = {v: k for k, v in self.empresa_ids.items()}
+
+    def __reduce__(self):
+        # Objetos hmac não são serializáveis: processos de trabalho iniciados
+        # com spawn (urlgen / emails --workers) recebem os segredos e recriam
+        # o codec
+        return (TokenCodec, (self._secrets[0], self.empresa_ids, self._secrets[1:], self.mac_bytes))
+
+    def _sign(self, payload, mac=None):
+        mac = (mac or self._macs[0]).copy()
+        mac.update(payload)
+        return mac.digest()[:self.mac_bytes]
+
+    def _encode(self, payload):
+        return _b64encode(payload + self._sign(payload))
+
+    def pixel(self, id_fatura, image=''):
+        """Token de /t/<token>.png para a fatura"""
+        if not id_fatura:
+            raise ValueError('id_fatura é obrigatório')
+        return self._encode(bytes((VERSION, KIND_PIXEL)) + _pack_str(id_fatura) + _pack_str(image))
+
+    def boleto(self, empresa, codigo, id_fatura=None):
+        """Token de /b/<token> para o boleto"""
+        empresa_id = self.empresa_ids.get(empresa)
+        if empresa_id is None:
+            raise ValueError(f'Empresa sem código de token: {empresa}')
+        if not codigo:
+            raise ValueError('codigo é obrigatório')
+        if len(codigo) % 2 == 0 and _is_hex(codigo):
+            fmt, data = CODIGO_HEX, bytes.fromhex(codigo)
+        else:
+            fmt, data = CODIGO_TEXT, codigo.encode('utf-8')
+        payload = (bytes((VERSION, KIND_BOLETO, empresa_id, fmt)) + _pack_field(data)
+                   + _pack_str(id_fatura))
+        return self._encode(payload)
+
+    def decode(self, token):
+        """Retorna PixelToken ou BoletoToken; levanta InvalidToken"""
+        raw = _b64decode(token)
+        if len(raw) <= self.mac_bytes + 2:
+            raise InvalidToken('Token inválido')
+        payload, signature = raw[:-self.mac_bytes], raw[-self.mac_bytes:]
+        if not any(hmac.compare_digest(self._sign(payload, mac), signature) for mac in self._macs):
+            raise InvalidToken('Assinatura inválida')
+
+        reader = _Reader(payload)
+        if reader.byte() != VERSION:
+            raise InvalidToken('Versão de token não suportada')
+        kind = reader.byte()
+        if kind == KIND_PIXEL:
+            result = PixelToken(reader.str(), reader.str())
+        elif kind == KIND_BOLETO:
+            empresa = self._empresas.get(reader.byte())
+            fmt = reader.byte()
+            data = reader.field()
+            if empresa is None or fmt not in (CODIGO_TEXT, CODIGO_HEX):
+                raise InvalidToken('Token inválido')
+            codigo = data.hex() if fmt == CODIGO_HEX else data.decode('utf-8', 'replace')
+            result = BoletoToken(empresa, codigo, reader.str() or None)
+        else:
+            raise InvalidToken('Tipo de token desconhecido')
+        if reader.pos != len(payload):
+            raise InvalidToken('Token inválido')
+        return result
+
+
+def _key(secret):
+    return secret.encode('utf-8') if isinstance(secret, str) else secret
+
+
+HEX_DIGITS = frozenset('0123456789abcdef')
+
+
+def _is_hex(value):
+    # Só minúsculas, sem espaços: o código decodificado precisa ser idêntico
+    return HEX_DIGITS.issuperset(value)
+
+
+def codec_from_config(config, empresa_ids=None):
+    if empresa_ids is None:
+        import empresas
+        empresa_ids = empresas.load_file(config.EMPRESAS_FILE).token_ids
+    return TokenCodec(config.TRACKING_TOKEN_SECRET, empresa_ids, config.TRACKING_TOKEN_OLD_SECRETS,
+                      config.TRACKING_TOKEN_MAC_BYTES)
+
+
+if __name__ == '__main__':
+    from config import config
+
+    args = sys.argv[1:]
+    if not args or args[0] not in ('pixel', 'boleto') or len(args) < (2 if args[0] == 'pixel' else 3):
+        print("Uso: python tokens.py pixel <id_fatura> [imagem]")
+        print("     python tokens.py boleto <empresa> <codigo> [id_fatura]")
+        sys.exit(2)
+
+    codec = codec_from_config(config)
+    if args[0] == 'pixel':
+        print(f"/t/{codec.pixel(*args[1:3])}.png")
+    else:
+        print(f"/b/{codec.boleto(*args[1:4])}")
@@ -0,0 +1,276 @@
+# Geração em massa das URLs de rastreamento para mala direta
+#
+# Lê um fluxo CSV ou NDJSON com as colunas empresa, codigo e id_fatura e
+# escreve, para cada linha, a URL do pixel e a URL do boleto (em texto claro
+# ou com token assinado, ver tokens.py). A entrada é lida e a saída escrita
+# em blocos, então a memória não depende do tamanho do arquivo; os blocos são
+# processados em paralelo por vários processos, na ordem da entrada.
+#
+# Uso: python urlgen.py [--tokens] [--base-url URL] [--input faturas.csv]
+#                       [--output urls.csv] [--format csv|ndjson]
+#                       [--output-format csv|ndjson] [--workers N]
+
+import argparse
+import collections
+import csv
+import io
+import itertools
+import json
+import multiprocessing
+import sys
+import time
+from urllib.parse import quote
+
+import empresas
+import tokens
+
+INPUT_COLUMNS = ('empresa', 'codigo', 'id_fatura')
+OUTPUT_COLUMNS = ('id_fatura', 'empresa', 'codigo', 'pixel_url', 'boleto_url')
+
+# Erros de linha impressos por execução (os demais só são contados)
+MAX_REPORTED_ERRORS = 10
+
+
+class UrlBuilder:
+    """Monta as URLs de uma linha; com ``codec`` gera links /t/ e /b/.
+
+    ``empresas`` (opcional) são as empresas válidas; as demais linhas são
+    rejeitadas em vez de gerar links que /boleto recusaria.
+    """
+
+    def __init__(self, base_url, codec=None, image='img1.png', empresas=None):
+        self.base_url = base_url.rstrip('/')
+        self.codec = codec
+        self.image = image
+        self.empresas = frozenset(empresas) if empresas is not None else None
+        self._image_prefix = '%s/image/%s?id_fatura=' % (self.base_url, quote(image))
+
+    def pixel_url(self, id_fatura):
+        if self.codec is not None:
+            # Com a imagem padrão do token o link fica menor
+            image = '' if self.image == 'pixel.png' else self.image
+            return '%s/t/%s.png' % (self.base_url, self.codec.pixel(id_fatura, image))
+        return self._image_prefix + quote(id_fatura, safe='')
+
+    def boleto_url(self, empresa, codigo, id_fatura):
+        if self.codec is not None:
+            return '%s/b/%s' % (self.base_url, self.codec.boleto(empresa, codigo, id_fatura))
+        url = '%s/boleto?empresa=%s&codigo=%s' % (self.base_url, quote(empresa, safe=''),
+                                                  quote(codigo, safe=''))
+        if id_fatura:
+            url += '&id_fatura=' + quote(id_fatura, safe='')
+        return url
+
+    def build(self, empresa, codigo, id_fatura):
+        """Retorna a linha de saída; levanta ValueError se a linha for inválida"""
+        empresa = (empresa or '').strip().lower()
+        codigo = (codigo or '').strip()
+        id_fatura = (id_fatura or '').strip()
+        if not id_fatura and not codigo:
+            raise ValueError('linha sem id_fatura e sem codigo')
+        if codigo and not empresa:
+            raise ValueError('codigo informado sem empresa')
+        if codigo and self.empresas is not None and empresa not in self.empresas:
+            raise ValueError(f'empresa desconhecida: {empresa}')
+        return (
+            id_fatura,
+            empresa,
+            codigo,
+            self.pixel_url(id_fatura) if id_fatura else '',
+            self.boleto_url(empresa, codigo, id_fatura) if codigo else '',
+        )
+
+
+def generate_urls(rows, builder):
+    """Gera (linha de saída, erro) para cada (empresa, codigo, id_fatura)"""
+    for empresa, codigo, id_fatura in rows:
+        try:
+            yield builder.build(empresa, codigo, id_fatura), None
+        except ValueError as e:
+            yield None, str(e)
+
+
+def read_csv_rows(stream):
+    """Linhas (empresa, codigo, id_fatura) de um CSV com cabeçalho"""
+    reader = csv.reader(stream)
+    header = next(reader, None)
+    if header is None:
+        return
+    header = [h.strip().lower() for h in header]
+    missing = [c for c in INPUT_COLUMNS if c not in header and c != 'id_fatura']
+    if missing:
+        raise ValueError('Colunas ausentes no CSV: %s' % ', '.join(missing))
+    indexes = [header.index(c) if c in header else None for c in INPUT_COLUMNS]
+    for row in reader:
+        yield tuple(row[i] if i is not None and i < len(row) else '' for i in indexes)
+
+
+def read_ndjson_lines(stream):
+    """Linhas brutas do NDJSON; a decodificação é feita nos processos"""
+    for line in stream:
+        if line.strip():
+            yield line
+
+
+def _ndjson_row(line):
+    record = json.loads(line)
+    return tuple(str(record.get(c) or '') for c in INPUT_COLUMNS)
+
+
+def format_csv(rows, header=False):
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+    if header:
+        writer.writerow(OUTPUT_COLUMNS)
+    writer.writerows(rows)
+    return buf.getvalue()
+
+
+def format_ndjson(rows):
+    return ''.join(json.dumps(dict(zip(OUTPUT_COLUMNS, row)), ensure_ascii=False) + '\n'
+                   for row in rows)
+
+
+# Estado de cada processo de trabalho (definido por _init_worker)
+_worker = {}
+
+
+def _init_worker(builder, input_format, output_format):
+    _worker['builder'] = builder
+    _worker['input_format'] = input_format
+    _worker['output_format'] = output_format
+
+
+def process_chunk(first_line, items):
+    """Converte um bloco da entrada; retorna (texto de saída, linhas, erros)"""
+    builder = _worker['builder']
+    rows = []
+    errors = []
+    for n, item in enumerate(items, first_line):
+        try:
+            if _worker['input_format'] == 'ndjson':
+                item = _ndjson_row(item)
+            rows.append(builder.build(*item))
+        except (ValueError, AttributeError) as e:
+            errors.append((n, str(e)))
+    text = format_ndjson(rows) if _worker['output_format'] == 'ndjson' else format_csv(rows)
+    return text, len(rows), errors
+
+
+def chunked(items, chunk_rows):
+    """Blocos (número da primeira linha, itens) de até chunk_rows itens"""
+    line = 1
+    while True:
+        chunk = list(itertools.islice(items, chunk_rows))
+        if not chunk:
+            return
+        yield line, chunk
+        line += len(chunk)
+
+
+def map_chunks(func, chunks, workers, initializer, initargs):
+    """Aplica func(primeira_linha, itens) a cada bloco, em ordem.
+
+    Com workers=1 tudo roda no processo atual. Com mais processos, no máximo
+    2 blocos por processo ficam pendentes, para a leitura não se adiantar à
+    escrita.
+    """
+    if workers == 1:
+        initializer(*initargs)
+        for first_line, chunk in chunks:
+            yield func(first_line, chunk)
+        return
+    with multiprocessing.Pool(workers, initializer, initargs) as pool:
+        pending = collections.deque()
+        for first_line, chunk in chunks:
+            pending.append(pool.apply_async(func, (first_line, chunk)))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def run(input_stream, output_stream, builder, input_format='csv', output_format='csv',
+        workers=None, chunk_rows=5000, progress=None):
+    """Converte a entrada inteira; retorna {'rows', 'errors', 'seconds', 'rows_per_s'}"""
+    items = read_ndjson_lines(input_stream) if input_format == 'ndjson' else read_csv_rows(input_stream)
+    workers = workers or multiprocessing.cpu_count()
+
+    if output_format == 'csv':
+        output_stream.write(format_csv([], header=True))
+
+    stats = {'rows': 0, 'errors': 0}
+    started = time.perf_counter()
+
+    results = map_chunks(process_chunk, chunked(items, chunk_rows), workers,
+                         _init_worker, (builder, input_format, output_format))
+    for text, rows, errors in results:
+        output_stream.write(text)
+        report_errors(errors, stats)
+        stats['rows'] += rows
+        if progress:
+            progress(stats['rows'], time.perf_counter() - started)
+
+    seconds = time.perf_counter() - started
+    stats['seconds'] = seconds
+    stats['rows_per_s'] = stats['rows'] / seconds if seconds > 0 else 0.0
+    return stats
+
+
+def report_errors(errors, stats):
+    for line, message in errors:
+        if stats['errors'] < MAX_REPORTED_ERRORS:
+            print(f"Linha {line} ignorada: {message}", file=sys.stderr)
+        stats['errors'] += 1
+
+
+class Progress:
+    """Imprime a vazão no stderr a cada ``interval`` segundos"""
+
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self._next = interval
+
+    def __call__(self, rows, elapsed):
+        if elapsed >= self._next:
+            self._next = elapsed + self.interval
+            print(f"{rows} linhas em {elapsed:.1f}s ({rows / elapsed:.0f} linhas/s)", file=sys.stderr)
+
+
+def main(argv=None):
+    from config import config
+
+    parser = argparse.ArgumentParser(description='Gera URLs de rastreamento em massa')
+    parser.add_argument('--input', default='-', help='arquivo de entrada (padrão: stdin)')
+    parser.add_argument('--output', default='-', help='arquivo de saída (padrão: stdout)')
+    parser.add_argument('--format', choices=('csv', 'ndjson'), default='csv', help='formato da entrada')
+    parser.add_argument('--output-format', choices=('csv', 'ndjson'), help='formato da saída (padrão: o da entrada)')
+    parser.add_argument('--base-url', default=config.TRACKING_BASE_URL)
+    parser.add_argument('--image', default='img1.png', help='imagem do pixel')
+    parser.add_argument('--tokens', action='store_true', help='gera links /t/ e /b/ com token assinado')
+    parser.add_argument('--workers', type=int, default=config.URLGEN_WORKERS or None)
+    parser.add_argument('--chunk-rows', type=int, default=config.URLGEN_CHUNK_ROWS)
+    args = parser.parse_args(argv)
+
+    registry = empresas.load_file(config.EMPRESAS_FILE)
+    codec = tokens.codec_from_config(config, registry.token_ids) if args.tokens else None
+    builder = UrlBuilder(args.base_url, codec, args.image, registry.empresas)
+
+    input_stream = sys.stdin if args.input == '-' else open(args.input, newline='', encoding='utf-8')
+    output_stream = sys.stdout if args.output == '-' else open(args.output, 'w', newline='', encoding='utf-8')
+    try:
+        stats = run(input_stream, output_stream, builder, args.format,
+                    args.output_format or args.format, args.workers, args.chunk_rows, Progress())
+    finally:
+        if input_stream is not sys.stdin:
+            input_stream.close()
+        if output_stream is not sys.stdout:
+            output_stream.close()
+
+    print(f"{stats['rows']} URLs geradas em {stats['seconds']:.1f}s "
+          f"({stats['rows_per_s']:.0f} linhas/s), {stats['errors']} linhas com erro", file=sys.stderr)
+    return 1 if stats['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
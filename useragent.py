@@ -0,0 +1,199 @@
+# Classificação do User-Agent dos eventos de rastreamento
+#
+# Cada User-Agent vira três códigos pequenos (cliente, sistema, classe do
+# dispositivo) gravados em colunas SMALLINT de image_views / boleto_views e
+# usados nas estatísticas de dispositivos (devices.py). Poucos User-Agents
+# respondem pela maior parte do tráfego (proxies de imagem do Gmail, Outlook,
+# Apple Mail...), então o resultado fica num cache LRU limitado.
+#
+# Os códigos são gravados no banco: nunca reaproveite nem altere um código
+# existente, apenas acrescente novos.
+
+import functools
+import re
+from collections import namedtuple
+
+CACHE_SIZE = 4096
+
+# Clientes
+CLIENT_UNKNOWN = 0
+CLIENT_GMAIL_PROXY = 1
+CLIENT_YAHOO_PROXY = 2
+CLIENT_OUTLOOK = 3
+CLIENT_APPLE_MAIL = 4
+CLIENT_THUNDERBIRD = 5
+CLIENT_CHROME = 6
+CLIENT_FIREFOX = 7
+CLIENT_SAFARI = 8
+CLIENT_EDGE = 9
+CLIENT_OPERA = 10
+CLIENT_SAMSUNG = 11
+CLIENT_WHATSAPP = 12
+CLIENT_FACEBOOK = 13
+CLIENT_BOT = 14
+
+CLIENTS = {
+    CLIENT_UNKNOWN: 'desconhecido',
+    CLIENT_GMAIL_PROXY: 'gmail_proxy',
+    CLIENT_YAHOO_PROXY: 'yahoo_proxy',
+    CLIENT_OUTLOOK: 'outlook',
+    CLIENT_APPLE_MAIL: 'apple_mail',
+    CLIENT_THUNDERBIRD: 'thunderbird',
+    CLIENT_CHROME: 'chrome',
+    CLIENT_FIREFOX: 'firefox',
+    CLIENT_SAFARI: 'safari',
+    CLIENT_EDGE: 'edge',
+    CLIENT_OPERA: 'opera',
+    CLIENT_SAMSUNG: 'samsung_internet',
+    CLIENT_WHATSAPP: 'whatsapp',
+    CLIENT_FACEBOOK: 'facebook',
+    CLIENT_BOT: 'bot',
+}
+
+# Sistemas operacionais
+OS_UNKNOWN = 0
+OS_WINDOWS = 1
+OS_MACOS = 2
+OS_IOS = 3
+OS_ANDROID = 4
+OS_LINUX = 5
+OS_CHROMEOS = 6
+
+OPERATING_SYSTEMS = {
+    OS_UNKNOWN: 'desconhecido',
+    OS_WINDOWS: 'windows',
+    OS_MACOS: 'macos',
+    OS_IOS: 'ios',
+    OS_ANDROID: 'android',
+    OS_LINUX: 'linux',
+    OS_CHROMEOS: 'chromeos',
+}
+
+# Classes de dispositivo
+DEVICE_UNKNOWN = 0
+DEVICE_DESKTOP = 1
+DEVICE_MOBILE = 2
+DEVICE_TABLET = 3
+DEVICE_PROXY = 4  # proxy de imagens do provedor de e-mail (não é o leitor)
+DEVICE_BOT = 5
+
+DEVICES = {
+    DEVICE_UNKNOWN: 'desconhecido',
+    DEVICE_DESKTOP: 'desktop',
+    DEVICE_MOBILE: 'mobile',
+    DEVICE_TABLET: 'tablet',
+    DEVICE_PROXY: 'proxy',
+    DEVICE_BOT: 'bot',
+}
+
+UserAgentInfo = namedtuple('UserAgentInfo', ['client', 'os', 'device'])
+
+UNKNOWN = UserAgentInfo(CLIENT_UNKNOWN, OS_UNKNOWN, DEVICE_UNKNOWN)
+
+# Proxies de imagem: o provedor busca a imagem no lugar do leitor
+_PROXIES = (
+    ('GoogleImageProxy', CLIENT_GMAIL_PROXY),
+    ('YahooMailProxy', CLIENT_YAHOO_PROXY),
+)
+
+_BOT = re.compile(r'bot\b|crawler|spider|curl/|wget/|python-requests|python-urllib|go-http-client|'
+                  r'java/|okhttp|headless|preview|scan', re.IGNORECASE)
+
+# Ordem importa: Edge, Opera e Samsung também anunciam "Chrome"; Chrome
+# também anuncia "Safari"
+_CLIENTS = (
+    ('Microsoft Outlook', CLIENT_OUTLOOK),
+    ('ms-office', CLIENT_OUTLOOK),
+    ('Outlook-iOS', CLIENT_OUTLOOK),
+    ('Outlook-Android', CLIENT_OUTLOOK),
+    ('Thunderbird', CLIENT_THUNDERBIRD),
+    ('WhatsApp', CLIENT_WHATSAPP),
+    ('FBAN', CLIENT_FACEBOOK),
+    ('FBAV', CLIENT_FACEBOOK),
+    ('facebookexternalhit', CLIENT_FACEBOOK),
+    ('Edg/', CLIENT_EDGE),
+    ('EdgA/', CLIENT_EDGE),
+    ('EdgiOS/', CLIENT_EDGE),
+    ('OPR/', CLIENT_OPERA),
+    ('SamsungBrowser', CLIENT_SAMSUNG),
+    ('CriOS', CLIENT_CHROME),
+    ('Chrome/', CLIENT_CHROME),
+    ('FxiOS', CLIENT_FIREFOX),
+    ('Firefox/', CLIENT_FIREFOX),
+)
+
+
+def _os(ua):
+    if 'Windows' in ua:
+        return OS_WINDOWS
+    if 'iPhone' in ua or 'iPad' in ua or 'iPod' in ua:
+        return OS_IOS
+    if 'Android' in ua:
+        return OS_ANDROID
+    if 'CrOS' in ua:
+        return OS_CHROMEOS
+    if 'Mac OS X' in ua or 'Macintosh' in ua:
+        return OS_MACOS
+    if 'Linux' in ua:
+        return OS_LINUX
+    return OS_UNKNOWN
+
+
+def _device(ua, os_code):
+    if 'iPad' in ua or 'Tablet' in ua or (os_code == OS_ANDROID and 'Mobile' not in ua):
+        return DEVICE_TABLET
+    if os_code in (OS_IOS, OS_ANDROID) or 'Mobile' in ua:
+        return DEVICE_MOBILE
+    if os_code in (OS_WINDOWS, OS_MACOS, OS_LINUX, OS_CHROMEOS):
+        return DEVICE_DESKTOP
+    return DEVICE_UNKNOWN
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def classify(ua):
+    """UserAgentInfo com os códigos de cliente, sistema e dispositivo"""
+    if not ua:
+        return UNKNOWN
+    for marker, client in _PROXIES:
+        if marker in ua:
+            return UserAgentInfo(client, OS_UNKNOWN, DEVICE_PROXY)
+
+    os_code = _os(ua)
+    client = CLIENT_UNKNOWN
+    for marker, code in _CLIENTS:
+        if marker in ua:
+            client = code
+            break
+    else:
+        if _BOT.search(ua):
+            return UserAgentInfo(CLIENT_BOT, os_code, DEVICE_BOT)
+        if 'AppleWebKit' in ua and os_code in (OS_MACOS, OS_IOS):
+            # Safari anuncia "Version/x Safari/y"; o Apple Mail (WebKit
+            # embutido) não
+            client = CLIENT_SAFARI if 'Safari/' in ua and 'Version/' in ua else CLIENT_APPLE_MAIL
+    return UserAgentInfo(client, os_code, _device(ua, os_code))
+
+
+def is_proxy(ua):
+    return classify(ua).device == DEVICE_PROXY
+
+
+def describe(info):
+    """Nomes legíveis dos códigos"""
+    return {
+        'client': CLIENTS.get(info.client, 'desconhecido'),
+        'os': OPERATING_SYSTEMS.get(info.os, 'desconhecido'),
+        'device': DEVICES.get(info.device, 'desconhecido'),
+    }
+
+
+def cache_stats():
+    info = classify.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        'hits': info.hits,
+        'misses': info.misses,
+        'size': info.currsize,
+        'max_size': info.maxsize,
+        'hit_ratio': info.hits / lookups if lookups else 0.0,
+    }